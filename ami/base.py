@@ -1,12 +1,26 @@
 import asyncio
 import logging
+import re
 from abc import abstractmethod
-from typing import Dict, List, Callable, Any, Coroutine, Optional, Union
+from typing import AsyncIterator, Dict, Iterable, List, Callable, Any, Coroutine, Optional, Sequence, Set, Union
+
+from ami import cli, recording
+from ami.cache import ResponseCache
+from ami.dispatch import CoalesceKey, EventDispatcher
+from ami.executors import ExecutorOption, ExecutorPools, callback_runner
+from ami.metrics import DEFAULT_BUCKETS, Metrics
+from ami.originate import BulkOriginator, OriginateResult
+from ami.queues import QueueTracker
+from ami.routing import EventRouter, FilterValue, Handler, OrderKey
+from ami.state import ChannelTracker
+from ami.stream import EventStream
+from ami.timeouts import effective_timeout
 
 
 class AMIClientBase:
     def __init__(self, host: str, port: int, ssl_enabled: bool = False,
-                 cert_ca: Union[str, bytes] = None):
+                 cert_ca: Union[str, bytes] = None, event_filters: Optional[List[str]] = None,
+                 event_mask: Optional[Union[bool, str, List[str]]] = None, request_timeout: Optional[float] = None):
         """
         Initializes the AMI Client
 
@@ -14,19 +28,35 @@ class AMIClientBase:
         :param port: The server port
         :param ssl_enabled: Indicates whether SSL/TLS encryption is enabled (default is False)
         :param cert_ca: The CA certificate chain file or bytes (optional)
+        :param event_filters: The server-side event filters applied on every login (see add_filter)
+        :param event_mask: The event mask applied on every login (see set_event_mask)
+        :param request_timeout: The default number of seconds to wait for a response (None waits without limit)
         :raises AttributeError: If cert_ca is provided without enabling SSL/TLS encryption
         """
         if cert_ca is not None and not ssl_enabled:
             raise AttributeError('For cert ca need use ssl_enabled')
         self.logger = logging.getLogger('AMI Client')
-        self._event_callbacks: Dict[str, List[Callable[[dict, Any], Coroutine]]] = {}
+        self._router = EventRouter()
+        self._dispatcher = EventDispatcher(self, self._router)
+        self.channel_tracker: Optional[ChannelTracker] = None
+        self.queue_tracker: Optional[QueueTracker] = None
+        self.metrics: Optional[Metrics] = None
+        self.cache: Optional[ResponseCache] = None
+        self.executors = ExecutorPools()
+        self._streams: Set[EventStream] = set()
+        self.state = 'disconnected'
+        self._state_callbacks: List[Callable[[str, Any], Coroutine]] = []
+        # The running state callbacks, the loop keeps only weak references to tasks
+        self._state_tasks: Set[asyncio.Task] = set()
         self.running = False
         self._loop_tasks = list()
-        self._queues = {}
         self.host = host
         self.port = port
         self._ssl_enabled = ssl_enabled
         self._cert_chain = cert_ca
+        self._event_filters: List[str] = list(event_filters or [])
+        self._event_mask = None if event_mask is None else self._format_event_mask(event_mask)
+        self.request_timeout = request_timeout
 
     @abstractmethod
     async def connect(self, username: str, password: str) -> List[dict]:
@@ -40,36 +70,222 @@ class AMIClientBase:
         pass
 
     @abstractmethod
-    async def ami_request(self, query: dict) -> List[dict]:
+    async def ami_request(self, query: dict, request_timeout: Optional[float] = None) -> List[dict]:
         """
         Sends an AMI request to the server
 
         :param query: The data to be sent
+        :param request_timeout: Seconds to wait for the response (the client default if None, math.inf for no limit),
+            also limited by the current deadline (see ami.timeouts.deadline)
         :return: The response from the server
+        :raises asyncio.TimeoutError: If the response was not received in time
         """
         pass
 
-    @abstractmethod
+    def _timeout(self, request_timeout: Optional[float] = None) -> Optional[float]:
+        """
+        Calculates the time a request can wait for the response
+
+        :param request_timeout: The timeout of the request (the client default if None)
+        :return: The time in seconds or None if it is not limited
+        :raises asyncio.TimeoutError: If the current deadline has already expired
+        """
+        return effective_timeout(self.request_timeout if request_timeout is None else request_timeout)
+
     async def event_dispatch(self) -> None:
         """
-        Dispatches events for processing.
+        Dispatches events for processing until the client is closed.
 
         :return: None
         """
-        pass
+        await self._dispatcher.run()
+
+    def configure_dispatch(self, max_queue_size: int = 0, overflow: str = 'block',
+                           coalesce_key: Optional[CoalesceKey] = None) -> None:
+        """
+        Configures the queue of received events waiting for dispatch. Must be called before connect.
+
+        :param max_queue_size: The maximum number of queued events (0 is unbounded)
+        :param overflow: What to do when the queue is full: 'block' (stop reading from the server),
+            'drop_oldest', 'drop_newest' or 'coalesce' (replace the queued event with the same key)
+        :param coalesce_key: The header name or function giving the key of an event for the 'coalesce' policy
+        :return: None
+        :raises ValueError: If the policy is unknown or 'coalesce' is used without a key
+        """
+        self._dispatcher = EventDispatcher(self, self._router, max_queue_size, overflow, coalesce_key)
+        self._dispatcher.metrics = self.metrics
+
+    def enable_metrics(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Metrics:
+        """
+        Starts collecting metrics: request latency by action, events by type, callback run time
+        and exceptions, queue depths and reconnects. Without metrics the client does not measure anything.
+
+        :param buckets: The upper bounds of the latency buckets in seconds
+        :return: The metrics, see Metrics.snapshot and Metrics.prometheus
+        """
+        if self.metrics is None:
+            self.metrics = Metrics(self, buckets)
+            self._dispatcher.metrics = self.metrics
+        return self.metrics
 
-    async def register_callback(self, event_name: str, callback: Callable[[dict, Any], Coroutine]) -> None:
+    def disable_metrics(self) -> None:
+        self.metrics = None
+        self._dispatcher.metrics = None
+
+    def enable_cache(self, ttls: Optional[Dict[str, float]] = None, max_entries: int = 1024) -> ResponseCache:
+        """
+        Starts caching the responses of read-only actions: a response is reused for the TTL of its action,
+        identical requests in flight share one request to the server, and events or write actions that change
+        the data drop the cached responses (e.g. VarSet and Setvar drop the Getvar responses of the channel).
+
+        :param ttls: Seconds the responses are reused by action name, e.g. {"Getvar": 1, "DBGet": 10}
+            (ami.cache.DEFAULT_TTLS by default), the other actions are not cached
+        :param max_entries: The maximum number of cached responses, the least recently used are evicted
+        :return: The cache
+        """
+        if self.cache is None:
+            self.cache = ResponseCache(self._router, ttls, max_entries)
+        return self.cache
+
+    def disable_cache(self) -> None:
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def dispatch_stats(self) -> Dict[str, int]:
+        """
+        Returns the counters of the event dispatch: queued, in_flight, dispatched, dropped, coalesced and errors
+
+        :return: The counters
+        """
+        return self._dispatcher.stats()
+
+    async def register_callback(self, event_name: str, callback: Callable[[dict, Any], Any],
+                                filters: Optional[Dict[str, FilterValue]] = None,
+                                max_concurrency: Optional[int] = None,
+                                ordered_by: Optional[OrderKey] = None, workers: int = 8,
+                                executor: Optional[ExecutorOption] = None, batch_size: int = 1,
+                                batch_wait: float = 0.05) -> None:
         """
         Registers a callback function to be called when a specific event occurs.
 
-        :param event_name: The name of the event to register the callback for.
-        :param callback: The callback function to be called when the event occurs.
+        :param event_name: The name of the event to register the callback for ('*' for all events).
+        :param callback: The callback function to be called when the event occurs: a coroutine function
+            or a plain function, which runs in an executor and never blocks the event loop.
+        :param filters: The headers the event must match: a string for an exact match,
+            a compiled regular expression (see ami.routing.prefix) or a predicate taking the header value.
+        :param max_concurrency: The maximum number of simultaneous runs of the callback,
+            further events wait in the dispatch queue
+        :param ordered_by: The header name (e.g. 'Uniqueid', 'Linkedid', 'Channel') or function giving the key
+            of an event. Events with the same key are passed to the callback one by one in the order they were
+            received, events with different keys are processed in parallel by a pool of workers
+        :param workers: The number of workers of an ordered callback
+        :param executor: Where a plain function runs: 'thread' (the shared thread pool, the default),
+            'process' (the shared process pool, for CPU-bound work: the function must be defined at module level
+            and gets only the event as a dictionary) or a concurrent.futures.Executor
+        :param batch_size: Pass a plain function lists of up to batch_size events instead of single events
+        :param batch_wait: Seconds to wait for a batch to fill after its first event
+        :return: None
+        :raises ValueError: If an ordered callback has no workers or is batched,
+            an executor is set for a coroutine function or the executor is unknown
+        """
+        run = callback_runner(callback, self.executors, executor, batch_size, batch_wait, max_concurrency, ordered_by)
+        self._router.add(Handler(event_name, callback, filters, max_concurrency, ordered_by, workers, run=run))
+
+    async def unregister_callback(self, event_name: str, callback: Callable[[dict, Any], Coroutine]) -> None:
+        """
+        Removes a callback function registered for a specific event.
+
+        :param event_name: The name of the event the callback was registered for.
+        :param callback: The callback function.
+        :return: None
+        :raises ValueError: If the callback is not registered for the event
+        """
+        if not self._router.remove(event_name, callback):
+            raise ValueError(f'Callback {callback} is not registered for event "{event_name}"')
+        self._dispatcher.forget(event_name, callback)
+        if self.metrics is not None:
+            self.metrics.drop_callback(event_name, callback, [handler.callback for handler in self._router.handlers
+                                                              if handler.event_name == event_name])
+
+    def event_stream(self, names: Union[str, Iterable[str]] = '*', max_batch: int = 500, max_wait: float = 0.05,
+                     max_size: int = 10000, overflow: str = 'drop_oldest', coalesce_key: Optional[CoalesceKey] = None,
+                     filters: Optional[Dict[str, FilterValue]] = None) -> EventStream:
+        """
+        Subscribes an async iterator over batches of events, e.g.
+
+        async with client.event_stream('Cdr', max_batch=500, max_wait=0.05) as stream:
+            async for batch in stream:
+                await insert_many(batch)
+
+        A batch is returned when it has max_batch events or max_wait seconds passed since its first event.
+        The stream has its own buffer, when it is full the overflow policy applies to this stream only
+        ('block' makes the dispatcher wait, delaying all callbacks).
+
+        :param names: The name or names of the events ('*' for all events)
+        :param max_batch: The maximum number of events in a batch
+        :param max_wait: Seconds to wait for more events after the first event of a batch
+        :param max_size: The maximum number of buffered events
+        :param overflow: 'drop_oldest', 'drop_newest', 'coalesce' or 'block'
+        :param coalesce_key: The header name or function giving the key of an event for the 'coalesce' policy
+        :param filters: The header filters the events must match (see register_callback)
+        :return: The stream, closed by close() or when the client is closed
+        :raises ValueError: If max_batch is not positive or the policy is invalid
+        """
+        stream = EventStream(self._router, names, max_batch, max_wait, max_size, overflow, coalesce_key, filters)
+        self._streams = {other for other in self._streams if not other.closed}
+        self._streams.add(stream)
+        return stream
+
+    async def replay(self, path: str, speed: Optional[float] = 1.0) -> int:
+        """
+        Replays a recording made by TCPClient.start_recording into the event dispatch, the events are
+        passed to the callbacks and streams like the events received from the server.
+        If the client is not connected, the dispatch runs only for the replay.
+
+        :param path: The path of the recording
+        :param speed: The speed relative to the recorded time (2 is twice as fast), None replays as fast as possible
+        :return: The number of replayed events
+        """
+        if self.running:
+            return await recording.replay(self, path, speed)
+        self._dispatcher.reset()
+        task = asyncio.get_event_loop().create_task(self.event_dispatch())
+        try:
+            return await recording.replay(self, path, speed)
+        finally:
+            self._dispatcher.stop()
+            await task
+
+    def _get_functions(self, event: dict) -> Sequence[Handler]:
+        return self._router.match(event)
+
+    async def register_state_callback(self, callback: Callable[[str, Any], Coroutine]) -> None:
+        """
+        Registers a callback function to be called when the connection state changes.
+        The states are 'connected', 'disconnected', 'reconnecting' and 'closed'.
+
+        :param callback: The callback function taking the new state and the client.
+        :return: None
+        """
+        self._state_callbacks.append(callback)
+
+    def _set_state(self, state: str) -> None:
+        """
+        Changes the connection state and runs the state callbacks
+
+        :param state: The new state
         :return: None
         """
-        if event_name in self._event_callbacks:
-            self._event_callbacks[event_name].append(callback)
-        else:
-            self._event_callbacks[event_name] = [callback]
+        if state == self.state:
+            return
+        self.logger.info("Connection state changed from '%s' to '%s'", self.state, state)
+        self.state = state
+        loop = asyncio.get_event_loop()
+        for callback in self._state_callbacks:
+            task = loop.create_task(callback(state, self))
+            self._state_tasks.add(task)
+            task.add_done_callback(self._state_tasks.discard)
 
     async def _login(self, username: str, password: str) -> List[dict]:
         """
@@ -86,24 +302,160 @@ class AMIClientBase:
         }
         return await self.ami_request(data)
 
-    async def logoff(self) -> List[dict]:
+    async def _restore_session(self) -> None:
+        """
+        Applies the event mask and the event filters to a new manager session
+
+        :return: None
+        """
+        if self._event_mask is not None:
+            await self.ami_request({"Action": "Events", "EventMask": self._event_mask})
+        await asyncio.gather(*[self.ami_request({"Action": "Filter", "Operation": "Add", "Filter": event_filter})
+                               for event_filter in self._event_filters])
+
+    @staticmethod
+    def _format_event_mask(event_mask: Union[bool, str, List[str]]) -> str:
+        if isinstance(event_mask, bool):
+            return 'on' if event_mask else 'off'
+        if isinstance(event_mask, str):
+            return event_mask
+        return ','.join(event_mask)
+
+    async def add_filter(self, event_filter: str, request_timeout: Optional[float] = None) -> List[dict]:
+        """
+        Adds a server-side event filter, so Asterisk sends only the events the client needs.
+        The filter is a regular expression matched against the whole event text,
+        filters starting with '!' drop the matching events.
+        Filters are kept by the client and applied again after every login.
+
+        :param event_filter: The filter, e.g. "Event: Newchannel" or "!Channel: Local/"
+        :param request_timeout: Seconds to wait for the response (the client default if None)
+        :return: The response from the server or an empty list if the client is not connected yet
+        """
+        if event_filter not in self._event_filters:
+            self._event_filters.append(event_filter)
+        if not self.running:
+            return []
+        return await self.ami_request({"Action": "Filter", "Operation": "Add", "Filter": event_filter},
+                                      request_timeout)
+
+    async def set_event_mask(self, event_mask: Union[bool, str, List[str]],
+                             request_timeout: Optional[float] = None) -> List[dict]:
+        """
+        Sets the classes of events the server sends to the client (Events action).
+        The mask is kept by the client and applied again after every login.
+
+        :param event_mask: True or 'on' for all events, False or 'off' for none,
+            or the list of event classes, e.g. ['call', 'agent']
+        :param request_timeout: Seconds to wait for the response (the client default if None)
+        :return: The response from the server or an empty list if the client is not connected yet
         """
-        Logoff from the AMI server
+        self._event_mask = self._format_event_mask(event_mask)
+        if not self.running:
+            return []
+        return await self.ami_request({"Action": "Events", "EventMask": self._event_mask}, request_timeout)
 
+    def callbacks_filter(self) -> Optional[str]:
+        """
+        Builds a whitelist filter passing only the events that have registered callbacks.
+
+        :return: The filter or None if a callback is registered for all events ('*') or no callbacks are registered
+        """
+        event_names = self._router.event_names()
+        if not event_names or '*' in event_names:
+            return None
+        # Asterisk uses POSIX regular expressions, the name is followed by the line break
+        return f"^Event: ({'|'.join(re.escape(name) for name in sorted(event_names))})[[:space:]]"
+
+    async def filter_by_callbacks(self, request_timeout: Optional[float] = None) -> List[dict]:
+        """
+        Adds a server-side whitelist filter built from the registered callbacks (see callbacks_filter),
+        so Asterisk stops sending the events no callback will consume.
+        Callbacks registered after the call are not taken into account until it is called again.
+
+        :param request_timeout: Seconds to wait for the response (the client default if None)
+        :return: The response from the server or an empty list if there is nothing to filter
+        """
+        event_filter = self.callbacks_filter()
+        if event_filter is None:
+            return []
+        return await self.add_filter(event_filter, request_timeout)
+
+    async def logoff(self, request_timeout: Optional[float] = None) -> List[dict]:
+        """
+        Logoff from the AMI server and close the connection
+
+        :param request_timeout: Seconds to wait for the response (the client default if None)
         :return: The response from the server
         """
-        response = await self.ami_request({"Action": "LogOff"})
-        self.running = False
-        await asyncio.gather(*self._loop_tasks)
+        response = await self.ami_request({"Action": "LogOff"}, request_timeout)
+        await self.close()
         return response
 
-    async def channels(self) -> List[dict]:
+    async def close(self) -> None:
+        """
+        Stops the client loops and closes the connection without logoff
+
+        :return: None
+        """
+        self.running = False
+        self._dispatcher.stop()
+        for stream in list(self._streams):
+            stream.close()
+        self._streams.clear()
+        await asyncio.gather(*self._loop_tasks, return_exceptions=True)
+        self._loop_tasks.clear()
+        await self.executors.shutdown()
+        self._set_state('closed')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+    async def channels(self, refresh: bool = False, request_timeout: Optional[float] = None) -> List[dict]:
         """
-        Shows the channels on the AMI server
+        Shows the channels on the AMI server.
+        If the channels are tracked (see track_channels), the response is built from the tracked state
+        unless the connection was lost and the state is not reloaded yet.
 
+        :param refresh: Request the channels from the server even if they are tracked
+        :param request_timeout: Seconds to wait for the response (the client default if None)
         :return: The response from the server
         """
-        return await self.ami_request({"Action": "CoreShowChannels"})
+        if self.channel_tracker is not None and self.channel_tracker.synced and not refresh:
+            return self.channel_tracker.channels()
+        return await self.ami_request({"Action": "CoreShowChannels"}, request_timeout)
+
+    async def track_channels(self) -> ChannelTracker:
+        """
+        Starts tracking the live channels and bridges in memory. The state is seeded from the server once
+        and then kept current from the channel events, channels() is answered from it without a request.
+
+        :return: The channel tracker with lookups by Uniqueid, channel name and Linkedid
+        """
+        if self.channel_tracker is None:
+            self.channel_tracker = ChannelTracker(self)
+        if not self.channel_tracker.running:
+            await self.channel_tracker.start()
+        return self.channel_tracker
+
+    async def track_queues(self, window: float = 900, sla: Optional[float] = None) -> QueueTracker:
+        """
+        Starts tracking the call queues and their agents in memory. The state is seeded from QueueStatus
+        (again after every reconnect) and then kept current from the queue and agent events,
+        so wallboards can read it without requests.
+
+        :param window: The length of the rolling window of the answered, abandoned and SLA statistics in seconds
+        :param sla: The service level in seconds (by default the ServiceLevel of every queue)
+        :return: The queue tracker with snapshots by queue and by agent
+        """
+        if self.queue_tracker is None:
+            self.queue_tracker = QueueTracker(self, window, sla=sla)
+        if not self.queue_tracker.running:
+            await self.queue_tracker.start()
+        return self.queue_tracker
 
     async def originate(
             self,
@@ -120,7 +472,8 @@ class AMIClientBase:
             early_media: Optional[bool] = None,
             codecs: Optional[List[str]] = None,
             other_channel_id: Optional[str] = None,
-            variables: Optional[List[str]] = None
+            variables: Optional[List[str]] = None,
+            request_timeout: Optional[float] = None
     ) -> List[dict]:
         """
         Sends an originate AMI request
@@ -139,8 +492,37 @@ class AMIClientBase:
         :param codecs: The codecs to use for the call
         :param other_channel_id: The ID of another channel involved in the call
         :param variables: The variables to set for the call
+        :param request_timeout: Seconds to wait for the response (the client default if None)
         :return: The response from the server
         """
+        data = self.originate_query(
+            originator, extension, priority, run_async, timeout, context, caller_id, application, app_data,
+            account, early_media, codecs, other_channel_id, variables
+        )
+        return await self.ami_request(data, request_timeout)
+
+    @staticmethod
+    def originate_query(
+            originator: int,
+            extension: int,
+            priority: int = 1,
+            run_async: bool = True,
+            timeout: int = 15,
+            context: str = "from-internal",
+            caller_id: Optional[str] = None,
+            application: Optional[str] = None,
+            app_data: Optional[str] = None,
+            account: Optional[str] = None,
+            early_media: Optional[bool] = None,
+            codecs: Optional[List[str]] = None,
+            other_channel_id: Optional[str] = None,
+            variables: Optional[List[str]] = None
+    ) -> dict:
+        """
+        Builds the data of an originate AMI request, the parameters are the same as in originate
+
+        :return: The data to be sent
+        """
         data = {
             "Action": "Originate",
             "Channel": f"Local/{originator}@{context}",
@@ -164,15 +546,32 @@ class AMIClientBase:
         if early_media is not None:
             data["EarlyMedia"] = early_media
         if codecs is not None:
-            for n, codec in enumerate(codecs):
-                data[f"Codecs[{n}]"] = codec
+            data["Codecs"] = list(codecs)
         if other_channel_id is not None:
             data["OtherChannelId"] = other_channel_id
         if variables is not None:
-            for n, var in enumerate(variables):
-                data[f"Variable[{n}]"] = variables
+            data["Variable"] = list(variables)
 
-        return await self.ami_request(data)
+        return data
+
+    def originate_many(self, specs: Iterable[dict], rate: float = 10, max_concurrent: int = 100,
+                       burst: Optional[int] = None, result_timeout: Optional[float] = None
+                       ) -> AsyncIterator[OriginateResult]:
+        """
+        Originates a batch of calls, paced by a token-bucket rate and a limit of calls in progress.
+        Every call is correlated with its OriginateResponse event by ActionID, the results are
+        yielded as the calls finish.
+
+        :param specs: The calls, each is a dictionary of the originate parameters,
+            e.g. {"originator": 100, "extension": 89999999999}
+        :param rate: The number of calls started per second
+        :param max_concurrent: The maximum number of calls waiting for their OriginateResponse
+        :param burst: The number of calls that can be started at once (rate by default)
+        :param result_timeout: Seconds to wait for the OriginateResponse (the call timeout plus 30 by default)
+        :return: The async iterator over the results
+        """
+        originator = BulkOriginator(self, rate, max_concurrent, burst, result_timeout)
+        return originator.run(specs)
 
     async def redirect(
             self,
@@ -184,6 +583,7 @@ class AMIClientBase:
             extra_extension: int = None,
             extra_context: str = None,
             extra_priority: int = None,
+            request_timeout: Optional[float] = None
     ) -> List[dict]:
         """
         Sends a redirect AMI request
@@ -196,6 +596,7 @@ class AMIClientBase:
         :param extra_extension: The extra extension to redirect to
         :param extra_context: The extra context to redirect to
         :param extra_priority: The extra priority of the redirect
+        :param request_timeout: Seconds to wait for the response (the client default if None)
         :return: The response from the server
         """
         data = {
@@ -215,15 +616,17 @@ class AMIClientBase:
         if extra_priority is not None:
             data["ExtraPriority"] = extra_priority
 
-        return await self.ami_request(data)
+        return await self.ami_request(data, request_timeout)
 
-    async def blind_transfer(self, channel: str, extension: Union[str, int], context: str = "from-internal") -> List[dict]:
+    async def blind_transfer(self, channel: str, extension: Union[str, int], context: str = "from-internal",
+                             request_timeout: Optional[float] = None) -> List[dict]:
         """
         Sends a blind transfer AMI request
 
         :param channel: The channel to transfer
         :param extension: The number or extension to transfer to
         :param context: The context to transfer to
+        :param request_timeout: Seconds to wait for the response (the client default if None)
         :return: The response from the server
         """
         data = {
@@ -232,15 +635,17 @@ class AMIClientBase:
             "Exten": extension,
             "Context": context
         }
-        return await self.ami_request(data)
+        return await self.ami_request(data, request_timeout)
 
-    async def attended_transfer(self, channel: str, extension: Union[str, int], context: str = "from-internal") -> List[dict]:
+    async def attended_transfer(self, channel: str, extension: Union[str, int], context: str = "from-internal",
+                                request_timeout: Optional[float] = None) -> List[dict]:
         """
         Sends an attended transfer AMI request
 
         :param channel: The channel to transfer
         :param extension: The number or extension to transfer to
         :param context: The context to transfer to
+        :param request_timeout: Seconds to wait for the response (the client default if None)
         :return: The response from the server
         """
         data = {
@@ -249,10 +654,54 @@ class AMIClientBase:
             "Exten": extension,
             "Context": context
         }
-        return await self.ami_request(data)
+        return await self.ami_request(data, request_timeout)
+
+    def command(self, command: str, parse: Union[bool, cli.LineParser] = False,
+                request_timeout: Optional[float] = None) -> AsyncIterator[Union[str, dict]]:
+        """
+        Runs a CLI command and yields its output line by line. HTTPClient streams the lines as they are received,
+        TCPClient yields them after the whole response is received (the output is one message), e.g.
 
-    async def ping(self):
+        async for channel in client.command("core show channels concise", parse=True):
+            print(channel["channel"], channel["state"])
+
+        :param command: The CLI command
+        :param parse: True parses the known table outputs into rows (see ami.cli.PARSERS),
+            a parser from ami.cli (e.g. ami.cli.fixed_width) parses any output with it
+        :param request_timeout: Seconds to wait for the response (the client default if None)
+        :return: The async iterator over the lines or the parsed rows
+        :raises ValueError: If parse is True and the output of the command has no known format
+        :raises RuntimeError: If the server rejected the command
+        """
+        lines = self._command_output(command, request_timeout)
+        if not parse:
+            return lines
+        parser = cli.parser_for(command) if parse is True else parse
+        if parser is None:
+            raise ValueError(f'No parser for the output of "{command}"')
+        return parser(lines)
+
+    async def _command_output(self, command: str, request_timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """
+        Yields the Output lines of a Command response. The response is one message, so the lines
+        are yielded after it is received as a whole
+
+        :param command: The CLI command
+        :param request_timeout: Seconds to wait for the response
+        :return: The async iterator over the lines
+        """
+        response = await self.ami_request({"Action": "Command", "Command": command}, request_timeout)
+        message = response[0] if response else {}
+        lines = message.getall('Output') if hasattr(message, 'getall') else [message.get('Output', '')]
+        if message.get('Response') == 'Error' and not lines:
+            raise RuntimeError(message.get('Message', f'Command "{command}" failed'))
+        for line in lines:
+            yield line
+
+    async def ping(self, request_timeout: Optional[float] = None):
         """
         A 'Ping' action will elicit a 'Pong' response. Used to keep the manager connection open.
+
+        :param request_timeout: Seconds to wait for the response (the client default if None)
         """
-        return await self.ami_request({"Action": "Ping"})
+        return await self.ami_request({"Action": "Ping"}, request_timeout)
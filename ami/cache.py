@@ -0,0 +1,272 @@
+import asyncio
+import collections
+import contextvars
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from ami.routing import EventRouter, Handler
+from ami.serializer import action_headers
+
+# Set in the task filling a cache entry, its request goes to the server
+_filling = contextvars.ContextVar('ami_cache_filling', default=False)
+
+# Action (lower case) -> seconds a successful response is reused
+DEFAULT_TTLS = {
+    'getvar': 1,
+    'dbget': 5,
+    'coreshowchannels': 1,
+    'pjsipshowendpoints': 5,
+    'pjsipshowendpoint': 5,
+    'sippeers': 5,
+    'queuestatus': 1,
+    'queuesummary': 1,
+    'bridgelist': 1,
+    'extensionstate': 1,
+    'corestatus': 1,
+    'coresettings': 60,
+}
+
+# Invalidation rules: event or action -> (cached action, its header, the header of the event or action).
+# The entries of the cached action whose header equals the value of the event header are dropped,
+# all entries of the action are dropped if the rule has no headers or the event does not have the header.
+EVENT_INVALIDATIONS = {
+    'VarSet': [('getvar', 'channel', 'Channel')],
+    'Hangup': [('getvar', 'channel', 'Channel'), ('coreshowchannels', None, None)],
+    'Newchannel': [('coreshowchannels', None, None)],
+    'Newstate': [('coreshowchannels', None, None)],
+    'BridgeCreate': [('bridgelist', None, None)],
+    'BridgeDestroy': [('bridgelist', None, None)],
+    'QueueMemberStatus': [('queuestatus', 'queue', 'Queue'), ('queuesummary', 'queue', 'Queue')],
+    'QueueCallerJoin': [('queuestatus', 'queue', 'Queue'), ('queuesummary', 'queue', 'Queue')],
+    'QueueCallerLeave': [('queuestatus', 'queue', 'Queue'), ('queuesummary', 'queue', 'Queue')],
+    'QueueMemberAdded': [('queuestatus', 'queue', 'Queue'), ('queuesummary', 'queue', 'Queue')],
+    'QueueMemberRemoved': [('queuestatus', 'queue', 'Queue'), ('queuesummary', 'queue', 'Queue')],
+    'QueueMemberPause': [('queuestatus', 'queue', 'Queue'), ('queuesummary', 'queue', 'Queue')],
+    'ExtensionStatus': [('extensionstate', 'exten', 'Exten')],
+    'ContactStatus': [('pjsipshowendpoints', None, None), ('pjsipshowendpoint', 'endpoint', 'EndpointName')],
+    'PeerStatus': [('sippeers', None, None)],
+}
+ACTION_INVALIDATIONS = {
+    'setvar': [('getvar', 'channel', 'channel')],
+    'dbput': [('dbget', 'family', 'family')],
+    'dbdel': [('dbget', 'family', 'family')],
+    'dbdeltree': [('dbget', 'family', 'family')],
+}
+
+CacheKey = Tuple[Tuple[str, str], ...]
+
+
+class _Entry:
+    __slots__ = ('action', 'response', 'expires', 'tags')
+
+    def __init__(self, action: str, response: List[dict], expires: float, tags: Tuple[tuple, ...]):
+        self.action = action
+        self.response = response
+        self.expires = expires
+        self.tags = tags
+
+
+class ResponseCache:
+    """
+    Read-through cache of the responses of read-only actions.
+
+    A response is reused for the TTL of its action, the least recently used entries are evicted
+    when there are more than max_entries. Identical requests made while the response is on its
+    way share one request to the server. Entries are dropped when events or actions change
+    what they describe (e.g. a VarSet of a channel drops its Getvar responses, see EVENT_INVALIDATIONS).
+    Error responses are not cached.
+    """
+
+    def __init__(self, router: EventRouter, ttls: Optional[Dict[str, float]] = None, max_entries: int = 1024):
+        """
+        Initializes the cache and subscribes it to the invalidating events
+
+        :param router: The routing table of the client
+        :param ttls: Seconds the responses are reused by action name (DEFAULT_TTLS by default),
+            the other actions are not cached
+        :param max_entries: The maximum number of cached responses
+        """
+        self.ttls = {action.lower(): ttl for action, ttl in (DEFAULT_TTLS if ttls is None else ttls).items()}
+        self.max_entries = max_entries
+        self._entries: Dict[CacheKey, _Entry] = collections.OrderedDict()
+        self._by_action: Dict[str, Set[CacheKey]] = {}
+        self._by_tag: Dict[tuple, Set[CacheKey]] = {}
+        self._in_flight: Dict[CacheKey, asyncio.Future] = {}
+        # Bumped by every invalidation of an action (and by clear), a response requested before it is not stored
+        self._generations: Dict[str, int] = {}
+        self._cleared = 0
+        # Cached action -> its headers used by the invalidation rules
+        self._tag_headers: Dict[str, Set[str]] = {}
+        for rules in list(EVENT_INVALIDATIONS.values()) + list(ACTION_INVALIDATIONS.values()):
+            for action, header, _ in rules:
+                if header is not None:
+                    self._tag_headers.setdefault(action, set()).add(header)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._router = router
+        self._handlers = [router.add(Handler(event_name, self._on_event, inline=True))
+                          for event_name in EVENT_INVALIDATIONS]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def close(self) -> None:
+        """
+        Unsubscribes from the events and drops all entries
+
+        :return: None
+        """
+        for handler in self._handlers:
+            self._router.remove(handler.event_name, handler.callback)
+        self._handlers = []
+        self.clear()
+
+    def clear(self) -> None:
+        self._cleared += 1
+        self._entries.clear()
+        self._by_action.clear()
+        self._by_tag.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: The counters of the cache: entries, hits, misses and coalesced requests
+        """
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+    @staticmethod
+    def key(query: dict) -> CacheKey:
+        """
+        The key of a request: its headers except ActionID, in a stable order
+
+        :param query: The action
+        :return: The key
+        """
+        return tuple(sorted((name.lower(), str(value)) for name, value in action_headers(query)
+                            if name.lower() != 'actionid'))
+
+    async def request(self, client: Any, query: dict, request_timeout: Optional[float] = None,
+                      **options: Any) -> Optional[List[dict]]:
+        """
+        Answers a request from the cache, joins the identical request in flight or sends it and caches the response.
+        Write actions drop the entries they make stale.
+
+        :param client: The client sending the request
+        :param query: The action
+        :param request_timeout: Seconds to wait for the response (the client default if None)
+        :param options: The other arguments of the request, passed to client.ami_request
+            (a request joining one in flight shares its options)
+        :return: The response or None if the request is not cached and must be sent as usual
+        """
+        if _filling.get():
+            return None
+        action = str(query.get('Action', '')).lower()
+        rules = ACTION_INVALIDATIONS.get(action)
+        if rules is not None:
+            self._apply(rules, {name.lower(): value for name, value in action_headers(query)})
+            return None
+        ttl = self.ttls.get(action)
+        if not ttl:
+            return None
+
+        key = self.key(query)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return list(entry.response)
+            self._drop(key)
+
+        future = self._in_flight.get(key)
+        if future is None:
+            self.misses += 1
+            future = self._in_flight[key] = asyncio.get_event_loop().create_task(
+                self._fill(client, key, action, ttl, query, request_timeout, options))
+            # The error is raised to the waiting callers, it must not be reported again if they all stopped waiting
+            future.add_done_callback(self._consume)
+        else:
+            self.coalesced += 1
+        # A caller that stops waiting does not cancel the request of the others
+        return list(await asyncio.shield(future))
+
+    async def _fill(self, client: Any, key: CacheKey, action: str, ttl: float, query: dict,
+                    request_timeout: Optional[float], options: Dict[str, Any]) -> List[dict]:
+        _filling.set(True)
+        version = self._version(action)
+        try:
+            response = await client.ami_request(query, request_timeout, **options)
+        finally:
+            del self._in_flight[key]
+        # An invalidation while the response was on its way may have made it stale
+        if response and response[0].get('Response') != 'Error' and self._version(action) == version:
+            self._store(key, _Entry(action, response, time.monotonic() + ttl, self._tags(action, key)))
+        return response
+
+    @staticmethod
+    def _consume(task: asyncio.Task) -> None:
+        if not task.cancelled():
+            task.exception()
+
+    def _version(self, action: str) -> Tuple[int, int]:
+        return self._cleared, self._generations.get(action, 0)
+
+    def _invalidated(self, action: str) -> None:
+        self._generations[action] = self._generations.get(action, 0) + 1
+
+    def _tags(self, action: str, key: CacheKey) -> Tuple[tuple, ...]:
+        headers = self._tag_headers.get(action)
+        if not headers:
+            return ()
+        return tuple((action, name, value) for name, value in key if name in headers)
+
+    def _store(self, key: CacheKey, entry: _Entry) -> None:
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = entry
+        self._by_action.setdefault(entry.action, set()).add(key)
+        for tag in entry.tags:
+            self._by_tag.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: CacheKey) -> None:
+        entry = self._entries.pop(key)
+        keys = self._by_action.get(entry.action)
+        keys.discard(key)
+        if not keys:
+            del self._by_action[entry.action]
+        for tag in entry.tags:
+            keys = self._by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self._by_tag[tag]
+
+    def invalidate(self, action: str, **headers: Any) -> int:
+        """
+        Drops cached responses, e.g. cache.invalidate('DBGet', Family='cidname')
+
+        :param action: The action of the responses
+        :param headers: The headers the requests must have, all responses of the action are dropped if there are none
+        :return: The number of dropped responses
+        """
+        action = action.lower()
+        self._invalidated(action)
+        wanted = [(name.lower(), str(value)) for name, value in headers.items()]
+        keys = [key for key in self._by_action.get(action, ()) if all(header in key for header in wanted)]
+        for key in keys:
+            self._drop(key)
+        return len(keys)
+
+    def _apply(self, rules: List[Tuple[str, Optional[str], Optional[str]]], source: dict) -> None:
+        for action, header, source_header in rules:
+            self._invalidated(action)
+            if action not in self._by_action:
+                continue
+            value = source.get(source_header) if source_header is not None else None
+            keys = self._by_action[action] if value is None else self._by_tag.get((action, header, str(value)), ())
+            for key in list(keys):
+                self._drop(key)
+
+    def _on_event(self, event: dict, _client: Any) -> None:
+        self._apply(EVENT_INVALIDATIONS[event.get('Event')], event)
@@ -0,0 +1,114 @@
+import re
+from typing import AsyncIterator, Callable, List, Optional, Sequence, Tuple
+
+LineParser = Callable[[AsyncIterator[str]], AsyncIterator[dict]]
+
+# The summary after a table, e.g. "12 active channels" or "3 sip peers [Monitored: ...]"
+_SUMMARY = re.compile(r'^\d+ [a-z]')
+_COLUMN = re.compile(r'\S+')
+
+
+def _columns(header: str) -> List[Tuple[str, int]]:
+    return [(match.group(), match.start()) for match in _COLUMN.finditer(header)]
+
+
+async def fixed_width(lines: AsyncIterator[str]) -> AsyncIterator[dict]:
+    """
+    Parses a table aligned to its header line, e.g. the output of "core show channels" or "sip show peers".
+    A value is cut from the start of its column to the start of the next one, the table ends at an empty
+    line or a summary line like "12 active channels".
+
+    :param lines: The lines of the output
+    :return: The async iterator over the rows by column name
+    """
+    columns = None
+    async for line in lines:
+        if columns is None:
+            if line.strip():
+                columns = _columns(line)
+            continue
+        if not line.strip() or _SUMMARY.match(line):
+            break
+        row = {}
+        for index, (name, start) in enumerate(columns):
+            end = columns[index + 1][1] if index + 1 < len(columns) else None
+            row[name] = line[start:end].strip()
+        yield row
+
+
+def concise(fields: Sequence[str], separator: str = '!') -> LineParser:
+    """
+    Creates a parser of the "concise" outputs, e.g. "core show channels concise"
+
+    :param fields: The names of the fields in order
+    :param separator: The separator of the fields
+    :return: The parser
+    """
+    async def parse(lines: AsyncIterator[str]) -> AsyncIterator[dict]:
+        async for line in lines:
+            if separator not in line:
+                continue
+            values = line.split(separator)
+            row = dict(zip(fields, values))
+            if len(values) > len(fields):
+                row['extra'] = values[len(fields):]
+            yield row
+    return parse
+
+
+def pjsip_objects(kind: str, pattern: str) -> LineParser:
+    """
+    Creates a parser of the "pjsip show ..." lists, where every object is a "<Kind>:" line after
+    the "=====" line ending the legend, e.g. "Contact:  100/sip:100@10.0.0.2:5060 4a1e35c5d1 Avail  12.345"
+
+    :param kind: The name before the colon, e.g. 'Contact' or 'Endpoint'
+    :param pattern: The regular expression matching the rest of the line, its named groups are the fields
+    :return: The parser
+    """
+    prefix = f'{kind}:'
+    fields = re.compile(pattern)
+
+    async def parse(lines: AsyncIterator[str]) -> AsyncIterator[dict]:
+        legend_done = False
+        async for line in lines:
+            line = line.strip()
+            if line.startswith('=' * 10):
+                legend_done = True
+                continue
+            if not legend_done or not line.startswith(prefix):
+                continue
+            match = fields.match(line[len(prefix):].strip())
+            if match is not None:
+                yield match.groupdict()
+    return parse
+
+
+PARSERS = {
+    'core show channels concise': concise(('channel', 'context', 'exten', 'priority', 'state', 'application',
+                                           'data', 'caller_id', 'account_code', 'peer_account', 'ama_flags',
+                                           'duration', 'bridge_id', 'uniqueid')),
+    'core show channels verbose': fixed_width,
+    'core show channels': fixed_width,
+    'sip show peers': fixed_width,
+    'iax2 show peers': fixed_width,
+    'pjsip show contacts': pjsip_objects('Contact',
+                                         r'(?P<contact>\S+)\s+(?P<hash>\S+)\s+(?P<status>\S+)\s+(?P<rtt>\S+)'),
+    'pjsip show endpoints': pjsip_objects('Endpoint',
+                                          r'(?P<endpoint>\S+)\s+(?P<state>.*?)\s+(?P<channels>\d+ of \S+)$'),
+    'pjsip show aors': pjsip_objects('Aor', r'(?P<aor>\S+)\s+(?P<max_contacts>\d+)'),
+    'pjsip show auths': pjsip_objects('Auth', r'(?P<auth>\S+)'),
+}
+
+
+def parser_for(command: str) -> Optional[LineParser]:
+    """
+    Finds the parser of the output of a CLI command by the longest matching command prefix
+
+    :param command: The CLI command
+    :return: The parser or None if the output has no known table format
+    """
+    normalized = ' '.join(command.lower().split())
+    for prefix in sorted(PARSERS, key=len, reverse=True):
+        if normalized == prefix or normalized.startswith(prefix + ' '):
+            return PARSERS[prefix]
+    return None
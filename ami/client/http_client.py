@@ -1,120 +1,322 @@
 import asyncio
 import logging
+import math
 import ssl
+import time
 import urllib.parse
-from typing import List, Coroutine, Callable, Union
+from typing import Any, AsyncIterator, Dict, List, Callable, Optional, Tuple, Union
 
 import aiohttp
 
 from ami.base import AMIClientBase
+from ami.executors import ExecutorOption
+from ami.routing import FilterValue, OrderKey
+from ami.parser import FrameParser, MXMLParser
+from ami.serializer import action_headers
 
 
 class HTTPClient(AMIClientBase):
+    ENDPOINTS = ('rawman', 'mxml')
+
     def __init__(self, host: str, port: int = 8088, ssl_enabled: bool = False,
-                 cert_ca: Union[str, bytes] = None):
+                 cert_ca: Union[str, bytes] = None, event_filters: Optional[List[str]] = None,
+                 event_mask: Optional[Union[bool, str, List[str]]] = None,
+                 pool_size: int = 100, keepalive_timeout: float = 30, request_timeout: Optional[float] = None,
+                 poll_timeout: int = 30, batch_delay: float = 0.01, min_batch: int = 100,
+                 retry_delay: float = 1, max_retry_delay: float = 30):
+        """
+        Initializes the AMI HTTP Client
+
+        :param host: The server hostname or ip
+        :param port: The server port
+        :param ssl_enabled: Indicates whether SSL/TLS encryption is enabled (default is False)
+        :param cert_ca: The CA certificate chain file or bytes (optional)
+        :param event_filters: The server-side event filters applied on every login
+        :param event_mask: The event mask applied on every login
+        :param pool_size: The maximum number of simultaneous connections to the server
+        :param keepalive_timeout: Seconds an idle connection is kept open for reuse
+        :param request_timeout: The default number of seconds to wait for a response (None waits without limit)
+        :param poll_timeout: The maximum number of seconds a WaitEvent long poll waits for events
+        :param batch_delay: The maximum number of seconds to wait before the next poll while events arrive
+            slower than min_batch per poll, so that the next poll returns them in one block
+        :param min_batch: The number of events per poll from which the next poll is sent immediately
+        :param retry_delay: The delay before the first retry of a failed poll, doubled after every failed retry
+        :param max_retry_delay: The maximum delay between retries of a failed poll
+        """
         if ssl_enabled and port == 8088:
             port = 8089
-        super().__init__(host, port, ssl_enabled, cert_ca)
+        super().__init__(host, port, ssl_enabled, cert_ca, event_filters, event_mask, request_timeout)
         self._context = None
         if cert_ca is not None:
             self._context = ssl.SSLContext()
             self._context.verify_mode = ssl.VerifyMode.CERT_REQUIRED
             self._context.load_verify_locations(cert_ca)
         self.logger = logging.getLogger('HTTP Client')
-        self._queues = {}
-        self._cookies = aiohttp.CookieJar()
+        # unsafe=True accepts the session cookie from servers addressed by IP, as Asterisk usually is
+        self._cookies = aiohttp.CookieJar(unsafe=True)
+        self._pool_size = pool_size
+        self._keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        # The long poll has its own connection, so it never waits for or occupies a slot of the action pool
+        self._event_session: Optional[aiohttp.ClientSession] = None
+        self.poll_timeout = poll_timeout
+        self.batch_delay = batch_delay
+        self.min_batch = min_batch
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.event_rate = 0.0
+        self._credentials: Optional[Tuple[str, str]] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Returns the long-lived session, creating it with its keep-alive connection pool if needed
+
+        :return: The session
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._pool_size, keepalive_timeout=self._keepalive_timeout)
+            # Timeouts are set per request, WaitEvent long polls must not be limited by the session
+            self._session = aiohttp.ClientSession(connector=connector, cookie_jar=self._cookies,
+                                                  timeout=aiohttp.ClientTimeout(total=None))
+        return self._session
+
+    def _get_event_session(self) -> aiohttp.ClientSession:
+        """
+        Returns the session of the event long poll, it shares the cookies (the manager session) of the action pool
+
+        :return: The session
+        """
+        if self._event_session is None or self._event_session.closed:
+            connector = aiohttp.TCPConnector(limit=1, keepalive_timeout=self._keepalive_timeout)
+            self._event_session = aiohttp.ClientSession(connector=connector, cookie_jar=self._cookies,
+                                                        timeout=aiohttp.ClientTimeout(total=None))
+        return self._event_session
 
     async def connect(self, username, password) -> List[dict]:
         self.running = True
-        self._queues['events'] = asyncio.Queue()
+        self._credentials = (username, password)
+        self._get_session()
+        self._dispatcher.reset()
 
         login_resp = await self._login(username, password)
+        if not login_resp or login_resp[0].get('Response') == 'Error':
+            # Polling with rejected credentials would only repeat the failed login
+            self.running = False
+            return login_resp
+        await self._restore_session()
+        self._set_state('connected')
 
         loop = asyncio.get_event_loop()
         self._loop_tasks.append(loop.create_task(self.event_dispatch()))
 
         return login_resp
 
-    async def register_callback(self, event_name: str, callback: Callable[[dict, 'HTTPClient'], Coroutine]) -> None:
-        await super().register_callback(event_name, callback)
+    async def close(self) -> None:
+        self.running = False
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._event_session is not None:
+            # Closing the session also interrupts the WaitEvent long poll
+            await self._event_session.close()
+            self._event_session = None
+        await super().close()
+
+    async def __aenter__(self) -> 'HTTPClient':
+        return self
 
-    async def events(self, timeout=-1):
+    async def register_callback(self, event_name: str, callback: Callable[[dict, 'HTTPClient'], Any],
+                                filters: Optional[Dict[str, FilterValue]] = None,
+                                max_concurrency: Optional[int] = None,
+                                ordered_by: Optional[OrderKey] = None, workers: int = 8,
+                                executor: Optional[ExecutorOption] = None, batch_size: int = 1,
+                                batch_wait: float = 0.05) -> None:
+        await super().register_callback(event_name, callback, filters, max_concurrency, ordered_by, workers,
+                                        executor, batch_size, batch_wait)
+
+    async def events(self, timeout=-1, request_timeout: Optional[float] = None):
         """
         Waits for an event from the AMI server
 
+        :param timeout: Seconds the server waits for an event (-1 waits without limit)
+        :param request_timeout: Seconds to wait for the response (by default a bit longer than timeout)
         :return: The response from the server
         """
-        return await self.ami_request({"Action": "WaitEvent", "Timeout": timeout})
+        if request_timeout is None:
+            request_timeout = math.inf if timeout < 0 else timeout + 5
+        return await self.ami_request({"Action": "WaitEvent", "Timeout": timeout}, request_timeout)
+
+    async def _poll_events(self, timeout: int) -> List[dict]:
+        """
+        Sends one WaitEvent long poll over the event connection and parses the whole returned block
+
+        :param timeout: Seconds the server waits for an event
+        :return: The messages of the response
+        """
+        parser = FrameParser()
+        url = self._url({"Action": "WaitEvent", "Timeout": timeout}, 'rawman')
+        request_timeout = aiohttp.ClientTimeout(total=timeout + 5)
+        async with self._get_event_session().get(url=url, headers={"Content-Type": "text/plain"},
+                                                 ssl=self._context, timeout=request_timeout) as resp:
+            messages = parser.feed(await resp.read())
+        messages.extend(parser.flush())
+        return messages
 
     async def _event_receiving(self):
         """
-        Receives events from the server in a continuous loop, and puts them into a queue for processing.
+        Receives events from the server with WaitEvent long polls and puts every returned block
+        into the dispatch queue at once.
+
+        The server answers a poll as soon as it has events, so under load every poll returns
+        what was queued since the previous one. While fewer than min_batch events arrive per poll,
+        the next poll is delayed (at most batch_delay) by the time in which min_batch events are
+        expected at the measured rate, to receive them in one request instead of many small ones.
+        Idle polls use the full poll_timeout. Failed polls are retried with exponential backoff,
+        an expired manager session is restored by logging in again, failed logins back off the same way.
 
         :return: None
         """
+        loop = asyncio.get_event_loop()
+        attempt = 0
+        last = loop.time()
         while self.running:
-            events = await self.events()
+            try:
+                messages = await self._poll_events(self.poll_timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not self.running:
+                    break
+                delay = min(self.retry_delay * 2 ** attempt, self.max_retry_delay)
+                attempt += 1
+                self.logger.warning("Event poll failed: %r, retry in %.1fs", e, delay)
+                await asyncio.sleep(delay)
+                continue
+            if messages and messages[0].get('Response') == 'Error':
+                self.logger.warning("Event poll rejected: %s", messages[0].get('Message'))
+                if await self._relogin():
+                    attempt = 0
+                    continue
+                delay = min(self.retry_delay * 2 ** attempt, self.max_retry_delay)
+                attempt += 1
+                self.logger.warning("Login failed, retry in %.1fs", delay)
+                await asyncio.sleep(delay)
+                continue
+            attempt = 0
+            events = [message for message in messages
+                      if 'Event' in message and message['Event'] != 'WaitEventComplete']
+            if events:
+                await self._dispatcher.put_many(events)
 
-            for event in events:
-                if 'Event' in event and event['Event'] != "WaitEventComplete":
-                    await self._queues['events'].put(event)
+            now = loop.time()
+            elapsed, last = now - last, now
+            if elapsed > 0:
+                # Exponentially weighted rate, a busy second is not forgotten after one quiet poll
+                self.event_rate += (len(events) / elapsed - self.event_rate) * min(elapsed, 1)
+            if events and len(events) < self.min_batch and self.event_rate > 0:
+                await asyncio.sleep(min(self.batch_delay, (self.min_batch - len(events)) / self.event_rate))
+
+    async def _relogin(self) -> bool:
+        """
+        Logs in again after the manager session has expired
 
-    def _get_functions(self, event_name):
-        return self._event_callbacks.get(event_name, []) + self._event_callbacks.get('*', [])
+        :return: True if the session was restored
+        """
+        if self._credentials is None:
+            return False
+        try:
+            response = await self._login(*self._credentials)
+            if not response or response[0].get('Response') == 'Error':
+                return False
+            await self._restore_session()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning("Login failed: %r", e)
+            return False
+        return True
 
     async def event_dispatch(self):
         loop = asyncio.get_event_loop()
         self._loop_tasks.append(loop.create_task(self._event_receiving()))
+        await super().event_dispatch()
 
-        while self.running:
-            try:
-                # retrieve the get() awaitable
-                get_await = self._queues['events'].get()
-                # await the awaitable with a timeout
-                event = await asyncio.wait_for(get_await, 1)
-            except asyncio.TimeoutError:
-                self.logger.debug('Events timeout, retry')
-                continue
-            # check for stop
-            if event is None:
-                break
-            functions = self._get_functions(event['Event'])
-            if len(functions) != 0:
-                loop = asyncio.get_event_loop()
-                [loop.create_task(fn(event, self)) for fn in functions]
-                self.logger.info(f"Execute callbacks for event '{event['Event']}'")
-
-    @staticmethod
-    def _headers_to_dict(headers: str) -> List[dict]:
-        """
-        This static method converts a strings to formatted as key-value pairs into a dictionary.
-
-        :param headers: The string containing the key-value pairs.
-        :return: The list of dictionaries with the converted key-value pairs.
-        """
-        header_list = []
-        blocks = headers.strip().split('\r\n\r\n')
-        for block in blocks:
-            header_dict = {}
-            lines = block.split('\r\n')
-            for line in lines:
-                key, value = line.split(': ', 1)
-                header_dict[key] = value
-            header_list.append(header_dict)
-        return header_list
-
-    async def ami_request(self, query: dict) -> List[dict]:
-        scheme = 'http'
+    def _url(self, query: dict, endpoint: str) -> str:
+        scheme = 'https' if self._ssl_enabled else 'http'
+        # Asterisk looks the header names up in lower case, the values are sent as they are
+        get_query = urllib.parse.urlencode([(name.lower(), value) for name, value in action_headers(query)])
+        return f"{scheme}://{self.host}:{self.port}/{endpoint}?{get_query}"
+
+    async def ami_request_stream(self, query: dict, endpoint: str = 'rawman',
+                                 request_timeout: Optional[float] = None) -> AsyncIterator[dict]:
+        """
+        Sends an AMI request to the server and yields the messages of the response as soon as each
+        of them is received, without loading the whole response into memory.
+        With the 'mxml' endpoint the keys of the messages are in lower case, as Asterisk sends them.
+
+        :param query: The data to be sent
+        :param endpoint: The manager endpoint: 'rawman' or 'mxml'
+        :param request_timeout: Seconds to receive the whole response (the client default if None,
+            math.inf for no limit), also limited by the current deadline (see ami.timeouts.deadline)
+        :return: The async iterator over the messages of the response
+        :raises ValueError: If the endpoint is not supported
+        :raises asyncio.TimeoutError: If the response was not received in time
+        """
+        if endpoint not in self.ENDPOINTS:
+            raise ValueError(f'Unsupported endpoint "{endpoint}", use one of {", ".join(self.ENDPOINTS)}')
+        parser = MXMLParser() if endpoint == 'mxml' else FrameParser()
         headers = {"Content-Type": "text/plain"}
-        get_query = urllib.parse.urlencode(query).lower()
-        if self._ssl_enabled:
-            scheme = 'https'
-        url = f"{scheme}://{self.host}:{self.port}/rawman?{get_query}"
-        async with aiohttp.ClientSession(cookie_jar=self._cookies) as session:
-            async with session.get(url=url, headers=headers, ssl=self._context) as resp:
-                response_text = await resp.text(encoding='windows-1251', errors='replace')
-                self.logger.debug(resp.status, resp.reason, response_text)
-                response = self._headers_to_dict(response_text)
-                if query['Action'] != 'WaitEvent':
-                    self.logger.info(f"Response {response} for {query}")
+        url = self._url(query, endpoint)
+        timeout = aiohttp.ClientTimeout(total=self._timeout(request_timeout))
+        async with self._get_session().get(url=url, headers=headers, ssl=self._context, timeout=timeout) as resp:
+            self.logger.debug("%s %s for %s", resp.status, resp.reason, query)
+            async for chunk in resp.content.iter_any():
+                for message in parser.feed(chunk):
+                    yield message
+            for message in parser.flush():
+                yield message
+
+    async def _command_output(self, command: str, request_timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """
+        Yields the Output lines of a Command response as they are received, without buffering the response
+
+        :param command: The CLI command
+        :param request_timeout: Seconds to receive the whole output (the client default if None)
+        :return: The async iterator over the lines
+        """
+        url = self._url({"Action": "Command", "Command": command}, 'rawman')
+        timeout = aiohttp.ClientTimeout(total=self._timeout(request_timeout))
+        encoding = FrameParser().encoding
+        error = None
+        has_output = False
+        async with self._get_session().get(url=url, headers={"Content-Type": "text/plain"},
+                                           ssl=self._context, timeout=timeout) as resp:
+            async for raw in resp.content:
+                key, sep, value = raw.decode(encoding, 'replace').partition(':')
+                if not sep:
+                    continue
+                if key == 'Output':
+                    has_output = True
+                    yield value.strip()
+                elif key == 'Response' and value.strip() == 'Error':
+                    error = f'Command "{command}" failed'
+                elif key == 'Message' and error is not None:
+                    error = value.strip()
+        if error is not None and not has_output:
+            raise RuntimeError(error)
+
+    async def ami_request(self, query: dict, request_timeout: Optional[float] = None) -> List[dict]:
+        if self.cache is not None:
+            response = await self.cache.request(self, query, request_timeout)
+            if response is not None:
                 return response
+        messages = self.ami_request_stream(query, request_timeout=request_timeout)
+        if self.metrics is None:
+            response = [message async for message in messages]
+        else:
+            started = time.monotonic()
+            failed = True
+            try:
+                response = [message async for message in messages]
+                failed = False
+            finally:
+                self.metrics.observe_request(query.get('Action'), time.monotonic() - started, failed)
+        if query['Action'] != 'WaitEvent':
+            self.logger.info("Response %s for %s", response, query)
+        return response
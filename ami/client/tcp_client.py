@@ -1,23 +1,78 @@
 import asyncio
+import collections
+import contextvars
+import itertools
 import logging
-import re
+import random
 import ssl
-from typing import List, Union, Coroutine, Callable, Optional
+import uuid
+from typing import Any, Dict, List, Union, Callable, Optional, Set, Tuple
 
 from ami.base import AMIClientBase
+from ami.executors import ExecutorOption
+from ami.routing import FilterValue, OrderKey
+from ami.parser import FrameParser
+from ami.recording import EventRecorder
+from ami.serializer import serialize_action
+
+
+# Set in the task restoring the session after a reconnect, its requests do not wait for the session
+_resuming = contextvars.ContextVar('resuming', default=False)
 
 
 class TCPClient(AMIClientBase):
+    # Actions that are safe to send again if the connection was lost before the response was received
+    REPLAYABLE_ACTIONS = frozenset((
+        'ping', 'getvar', 'dbget', 'coreshowchannels', 'corestatus', 'coresettings', 'status', 'bridgelist',
+        'bridgeinfo', 'queuestatus', 'queuesummary', 'sippeers', 'sipshowpeer', 'pjsipshowendpoints',
+        'pjsipshowendpoint', 'pjsipshowcontacts', 'pjsipshowregistrationsoutbound', 'iaxpeerlist',
+        'extensionstate', 'presencestate', 'devicestatelist', 'mailboxcount', 'mailboxstatus', 'listcommands',
+        'showdialplan', 'confbridgelist', 'confbridgelistrooms', 'parkedcalls', 'agents',
+    ))
+
     def __init__(self, host: str, port: int = 5038, ssl_enabled: bool = False,
-                 cert_ca: Union[str, bytes] = None):
+                 cert_ca: Union[str, bytes] = None, event_filters: Optional[List[str]] = None,
+                 event_mask: Optional[Union[bool, str, List[str]]] = None, reconnect: bool = True,
+                 reconnect_delay: float = 1, max_reconnect_delay: float = 60, request_timeout: Optional[float] = None):
+        """
+        Initializes the AMI TCP Client
+
+        :param host: The server hostname or ip
+        :param port: The server port
+        :param ssl_enabled: Indicates whether SSL/TLS encryption is enabled (default is False)
+        :param cert_ca: The CA certificate chain file or bytes (optional)
+        :param event_filters: The server-side event filters applied on every login
+        :param event_mask: The event mask applied on every login
+        :param reconnect: Reconnect and login again when the connection is lost
+        :param reconnect_delay: The delay before the first reconnect attempt, doubled after every failed attempt
+        :param max_reconnect_delay: The maximum delay between reconnect attempts
+        :param request_timeout: The default number of seconds to wait for a response (None waits without limit)
+        """
         if ssl_enabled and port == 5038:
             port = 5039
-        super().__init__(host, port, ssl_enabled, cert_ca)
+        super().__init__(host, port, ssl_enabled, cert_ca, event_filters, event_mask, request_timeout)
         self.logger = logging.getLogger('TCP Client')
         self._reader: Union[asyncio.StreamReader, None] = None
         self._writer: Union[asyncio.StreamWriter, None] = None
-        self._queues = {}
-        self._resp_waiting = []
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._requests: Dict[str, Tuple[bytes, bool]] = {}
+        self._event_lists: Dict[str, List[dict]] = {}
+        # ActionIDs of the requests that stopped waiting, their late responses are discarded
+        self._expired: Dict[str, None] = collections.OrderedDict()
+        self._discarding: Set[str] = set()
+        self._outgoing: List[bytes] = []
+        self._action_prefix = uuid.uuid4().hex[:8]
+        self._action_ids = itertools.count(1)
+        self._parser = FrameParser()
+        self.read_size = 65536
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.reconnects = 0
+        self._credentials: Optional[Tuple[str, str]] = None
+        self._logging_off = False
+        self._ready: Optional[asyncio.Event] = None
+        self.recorder: Optional[EventRecorder] = None
 
     async def tls_handshake(self, ssl_context: Optional[ssl.SSLContext] = None):
         # Get from toolbox https://github.com/synchronizing/toolbox
@@ -34,11 +89,13 @@ class TCPClient(AMIClientBase):
         self._reader._transport = new_transport
         self._writer._transport = new_transport
 
-    async def connect(self, username, password) -> List[dict]:
-        self.running = True
-        self._queues['messages'] = asyncio.Queue()
-        self._queues['events'] = asyncio.Queue()
-        self._queues['responses'] = asyncio.Queue()
+    async def _open_connection(self) -> None:
+        """
+        Opens the TCP connection, with the TLS handshake if SSL/TLS encryption is enabled
+
+        :return: None
+        """
+        self._parser.clear()
         self._reader, self._writer = await asyncio.open_connection(host=self.host, port=self.port)
         if self._ssl_enabled:
             context = ssl.SSLContext()
@@ -50,6 +107,15 @@ class TCPClient(AMIClientBase):
 
             await self.tls_handshake(context)
 
+    async def connect(self, username, password) -> List[dict]:
+        self.running = True
+        self._logging_off = False
+        self._credentials = (username, password)
+        self._ready = asyncio.Event()
+        self._ready.set()
+        self._dispatcher.reset()
+        await self._open_connection()
+
         loop = asyncio.get_event_loop()
         self._loop_tasks.append(loop.create_task(self.message_loop()))
         self._loop_tasks.append(loop.create_task(self.event_dispatch()))
@@ -57,130 +123,368 @@ class TCPClient(AMIClientBase):
         login_resp = await self._login(username, password)
         if login_resp[0].get('Response') == 'Error':
             self.running = False
+        else:
+            await self._restore_session()
+            self._set_state('connected')
 
         return login_resp
 
-    async def register_callback(self, event_name: str, callback: Callable[[dict, 'TCPClient'], Coroutine]) -> None:
-        await super().register_callback(event_name, callback)
+    async def logoff(self, request_timeout: Optional[float] = None) -> List[dict]:
+        # The server closes the connection after the response, it must not be restored
+        self._logging_off = True
+        return await super().logoff(request_timeout)
+
+    async def close(self) -> None:
+        self.running = False
+        if self.state == 'reconnecting':
+            for task in self._loop_tasks:
+                task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        self._fail_pending(ConnectionError('The client is closed'))
+        await self.stop_recording()
+        await super().close()
+
+    def start_recording(self, path: str, compress: bool = False, max_bytes: Optional[int] = None,
+                        flush_interval: float = 0.5) -> EventRecorder:
+        """
+        Starts recording the data received from the server to an append-only file,
+        see ami.recording.replay to replay it. The data is written in batches by a separate thread.
+
+        :param path: The path of the file
+        :param compress: Compress the file with gzip
+        :param max_bytes: Start a new numbered file when the current one reaches this size
+        :param flush_interval: Seconds between batched writes
+        :return: The recorder
+        """
+        if self.recorder is None:
+            self.recorder = EventRecorder(path, compress, max_bytes, flush_interval)
+            self.recorder.start(self._parser.pending())
+        return self.recorder
+
+    async def stop_recording(self) -> None:
+        """
+        Stops recording and writes the rest of the recorded data
+
+        :return: None
+        """
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            await recorder.stop()
+
+    async def __aenter__(self) -> 'TCPClient':
+        return self
+
+    async def register_callback(self, event_name: str, callback: Callable[[dict, 'TCPClient'], Any],
+                                filters: Optional[Dict[str, FilterValue]] = None,
+                                max_concurrency: Optional[int] = None,
+                                ordered_by: Optional[OrderKey] = None, workers: int = 8,
+                                executor: Optional[ExecutorOption] = None, batch_size: int = 1,
+                                batch_wait: float = 0.05) -> None:
+        await super().register_callback(event_name, callback, filters, max_concurrency, ordered_by, workers,
+                                        executor, batch_size, batch_wait)
+
+    async def _write(self, request: bytes) -> None:
+        """
+        Queues a request for sending. The requests queued in the same loop iteration are written
+        to the socket at once with writelines.
+
+        :param request: The serialized request
+        :return: None
+        :raises ConnectionError: If the connection was lost
+        """
+        self._outgoing.append(request)
+        if len(self._outgoing) == 1:
+            asyncio.get_event_loop().call_soon(self._flush)
+        await self._writer.drain()
+
+    def _flush(self) -> None:
+        outgoing, self._outgoing = self._outgoing, []
+        if outgoing and self._writer is not None:
+            self._writer.writelines(outgoing)
+
+    async def _receiving(self) -> Optional[List[dict]]:
+        """
+        This method reads the next chunk from the TCP stream and parses all complete messages from it.
+
+        :return: The list of parsed messages (may be empty) or None if the connection was closed
+        """
+        try:
+            data = await asyncio.wait_for(self._reader.read(self.read_size), timeout=5)
+        except asyncio.TimeoutError:
+            self.logger.debug("Socket timeout, retry")
+            return []
+        except OSError as e:
+            self.logger.error(f"Socket error: {e!r}")
+            return None
+        if not data:
+            return None
+        if self.recorder is not None:
+            self.recorder.record(data)
+        return self._parser.feed(data)
+
+    def _next_action_id(self) -> str:
+        """
+        Generates a unique ActionID for an outgoing request.
 
-    @staticmethod
-    def _dict_to_headers(data: dict) -> str:
+        :return: The ActionID
         """
-        This static method converts a dictionary into a formatted string with key-value pairs suitable for headers.
+        return f"{self._action_prefix}-{next(self._action_ids)}"
 
-        :param data: The dictionary containing the data.
-        :return: The formatted string with key-value pairs.
+    def _resolve(self, action_id: str, response: List[dict]) -> None:
+        """
+        Hands a complete response over to the request waiting for it.
+
+        :param action_id: The ActionID of the request
+        :param response: The response from the server
+        :return: None
         """
-        result = ''
-        for key, value in data.items():
-            key_name = re.sub(r"\[\d+]", "", key)
-            result += f"{key_name}: {value}\r\n"
-        result += '\r\n'
-        return result
+        future = self._pending.get(action_id)
+        if future is not None and not future.done():
+            future.set_result(response)
 
-    @staticmethod
-    def _message_to_dict(data: list) -> dict:
+    def _route_message(self, message: dict) -> Optional[dict]:
         """
-        This static method converts a list of strings formatted as key-value pairs into a dictionary.
+        Routes a message: responses and EventList events go to the request waiting for them
+        by their ActionID, all other events are returned for dispatch.
 
-        :param data: The list containing the key-value pairs.
-        :return: The dictionary with the converted key-value pairs.
+        :param message: The parsed message
+        :return: The event to dispatch or None if the message was consumed
         """
-        result = {}
-        for row in data:
-            line = row.split(': ', 1)
-            if len(line) == 2:
-                key, value = line
-                result[key] = value
-        return result
+        action_id = message.get('ActionID')
 
-    async def _receiving(self):
+        # Events may carry a Response header too, e.g. OriginateResponse
+        if 'Event' in message:
+            if self._discarding and action_id in self._discarding:
+                if message.get('EventList') == 'Complete':
+                    self._discarding.discard(action_id)
+                return None
+            response_list = self._event_lists.get(action_id) if action_id is not None else None
+            if response_list is None:
+                return message
+            response_list.append(message)
+            if message.get('EventList') == 'Complete':
+                del self._event_lists[action_id]
+                self._resolve(action_id, response_list)
+        elif 'Response' in message:
+            if action_id in self._expired:
+                del self._expired[action_id]
+                if message.get('EventList') == 'start':
+                    self._discarding.add(action_id)
+                self.logger.debug('Discard late response for ActionID "%s"', action_id)
+            elif action_id not in self._pending:
+                self.logger.warning(f'Response for unknown ActionID "{action_id}": {message}')
+            elif message.get('EventList') == 'start':
+                self._event_lists[action_id] = [message]
+            else:
+                self._resolve(action_id, [message])
+        else:
+            logging.error(f'Проблемы с определением типа сообщения "{message}"')
+        return None
+
+    async def message_loop(self):
         """
-        This method reads lines from the TCP stream and puts them in a queue until an empty line is encountered.
-        It decodes each line and strips leading and trailing whitespace before adding it to the list.
+        This method is responsible for reading and processing messages.
 
         :return: None
         """
-        lines = []
         while self.running:
-            try:
-                line = await asyncio.wait_for(self._reader.readline(), timeout=5)
-            except TimeoutError:
-                self.logger.debug("Socket timeout, retry")
+            messages = await self._receiving()
+            if messages is None:
+                if not self.running:
+                    break
+                self.logger.error('Connection closed by the server')
+                if not self.reconnect or self._logging_off:
+                    self._fail_pending(ConnectionResetError('Connection closed by the server'))
+                    self._set_state('disconnected')
+                    break
+                self._connection_lost()
+                if not await self._reopen():
+                    break
+                self.reconnects += 1
+                self._loop_tasks = [task for task in self._loop_tasks if not task.done()]
+                self._loop_tasks.append(asyncio.get_event_loop().create_task(self._resume_session()))
                 continue
+            for message in messages:
+                self.logger.debug("New message: %s", message)
+                event = self._route_message(message)
+                if event is not None:
+                    await self._dispatcher.put(event)
 
-            if not line.strip():
-                await self._queues['messages'].put(lines)
-                lines = []
-                continue
-            logging.debug(f"Line: {line}")
-            decoded_line = line.decode('windows-1251', errors='replace').strip()
-            lines.append(decoded_line)
+    def _connection_lost(self) -> None:
+        """
+        Prepares the requests for a reconnect: the requests that can be replayed keep waiting,
+        the others fail. New requests wait until the session is restored.
 
-    def _get_functions(self, event_name):
-        return self._event_callbacks.get(event_name, []) + self._event_callbacks.get('*', [])
+        :return: None
+        """
+        self._ready.clear()
+        self._set_state('disconnected')
+        self._event_lists.clear()
+        if self.recorder is not None:
+            self.recorder.reset()
+        # Requests not written yet are replayed or failed below with the others
+        self._outgoing.clear()
+        exc = ConnectionResetError('Connection closed by the server')
+        for action_id, future in self._pending.items():
+            _, replay = self._requests[action_id]
+            if not replay and not future.done():
+                future.set_exception(exc)
 
-    async def event_dispatch(self):
+    async def _reopen(self) -> bool:
+        """
+        Opens the connection again, retrying with exponential backoff
+
+        :return: False if the client was closed before the connection was opened
+        """
+        self._set_state('reconnecting')
+        if self._writer is not None:
+            self._writer.close()
+        attempt = 0
         while self.running:
             try:
-                # retrieve the get() awaitable
-                get_await = self._queues['events'].get()
-                # await the awaitable with a timeout
-                event = await asyncio.wait_for(get_await, 1)
-            except asyncio.TimeoutError:
-                self.logger.debug('Events timeout, retry')
-                continue
-            # check for stop
-            if event is None:
-                break
-            functions = self._get_functions(event['Event'])
-            if len(functions) != 0:
-                loop = asyncio.get_event_loop()
-                [loop.create_task(fn(event, self)) for fn in functions]
-                self.logger.info(f"Execute callbacks for event '{event['Event']}'")
+                await self._open_connection()
+                return True
+            except OSError as e:
+                delay = min(self.reconnect_delay * 2 ** attempt, self.max_reconnect_delay)
+                attempt += 1
+                self.logger.warning(f"Reconnect attempt {attempt} failed: {e!r}, next in {delay:.1f}s")
+                await asyncio.sleep(delay * random.uniform(0.5, 1))
+        return False
 
-    async def message_loop(self):
+    async def _resume_session(self) -> None:
         """
-        This method is responsible for processing messages.
+        Logs in again after a reconnect, restores the event mask and filters and replays
+        the requests interrupted by the disconnect
 
         :return: None
         """
-        loop = asyncio.get_event_loop()
-        self._loop_tasks.append(loop.create_task(self._receiving()))
+        _resuming.set(True)
+        lost = False
+        try:
+            try:
+                login_resp = await self._login(*self._credentials)
+            except ConnectionError:
+                raise
+            except Exception as e:
+                # Not logged in, the message loop connects again
+                self.logger.error(f"Login after reconnect failed: {e!r}")
+                self._writer.close()
+                raise ConnectionError('Login after reconnect failed') from e
+            if login_resp[0].get('Response') == 'Error':
+                self.logger.error(f"Login after reconnect failed: {login_resp}")
+                self.running = False
+                self._fail_pending(ConnectionError(f"Login after reconnect failed: {login_resp[0].get('Message')}"))
+                self._writer.close()
+                self._set_state('disconnected')
+                return
+            await self._restore_session()
+            replayed = []
+            for action_id, (request, replay) in list(self._requests.items()):
+                future = self._pending.get(action_id)
+                if replay and future is not None and not future.done():
+                    self.logger.info("Replay request %s", action_id)
+                    replayed.append(request)
+            self._writer.writelines(replayed)
+            await self._writer.drain()
+        except ConnectionError:
+            # The connection was lost again, the message loop will retry
+            lost = True
+        except Exception as e:
+            self.logger.error(f"Failed to restore the session after reconnect: {e!r}")
+        finally:
+            if not lost:
+                # The requests waiting for the session must not wait forever, even if it was not fully restored
+                self._ready.set()
+                if self.running:
+                    self._set_state('connected')
 
-        while self.running:
-            data = await self._queues['messages'].get()
-            self.logger.debug(f"New message: {data}")
+    def _expire(self, action_id: str) -> None:
+        """
+        Marks a request that stopped waiting, so its late response is discarded
 
-            message = self._message_to_dict(data)
+        :param action_id: The ActionID of the request
+        :return: None
+        """
+        if action_id in self._event_lists:
+            self._discarding.add(action_id)
+            return
+        self._expired[action_id] = None
+        if len(self._expired) > 1024:
+            self._expired.popitem(last=False)
 
-            if 'Event' in message:
-                await self._queues['events'].put(message)
-            elif 'Response' in message:
-                response_list = [message]
+    def _fail_pending(self, exc: BaseException) -> None:
+        """
+        Fails all requests waiting for a response.
 
-                if message.get('EventList') == 'start':
-                    while self.running:
-                        list_data = await self._queues['messages'].get()
-                        list_message = self._message_to_dict(list_data)
-                        response_list.append(list_message)
-                        if 'Event' in list_message and list_message.get('EventList') == 'Complete':
-                            break
-
-                await self._queues['responses'].put(response_list)
-            else:
-                logging.error(f'Проблемы с определением типа сообщения "{message}"')
+        :param exc: The exception to raise in the waiting requests
+        :return: None
+        """
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exc)
 
-    async def ami_request(self, query: dict) -> List[dict]:
-        request = self._dict_to_headers(query)
-        self._writer.write(request.encode('utf8'))
-        await self._writer.drain()
+    async def ami_request(self, query: dict, request_timeout: Optional[float] = None,
+                          replay: Optional[bool] = None) -> List[dict]:
+        """
+        Sends an AMI request to the server and waits for the response with the same ActionID.
+        If the query has no ActionID, a unique one is generated, so any number of requests
+        can be in flight on the connection at the same time.
+        While the client is reconnecting, the request waits until the session is restored.
+
+        :param query: The data to be sent
+        :param request_timeout: Seconds to wait for the response (the client default if None, math.inf for no limit),
+            also limited by the current deadline (see ami.timeouts.deadline)
+        :param replay: Send the request again if the connection is lost before the response is received,
+            by default only the read-only actions from REPLAYABLE_ACTIONS are replayed, the others fail
+        :return: The response from the server
+        :raises ValueError: If a request with the same ActionID is already waiting for a response
+        :raises ConnectionError: If the connection was lost and the request was not replayed
+        :raises asyncio.TimeoutError: If the response was not received in time
+        """
+        if self.cache is not None:
+            response = await self.cache.request(self, query, request_timeout, replay=replay)
+            if response is not None:
+                return response
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        timeout = self._timeout(request_timeout)
+        expires = None if timeout is None else loop.time() + timeout
+        if self._ready is not None and not self._ready.is_set() and not _resuming.get():
+            await asyncio.wait_for(self._ready.wait(), timeout)
+
+        query = dict(query)
+        action_id = str(query.setdefault('ActionID', self._next_action_id()))
+        if action_id in self._pending:
+            raise ValueError(f'Request with ActionID "{action_id}" is already in progress')
+        if replay is None:
+            replay = str(query.get('Action', '')).lower() in self.REPLAYABLE_ACTIONS
+
+        future = loop.create_future()
+        request = serialize_action(query)
+        self._pending[action_id] = future
+        self._requests[action_id] = (request, replay)
+        failed = True
+        try:
+            try:
+                await self._write(request)
+            except ConnectionError:
+                # The message loop fails or replays the request when it detects the disconnect
+                pass
 
-        self.logger.debug(f"Start wait for {query}")
-        self._resp_waiting.insert(0, 1)
-        response = await self._queues['responses'].get()
-        self._resp_waiting.pop(0)
-        self.logger.debug(f"Stop wait for {query}")
+            self.logger.debug("Start wait for %s", query)
+            response = await asyncio.wait_for(future, None if expires is None else max(expires - loop.time(), 0))
+            self.logger.debug("Stop wait for %s", query)
+            failed = False
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self._expire(action_id)
+            raise
+        finally:
+            self._pending.pop(action_id, None)
+            self._requests.pop(action_id, None)
+            self._event_lists.pop(action_id, None)
+            if self.metrics is not None:
+                self.metrics.observe_request(query.get('Action'), loop.time() - started, failed)
 
-        self.logger.info(f"Response {response} for {query}")
+        self.logger.info("Response %s for %s", response, query)
         return response
@@ -0,0 +1,413 @@
+import asyncio
+import collections
+import logging
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Union
+
+from ami.routing import EventRouter, Handler
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest', 'coalesce')
+
+CoalesceKey = Union[str, Callable[[dict], Any]]
+
+
+class EventBuffer:
+    """
+    Bounded queue of events with a selectable overflow policy:
+
+    - 'block': the reader waits until there is free space (backpressure on the socket)
+    - 'drop_oldest': the oldest queued event is dropped to free space
+    - 'drop_newest': the new event is dropped
+    - 'coalesce': a new event replaces the queued event with the same key, if there is
+      no such event and the queue is full, the oldest event is dropped
+    """
+
+    def __init__(self, maxsize: int = 0, overflow: str = 'block', coalesce_key: Optional[CoalesceKey] = None):
+        """
+        Initializes the buffer
+
+        :param maxsize: The maximum number of queued events (0 is unbounded)
+        :param overflow: The overflow policy
+        :param coalesce_key: The header name or function giving the key of an event for the 'coalesce' policy
+        :raises ValueError: If the policy is unknown or 'coalesce' is used without a key
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy "{overflow}", use one of {", ".join(OVERFLOW_POLICIES)}')
+        if overflow == 'coalesce' and coalesce_key is None:
+            raise ValueError('The coalesce policy requires coalesce_key')
+        self.maxsize = maxsize
+        self.overflow = overflow
+        if overflow != 'coalesce':
+            coalesce_key = None
+        elif isinstance(coalesce_key, str):
+            header = coalesce_key
+            coalesce_key = lambda event: event.get(header)  # noqa: E731
+        self._coalesce_key = coalesce_key
+        self._entries: Deque[list] = collections.deque()
+        self._by_key: Dict[Any, list] = {}
+        self._getters: Deque[asyncio.Future] = collections.deque()
+        self._putters: Deque[asyncio.Future] = collections.deque()
+        self._closed = False
+        self.dropped = 0
+        self.coalesced = 0
+
+    def qsize(self) -> int:
+        return len(self._entries)
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= len(self._entries)
+
+    @staticmethod
+    def _wake(waiters: Deque[asyncio.Future]) -> None:
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def _append(self, key: Any, event: dict) -> None:
+        entry = [key, event]
+        if key is not None:
+            self._by_key[key] = entry
+        self._entries.append(entry)
+        self._wake(self._getters)
+
+    def _popleft(self) -> dict:
+        entry = self._entries.popleft()
+        key, event = entry
+        if key is not None and self._by_key.get(key) is entry:
+            del self._by_key[key]
+        self._wake(self._putters)
+        return event
+
+    def get_nowait(self) -> Optional[dict]:
+        """
+        Takes the next event from the buffer without waiting.
+
+        :return: The event or None if the buffer is empty
+        """
+        if not self._entries:
+            return None
+        return self._popleft()
+
+    def put_nowait(self, event: dict) -> bool:
+        """
+        Puts an event in the buffer applying the overflow policy (the 'block' policy is treated as 'drop_newest').
+
+        :param event: The event
+        :return: False if the event was dropped
+        """
+        if self._closed:
+            return False
+        key = self._coalesce_key(event) if self._coalesce_key is not None else None
+        if key is not None:
+            entry = self._by_key.get(key)
+            if entry is not None:
+                entry[1] = event
+                self.coalesced += 1
+                return True
+        if self.full():
+            if self.overflow in ('drop_oldest', 'coalesce'):
+                self._popleft()
+                self.dropped += 1
+            else:
+                self.dropped += 1
+                return False
+        self._append(key, event)
+        return True
+
+    async def put(self, event: dict) -> bool:
+        """
+        Puts an event in the buffer, with the 'block' policy waits while the buffer is full.
+
+        :param event: The event
+        :return: False if the event was dropped
+        """
+        while self.overflow == 'block' and self.full() and not self._closed:
+            putter = asyncio.get_event_loop().create_future()
+            self._putters.append(putter)
+            try:
+                await putter
+            except asyncio.CancelledError:
+                putter.cancel()
+                raise
+        return self.put_nowait(event)
+
+    async def get(self) -> Optional[dict]:
+        """
+        Takes the next event from the buffer, waits if it is empty.
+
+        :return: The event or None if the buffer is closed
+        """
+        while not self._entries:
+            if self._closed:
+                return None
+            getter = asyncio.get_event_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                getter.cancel()
+                raise
+        return self._popleft()
+
+    def close(self) -> None:
+        """
+        Closes the buffer: waiting readers get None, waiting writers are released.
+
+        :return: None
+        """
+        self._closed = True
+        for waiter in list(self._getters) + list(self._putters):
+            if not waiter.done():
+                waiter.set_result(None)
+        self._getters.clear()
+        self._putters.clear()
+
+
+class OrderedWorkers:
+    """
+    Fixed pool of worker coroutines running one ordered callback.
+    Events are partitioned by the key of the handler (e.g. Uniqueid), events with the same key
+    always go to the same worker and are processed one by one in the order they were received,
+    events with different keys are processed in parallel.
+    """
+
+    def __init__(self, dispatcher: 'EventDispatcher', handler: Handler, queue_size: int = 1000):
+        """
+        Initializes the pool and starts the workers
+
+        :param dispatcher: The dispatcher running the callback
+        :param handler: The handler of the ordered callback
+        :param queue_size: The maximum number of events waiting for each worker
+        """
+        self._dispatcher = dispatcher
+        self._handler = handler
+        self._queues = [asyncio.Queue(queue_size) for _ in range(handler.workers)]
+        loop = asyncio.get_event_loop()
+        self._tasks = [loop.create_task(self._work(queue)) for queue in self._queues]
+        self.busy = 0
+
+    def qsize(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def submit(self, event: dict, key: Any) -> None:
+        """
+        Puts the event in the queue of its worker, waits if the queue is full.
+
+        :param event: The event
+        :param key: The order key of the event
+        :return: None
+        """
+        await self._queues[hash(key) % len(self._queues)].put(event)
+
+    async def _work(self, queue: asyncio.Queue) -> None:
+        while True:
+            event = await queue.get()
+            self.busy += 1
+            try:
+                await self._dispatcher.call(self._handler, event)
+            finally:
+                self.busy -= 1
+
+    def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+
+class EventDispatcher:
+    """
+    Takes events from a bounded buffer and runs the matching callbacks as tasks.
+    Callbacks registered with max_concurrency make the dispatcher wait for a free slot
+    before starting the next run, so a slow callback fills the buffer and the overflow
+    policy applies, instead of an unbounded number of tasks.
+    Callbacks registered with ordered_by are passed to their OrderedWorkers pool.
+    """
+
+    def __init__(self, client: Any, router: EventRouter, maxsize: int = 0, overflow: str = 'block',
+                 coalesce_key: Optional[CoalesceKey] = None):
+        """
+        Initializes the dispatcher
+
+        :param client: The client passed to the callbacks
+        :param router: The routing table of the callbacks
+        :param maxsize: The maximum number of queued events (0 is unbounded)
+        :param overflow: The overflow policy (see EventBuffer)
+        :param coalesce_key: The header name or function giving the key of an event for the 'coalesce' policy
+        """
+        self.logger = logging.getLogger('AMI Dispatcher')
+        self._client = client
+        self._router = router
+        self._buffer_options = (maxsize, overflow, coalesce_key)
+        self.buffer = EventBuffer(maxsize, overflow, coalesce_key)
+        self._tasks = set()
+        self._ordered: Dict[Handler, OrderedWorkers] = {}
+        self.dispatched = 0
+        self.errors = 0
+        self.metrics = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks) + sum(workers.busy for workers in self._ordered.values())
+
+    def reset(self) -> None:
+        """
+        Replaces the buffer with an empty one before the client starts again
+
+        :return: None
+        """
+        self.buffer.close()
+        self.buffer = EventBuffer(*self._buffer_options)
+
+    async def put(self, event: dict) -> bool:
+        if self.metrics is not None:
+            self.metrics.count_event(event)
+        return await self.buffer.put(event)
+
+    async def put_many(self, events: List[dict]) -> None:
+        """
+        Puts a block of events in the buffer, waiting only if the 'block' policy finds it full
+
+        :param events: The events
+        :return: None
+        """
+        if self.metrics is not None:
+            for event in events:
+                self.metrics.count_event(event)
+        buffer = self.buffer
+        for event in events:
+            if buffer.overflow == 'block' and buffer.full():
+                await buffer.put(event)
+            else:
+                buffer.put_nowait(event)
+
+    def stop(self) -> None:
+        self.buffer.close()
+        for workers in self._ordered.values():
+            workers.stop()
+        self._ordered.clear()
+
+    def forget(self, event_name: str, callback: Callable) -> None:
+        """
+        Stops the workers of the ordered handlers of an unregistered callback
+
+        :param event_name: The name of the event
+        :param callback: The callback function
+        :return: None
+        """
+        for handler in [handler for handler in self._ordered
+                        if handler.event_name == event_name and handler.callback == callback]:
+            self._ordered.pop(handler).stop()
+
+    async def run(self) -> None:
+        """
+        Dispatches events until the buffer is closed.
+
+        :return: None
+        """
+        while True:
+            event = await self.buffer.get()
+            if event is None:
+                break
+            handlers = self._router.match(event)
+            if len(handlers) != 0:
+                await self.dispatch(event, handlers)
+
+    async def dispatch(self, event: dict, handlers: List[Handler]) -> None:
+        """
+        Starts the handlers for the event, waiting for a free slot of handlers with a concurrency limit.
+
+        :param event: The event
+        :param handlers: The handlers matching the event
+        :return: None
+        """
+        loop = asyncio.get_event_loop()
+        for handler in handlers:
+            if handler.inline:
+                self.call_inline(handler, event)
+                continue
+            if handler.ordered_by is not None:
+                try:
+                    key = handler.order_key(event)
+                    # The key selects the worker by its hash
+                    hash(key)
+                except Exception:
+                    self.errors += 1
+                    self.logger.exception("Order key of callback %s failed on event '%s'",
+                                          handler.callback, event.get('Event'))
+                    continue
+                workers = self._ordered.get(handler)
+                if workers is None:
+                    workers = self._ordered[handler] = OrderedWorkers(self, handler)
+                await workers.submit(event, key)
+                continue
+            semaphore = handler.semaphore
+            if semaphore is not None:
+                await semaphore.acquire()
+            task = loop.create_task(self._run(handler, event))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self.dispatched += 1
+        self.logger.info("Execute callbacks for event '%s'", event.get('Event'))
+
+    async def call(self, handler: Handler, event: dict) -> None:
+        """
+        Runs the callback of the handler, logging and counting its exceptions.
+
+        :param handler: The handler
+        :param event: The event
+        :return: None
+        """
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0
+        failed = False
+        try:
+            await handler.run(event, self._client)
+        except Exception:
+            failed = True
+            self.errors += 1
+            self.logger.exception("Callback %s failed on event '%s'", handler.callback, event.get('Event'))
+        finally:
+            if metrics is not None:
+                metrics.observe_callback(handler.event_name, handler.callback, time.perf_counter() - started, failed)
+
+    def call_inline(self, handler: Handler, event: dict) -> None:
+        """
+        Runs the synchronous callback of an inline handler, logging and counting its exceptions.
+
+        :param handler: The handler
+        :param event: The event
+        :return: None
+        """
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0
+        failed = False
+        try:
+            handler.callback(event, self._client)
+        except Exception:
+            failed = True
+            self.errors += 1
+            self.logger.exception("Callback %s failed on event '%s'", handler.callback, event.get('Event'))
+        finally:
+            if metrics is not None:
+                metrics.observe_callback(handler.event_name, handler.callback, time.perf_counter() - started, failed)
+
+    async def _run(self, handler: Handler, event: dict) -> None:
+        try:
+            await self.call(handler, event)
+        finally:
+            if handler.semaphore is not None:
+                handler.semaphore.release()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: The counters of the dispatcher
+        """
+        return {
+            'queued': self.buffer.qsize() + sum(workers.qsize() for workers in self._ordered.values()),
+            'in_flight': self.in_flight,
+            'dispatched': self.dispatched,
+            'dropped': self.buffer.dropped,
+            'coalesced': self.buffer.coalesced,
+            'errors': self.errors + self._router.errors,
+        }
@@ -0,0 +1,185 @@
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import logging
+from typing import Any, Callable, Dict, List, Optional, Union
+
+EXECUTORS = ('thread', 'process')
+
+ExecutorOption = Union[str, concurrent.futures.Executor]
+
+
+def is_async_callback(callback: Callable) -> bool:
+    """
+    :param callback: The callback
+    :return: True if calling the callback returns a coroutine (a coroutine function, a partial of one
+        or an object with one as __call__)
+    """
+    while isinstance(callback, functools.partial):
+        callback = callback.func
+    return asyncio.iscoroutinefunction(callback) or asyncio.iscoroutinefunction(getattr(callback, '__call__', None))
+
+
+def callback_runner(callback: Callable, pools: 'ExecutorPools', executor: Optional[ExecutorOption] = None,
+                    batch_size: int = 1, batch_wait: float = 0.05, max_concurrency: Optional[int] = None,
+                    ordered_by: Any = None) -> Optional['ExecutorCallback']:
+    """
+    Checks the executor options of a callback and creates the runner of a plain function
+
+    :param callback: The callback
+    :param pools: The shared executors of the client
+    :param executor: 'thread', 'process' or an executor (the thread pool if None)
+    :param batch_size: The maximum number of events per call of a plain function
+    :param batch_wait: Seconds to wait for a batch to fill after its first event
+    :param max_concurrency: The maximum number of simultaneous runs of the callback
+    :param ordered_by: The key of ordered processing of the callback
+    :return: The runner or None if the callback is a coroutine function running on the event loop
+    :raises ValueError: If an executor or batching is set for a coroutine function, a batched callback
+        is ordered or the executor is unknown
+    """
+    if is_async_callback(callback):
+        if executor is not None or batch_size != 1:
+            raise ValueError('The executor and batching options are for plain functions, not coroutines')
+        return None
+    if batch_size != 1 and ordered_by is not None:
+        raise ValueError('Batched callbacks can not be ordered')
+    return ExecutorCallback(callback, pools, executor or 'thread', batch_size, batch_wait, max_concurrency)
+
+
+def _plain(event: Any) -> Any:
+    # Events are sent to other processes as plain dictionaries
+    if isinstance(event, list):
+        return [_plain(item) for item in event]
+    return event.to_dict() if hasattr(event, 'to_dict') else dict(event)
+
+
+class ExecutorPools:
+    """
+    The executors shared by the synchronous callbacks of a client: one thread pool and one process pool,
+    created on first use.
+    """
+
+    def __init__(self, threads: Optional[int] = None, processes: Optional[int] = None):
+        """
+        :param threads: The number of threads (the concurrent.futures default if None)
+        :param processes: The number of processes (the number of CPUs if None)
+        """
+        self.threads = threads
+        self.processes = processes
+        self._pools: Dict[str, concurrent.futures.Executor] = {}
+
+    def get(self, executor: ExecutorOption) -> concurrent.futures.Executor:
+        """
+        :param executor: 'thread', 'process' or an executor
+        :return: The executor
+        :raises ValueError: If the executor kind is unknown
+        """
+        if isinstance(executor, concurrent.futures.Executor):
+            return executor
+        if executor not in EXECUTORS:
+            raise ValueError(f'Unknown executor "{executor}", use one of {", ".join(EXECUTORS)} or an Executor')
+        pool = self._pools.get(executor)
+        if pool is None:
+            if executor == 'thread':
+                pool = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix='ami-callback')
+            else:
+                pool = concurrent.futures.ProcessPoolExecutor(self.processes)
+            self._pools[executor] = pool
+        return pool
+
+    async def shutdown(self) -> None:
+        """
+        Waits for the running jobs and stops the pools without blocking the event loop
+
+        :return: None
+        """
+        pools, self._pools = list(self._pools.values()), {}
+        loop = asyncio.get_event_loop()
+        for pool in pools:
+            await loop.run_in_executor(None, pool.shutdown)
+
+
+class ExecutorCallback:
+    """
+    Runs a synchronous callback in an executor, so user code never blocks the event loop.
+
+    In a thread pool the callback is called as callback(event, client), in a process pool as callback(event)
+    with the event as a dictionary (the callback must be a module-level function). With batch_size > 1
+    the events are collected and the callback gets a list of events per job: the batch is sent when
+    it is full or batch_wait seconds after its first event. At most max_jobs jobs run at the same time.
+    If the callback returns an awaitable (e.g. a lambda calling a coroutine function), it is awaited
+    on the event loop.
+    """
+
+    def __init__(self, callback: Callable, pools: ExecutorPools, executor: ExecutorOption = 'thread',
+                 batch_size: int = 1, batch_wait: float = 0.05, max_jobs: Optional[int] = None):
+        """
+        Initializes the runner
+
+        :param callback: The synchronous callback
+        :param pools: The shared executors of the client
+        :param executor: 'thread', 'process' or an executor
+        :param batch_size: The maximum number of events per job
+        :param batch_wait: Seconds to wait for a batch to fill after its first event
+        :param max_jobs: The maximum number of simultaneous jobs (unlimited if None)
+        :raises ValueError: If the executor kind is unknown or batch_size is not positive
+        """
+        if batch_size < 1:
+            raise ValueError('batch_size must be positive')
+        self.logger = logging.getLogger('AMI Dispatcher')
+        self.callback = callback
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        # The pool is looked up for every job, the shared pools are created again after the client is closed
+        self._pools = pools
+        self._executor = executor
+        self._in_process = isinstance(pools.get(executor), concurrent.futures.ProcessPoolExecutor)
+        self._max_jobs = max_jobs
+        self._jobs: Optional[asyncio.Semaphore] = None
+        self._batch: List[dict] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def _submit(self, events: Any, client: Any) -> Any:
+        if self._jobs is None and self._max_jobs:
+            self._jobs = asyncio.Semaphore(self._max_jobs)
+        if self._in_process:
+            job = functools.partial(self.callback, _plain(events))
+        else:
+            job = functools.partial(self.callback, events, client)
+        loop = asyncio.get_event_loop()
+        if self._jobs is None:
+            result = await loop.run_in_executor(self._pools.get(self._executor), job)
+        else:
+            async with self._jobs:
+                result = await loop.run_in_executor(self._pools.get(self._executor), job)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def __call__(self, event: dict, client: Any) -> None:
+        if self.batch_size == 1:
+            await self._submit(event, client)
+            return
+        self._batch.append(event)
+        if len(self._batch) >= self.batch_size:
+            await self._submit(self._take(), client)
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.batch_wait, self._flush, client)
+
+    def _take(self) -> List[dict]:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._batch = self._batch, []
+        return batch
+
+    def _flush(self, client: Any) -> None:
+        self._timer = None
+        if self._batch:
+            task = asyncio.get_event_loop().create_task(self._submit(self._take(), client))
+            task.add_done_callback(self._log_failure)
+
+    def _log_failure(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error("Callback %s failed on a batch of events", self.callback, exc_info=task.exception())
@@ -0,0 +1,115 @@
+import sys
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Raw header name -> interned name, header names repeat in every message
+_KEYS: Dict[bytes, str] = {}
+_KEYS_LIMIT = 4096
+
+
+class AMIMessage(Mapping):
+    """
+    Immutable message received from the server.
+
+    The frame is split into headers on first access, header names are interned and shared by all
+    messages, values are decoded only when they are read. Repeated headers (e.g. ChanVariable) are
+    all kept: getall returns every value, the dictionary interface returns the last one like a dict
+    filled header by header would.
+    """
+    __slots__ = ('_frame', '_encoding', '_keys', '_values', '_last')
+
+    def __init__(self, frame: bytes, encoding: str = 'windows-1251'):
+        """
+        Initializes the message
+
+        :param frame: The frame of "Key: Value" lines without the terminating empty line
+        :param encoding: The encoding of the frame
+        """
+        self._frame = frame
+        self._encoding = encoding
+        self._keys: Optional[Tuple[str, ...]] = None
+        self._values: Optional[List[Any]] = None
+        self._last: Optional[Dict[str, int]] = None
+
+    def _parse(self) -> Tuple[str, ...]:
+        keys = []
+        values = []
+        for line in self._frame.split(b'\r\n'):
+            key, sep, value = line.partition(b':')
+            if not sep:
+                continue
+            name = _KEYS.get(key)
+            if name is None:
+                name = sys.intern(key.strip().decode(self._encoding, 'replace'))
+                if len(_KEYS) < _KEYS_LIMIT:
+                    _KEYS[key] = name
+            keys.append(name)
+            values.append(value)
+        self._keys = tuple(keys)
+        self._values = values
+        if len(set(keys)) != len(keys):
+            self._last = {key: index for index, key in enumerate(keys)}
+        self._frame = None
+        return self._keys
+
+    def _value(self, index: int) -> str:
+        value = self._values[index]
+        if type(value) is bytes:
+            value = self._values[index] = value.strip().decode(self._encoding, 'replace')
+        return value
+
+    def _find(self, key: str) -> int:
+        keys = self._keys if self._keys is not None else self._parse()
+        if self._last is not None:
+            return self._last.get(key, -1)
+        try:
+            return keys.index(key)
+        except ValueError:
+            return -1
+
+    def __getitem__(self, key: str) -> str:
+        index = self._find(key)
+        if index < 0:
+            raise KeyError(key)
+        return self._value(index)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        index = self._find(key)
+        return default if index < 0 else self._value(index)
+
+    def __contains__(self, key: object) -> bool:
+        return self._find(key) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        keys = self._keys if self._keys is not None else self._parse()
+        return iter(keys if self._last is None else self._last)
+
+    def __len__(self) -> int:
+        keys = self._keys if self._keys is not None else self._parse()
+        return len(keys if self._last is None else self._last)
+
+    def getall(self, key: str) -> List[str]:
+        """
+        :param key: The header name
+        :return: All values of the header in the order they were received
+        """
+        keys = self._keys if self._keys is not None else self._parse()
+        return [self._value(index) for index, name in enumerate(keys) if name == key]
+
+    def headers(self) -> List[Tuple[str, str]]:
+        """
+        :return: All headers in the order they were received, repeated headers included
+        """
+        keys = self._keys if self._keys is not None else self._parse()
+        return [(key, self._value(index)) for index, key in enumerate(keys)]
+
+    def to_dict(self) -> dict:
+        """
+        :return: A mutable copy of the message (the last value of repeated headers)
+        """
+        return dict(self.items())
+
+    copy = to_dict
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
@@ -0,0 +1,270 @@
+import bisect
+import functools
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """ Cumulative-bucket histogram of durations in seconds, in the Prometheus sense """
+    __slots__ = ('bounds', 'counts', 'sum', 'count', 'errors')
+
+    def __init__(self, bounds: Sequence[float] = DEFAULT_BUCKETS):
+        self.bounds = tuple(bounds)
+        # The last bucket is +Inf
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, value: float, failed: bool = False) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+        if failed:
+            self.errors += 1
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """
+        :return: The upper bound and the number of observations less or equal to it for every bucket
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        :param q: The quantile, e.g. 0.99
+        :return: The upper bound of the bucket holding the quantile or None if there are no observations
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'sum': self.sum,
+            'avg': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+def _label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def callback_name(callback: Any) -> str:
+    """
+    The label of a callback in the metrics: the qualified name of its function, so bound methods and closures
+    of the same function share one series and no reference to the callback is kept
+
+    :param callback: The callback, wrappers (functools.wraps, __wrapped__) and partials are unwrapped
+    :return: The name, e.g. "app.handlers.Calls.on_hangup"
+    """
+    while True:
+        wrapped = getattr(callback, '__wrapped__', None)
+        if wrapped is not None:
+            callback = wrapped
+        elif isinstance(callback, functools.partial):
+            callback = callback.func
+        else:
+            break
+    if not hasattr(callback, '__qualname__'):
+        # A callable object
+        callback = type(callback)
+    module = getattr(callback, '__module__', None)
+    return f"{module}.{callback.__qualname__}" if module else callback.__qualname__
+
+
+class Metrics:
+    """
+    Instrumentation of a client: latency of requests by action, received events by type,
+    run time and exceptions of callbacks, depths of the queues and reconnects.
+
+    The client only calls into it when metrics are enabled (see AMIClientBase.enable_metrics),
+    the queue depths are read from the client when a snapshot is taken.
+    """
+
+    # Key of queues() -> metric name and type
+    QUEUE_METRICS = {
+        'queued': ('dispatch_queued', 'gauge'),
+        'in_flight': ('dispatch_in_flight', 'gauge'),
+        'dispatched': ('events_dispatched_total', 'counter'),
+        'dropped': ('events_dropped_total', 'counter'),
+        'coalesced': ('events_coalesced_total', 'counter'),
+        'errors': ('dispatch_errors_total', 'counter'),
+        'pending_requests': ('pending_requests', 'gauge'),
+        'outgoing': ('outgoing_requests', 'gauge'),
+    }
+
+    def __init__(self, client: Any, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """
+        Initializes the metrics
+
+        :param client: The instrumented client
+        :param buckets: The upper bounds of the latency buckets in seconds
+        """
+        self._client = client
+        self.buckets = tuple(sorted(buckets))
+        self.requests: Dict[str, Histogram] = {}
+        # (event name, callback name) -> run time of the callbacks
+        self.callbacks: Dict[Tuple[str, str], Histogram] = {}
+        self.events: Dict[str, int] = {}
+        self.started = time.monotonic()
+        self._last_events: Dict[str, int] = {}
+        self._last_snapshot = self.started
+
+    def observe_request(self, action: Any, duration: float, failed: bool = False) -> None:
+        """
+        Records a finished request
+
+        :param action: The name of the action
+        :param duration: Seconds from the request to the response
+        :param failed: The request raised an exception (timeout, lost connection)
+        :return: None
+        """
+        action = str(action).lower()
+        histogram = self.requests.get(action)
+        if histogram is None:
+            histogram = self.requests[action] = Histogram(self.buckets)
+        histogram.observe(duration, failed)
+
+    def count_event(self, event: dict) -> None:
+        name = event.get('Event')
+        self.events[name] = self.events.get(name, 0) + 1
+
+    def observe_callback(self, event_name: str, callback: Any, duration: float, failed: bool = False) -> None:
+        """
+        Records a run of a callback, the callbacks with the same name share their series (see callback_name)
+
+        :param event_name: The event name the callback is registered for
+        :param callback: The callback function
+        :param duration: Seconds the callback ran
+        :param failed: The callback raised an exception
+        :return: None
+        """
+        key = (event_name, callback_name(callback))
+        histogram = self.callbacks.get(key)
+        if histogram is None:
+            histogram = self.callbacks[key] = Histogram(self.buckets)
+        histogram.observe(duration, failed)
+
+    def drop_callback(self, event_name: str, callback: Any, registered: Iterable[Any] = ()) -> None:
+        """
+        Drops the series of an unregistered callback unless another registered callback shares it
+
+        :param event_name: The event name the callback was registered for
+        :param callback: The callback function
+        :param registered: The callbacks still registered for the event
+        :return: None
+        """
+        name = callback_name(callback)
+        if all(callback_name(other) != name for other in registered):
+            self.callbacks.pop((event_name, name), None)
+
+    def queues(self) -> Dict[str, int]:
+        """
+        :return: The current depths of the queues of the client and the counters of the dispatcher
+        """
+        client = self._client
+        queues = dict(client.dispatch_stats())
+        pending = getattr(client, '_pending', None)
+        if pending is not None:
+            queues['pending_requests'] = len(pending)
+        outgoing = getattr(client, '_outgoing', None)
+        if outgoing is not None:
+            queues['outgoing'] = len(outgoing)
+        return queues
+
+    def snapshot(self) -> dict:
+        """
+        Collects the current values. Events per second are measured since the previous snapshot.
+
+        :return: The dictionary of the metrics
+        """
+        now = time.monotonic()
+        elapsed = max(now - self._last_snapshot, 1e-9)
+        rates = {name: (count - self._last_events.get(name, 0)) / elapsed for name, count in self.events.items()}
+        self._last_events = dict(self.events)
+        self._last_snapshot = now
+        return {
+            'uptime': now - self.started,
+            'requests': {action: histogram.to_dict() for action, histogram in self.requests.items()},
+            'events': dict(self.events),
+            'events_per_second': rates,
+            'callbacks': {f"{event_name}:{name}": histogram.to_dict()
+                          for (event_name, name), histogram in self.callbacks.items()},
+            'queues': self.queues(),
+            'reconnects': getattr(self._client, 'reconnects', 0),
+            'state': self._client.state,
+        }
+
+    @staticmethod
+    def _histogram_lines(name: str, labels: str, histogram: Histogram) -> List[str]:
+        lines = []
+        for bound, total in histogram.cumulative():
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {total}')
+        lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+        lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+        return lines
+
+    def prometheus(self, prefix: str = 'ami') -> str:
+        """
+        Formats the metrics in the Prometheus text exposition format
+
+        :param prefix: The prefix of the metric names
+        :return: The text of the metrics
+        """
+        lines = [
+            f'# HELP {prefix}_request_duration_seconds Time from an AMI request to its response',
+            f'# TYPE {prefix}_request_duration_seconds histogram',
+        ]
+        for action, histogram in self.requests.items():
+            lines += self._histogram_lines(f'{prefix}_request_duration_seconds', f'action="{_label(action)}"',
+                                           histogram)
+        lines += [
+            f'# HELP {prefix}_request_failures_total AMI requests failed with an exception',
+            f'# TYPE {prefix}_request_failures_total counter',
+        ]
+        lines += [f'{prefix}_request_failures_total{{action="{_label(action)}"}} {histogram.errors}'
+                  for action, histogram in self.requests.items()]
+        lines += [
+            f'# HELP {prefix}_events_total Events received by type',
+            f'# TYPE {prefix}_events_total counter',
+        ]
+        lines += [f'{prefix}_events_total{{event="{_label(name)}"}} {count}' for name, count in self.events.items()]
+        lines += [
+            f'# HELP {prefix}_callback_duration_seconds Run time of event callbacks',
+            f'# TYPE {prefix}_callback_duration_seconds histogram',
+        ]
+        for (event_name, name), histogram in self.callbacks.items():
+            labels = f'event="{_label(event_name)}",callback="{_label(name)}"'
+            lines += self._histogram_lines(f'{prefix}_callback_duration_seconds', labels, histogram)
+        lines += [
+            f'# HELP {prefix}_callback_errors_total Exceptions raised by event callbacks',
+            f'# TYPE {prefix}_callback_errors_total counter',
+        ]
+        for (event_name, name), histogram in self.callbacks.items():
+            labels = f'event="{_label(event_name)}",callback="{_label(name)}"'
+            lines.append(f'{prefix}_callback_errors_total{{{labels}}} {histogram.errors}')
+        for name, value in self.queues().items():
+            metric, metric_type = self.QUEUE_METRICS.get(name, (name, 'gauge'))
+            lines += [f'# TYPE {prefix}_{metric} {metric_type}', f'{prefix}_{metric} {value}']
+        lines += [
+            f'# TYPE {prefix}_reconnects_total counter',
+            f'{prefix}_reconnects_total {getattr(self._client, "reconnects", 0)}',
+        ]
+        return '\n'.join(lines) + '\n'
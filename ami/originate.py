@@ -0,0 +1,170 @@
+import asyncio
+import itertools
+import logging
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+
+
+class TokenBucket:
+    """ Token-bucket rate limiter """
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        """
+        Initializes the bucket
+
+        :param rate: The number of tokens added per second
+        :param burst: The capacity of the bucket (rate by default, at least 1)
+        :raises ValueError: If the rate is not positive
+        """
+        if rate <= 0:
+            raise ValueError('The rate must be positive')
+        self.rate = rate
+        self.capacity = max(burst if burst is not None else rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        """
+        Takes a token, waiting until one is available
+
+        :return: None
+        """
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class OriginateResult:
+    """ The outcome of one call of a batch """
+    __slots__ = ('spec', 'action_id', 'response', 'event', 'error')
+
+    def __init__(self, spec: dict, action_id: str):
+        self.spec = spec
+        self.action_id = action_id
+        self.response: Optional[List[dict]] = None
+        self.event: Optional[dict] = None
+        self.error: Optional[BaseException] = None
+
+    @property
+    def success(self) -> bool:
+        """
+        :return: True if the call was answered (OriginateResponse with Response: Success)
+        """
+        return self.event is not None and self.event.get('Response') == 'Success'
+
+    @property
+    def reason(self) -> Optional[str]:
+        """
+        :return: The Reason header of the OriginateResponse (e.g. 4 answered, 5 busy, 3 no answer)
+        """
+        return None if self.event is None else self.event.get('Reason')
+
+    def __repr__(self) -> str:
+        outcome = self.error or (self.event or {}).get('Response') or (self.response or [{}])[0].get('Response')
+        return f"<OriginateResult {self.action_id} {outcome}>"
+
+
+class BulkOriginator:
+    """
+    Originates calls in batches: calls are started at a limited rate, with a limited number of calls
+    in progress, and each call is correlated with its OriginateResponse event by ActionID.
+    """
+
+    def __init__(self, client: Any, rate: float = 10, max_concurrent: int = 100,
+                 burst: Optional[int] = None, result_timeout: Optional[float] = None):
+        """
+        Initializes the originator
+
+        :param client: The client to send the requests with
+        :param rate: The number of calls started per second
+        :param max_concurrent: The maximum number of calls waiting for their OriginateResponse
+        :param burst: The number of calls that can be started at once (rate by default)
+        :param result_timeout: Seconds to wait for the OriginateResponse (the call timeout plus 30 by default)
+        """
+        self.logger = logging.getLogger('AMI Originate')
+        self._client = client
+        self._bucket = TokenBucket(rate, burst)
+        self._max_concurrent = max_concurrent
+        self._result_timeout = result_timeout
+        self._prefix = f"originate-{uuid.uuid4().hex[:8]}"
+        self._ids = itertools.count(1)
+        self._waiting: Dict[str, asyncio.Future] = {}
+
+    async def _on_response(self, event: dict, _client: Any) -> None:
+        future = self._waiting.get(event.get('ActionID'))
+        if future is not None and not future.done():
+            future.set_result(event)
+
+    async def _call(self, spec: dict, semaphore: asyncio.Semaphore, results: asyncio.Queue) -> None:
+        action_id = f"{self._prefix}-{next(self._ids)}"
+        result = OriginateResult(spec, action_id)
+        future = asyncio.get_event_loop().create_future()
+        self._waiting[action_id] = future
+        try:
+            query = self._client.originate_query(**dict(spec, run_async=True))
+            query["ActionID"] = action_id
+            result.response = await self._client.ami_request(query)
+            if result.response and result.response[0].get('Response') == 'Success':
+                timeout = self._result_timeout
+                if timeout is None:
+                    timeout = spec.get('timeout', 15) + 30
+                result.event = await asyncio.wait_for(future, timeout)
+        except Exception as e:
+            result.error = e
+        finally:
+            del self._waiting[action_id]
+            semaphore.release()
+            await results.put(result)
+
+    async def run(self, specs: Iterable[dict]) -> AsyncIterator[OriginateResult]:
+        """
+        Originates the calls and yields the results as the calls finish
+
+        :param specs: The calls, each is a dictionary of the originate parameters
+        :return: The async iterator over the results
+        """
+        results: asyncio.Queue = asyncio.Queue()
+        semaphore = asyncio.Semaphore(self._max_concurrent)
+        tasks = set()
+        loop = asyncio.get_event_loop()
+        started = 0
+
+        async def start_calls() -> None:
+            nonlocal started
+            try:
+                for spec in specs:
+                    await semaphore.acquire()
+                    await self._bucket.acquire()
+                    task = loop.create_task(self._call(spec, semaphore, results))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    started += 1
+            finally:
+                # Marks that no more calls will be started
+                results.put_nowait(None)
+
+        await self._client.register_callback('OriginateResponse', self._on_response)
+        producer = loop.create_task(start_calls())
+        received = 0
+        all_started = False
+        try:
+            while not all_started or received < started:
+                result = await results.get()
+                if result is None:
+                    all_started = True
+                    continue
+                received += 1
+                yield result
+            # Raises the error of the specs iterator, if any
+            producer.result()
+        finally:
+            producer.cancel()
+            for task in list(tasks):
+                task.cancel()
+            await self._client.unregister_callback('OriginateResponse', self._on_response)
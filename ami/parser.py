@@ -0,0 +1,142 @@
+from typing import List
+from xml.etree import ElementTree
+
+from ami.message import AMIMessage
+
+
+class FrameParser:
+    """
+    Incremental parser of the AMI wire format.
+
+    Data is fed in chunks of any size, complete messages (frames terminated by an empty line)
+    are cut out in one pass as AMIMessage objects, incomplete tail is kept until the next chunk arrives.
+    """
+    __slots__ = ('encoding', '_buffer', '_scan_from')
+
+    TERMINATOR = b'\r\n\r\n'
+
+    def __init__(self, encoding: str = 'windows-1251'):
+        """
+        Initializes the parser
+
+        :param encoding: The encoding of the data sent by the server
+        """
+        self.encoding = encoding
+        self._buffer = bytearray()
+        self._scan_from = 0
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def feed(self, data: bytes) -> List[AMIMessage]:
+        """
+        Adds a chunk of data to the buffer and parses all complete messages from it.
+
+        :param data: The chunk of data read from the socket
+        :return: The list of parsed messages
+        """
+        buffer = self._buffer
+        buffer += data
+        messages = []
+        start = 0
+        end = buffer.find(self.TERMINATOR, self._scan_from)
+        if end != -1:
+            with memoryview(buffer) as view:
+                while end != -1:
+                    if end > start:
+                        messages.append(AMIMessage(bytes(view[start:end]), self.encoding))
+                    start = end + 4
+                    end = buffer.find(self.TERMINATOR, start)
+            del buffer[:start]
+        # The terminator may be split between chunks, so the last 3 bytes are scanned again
+        self._scan_from = max(len(buffer) - 3, 0)
+        return messages
+
+    def pending(self) -> bytes:
+        """
+        :return: The buffered data of the incomplete message
+        """
+        return bytes(self._buffer)
+
+    def flush(self) -> List[AMIMessage]:
+        """
+        Parses the data left in the buffer as the last message, e.g. when the stream ended
+        without the terminating empty line.
+
+        :return: The list with the last message or an empty list if nothing was buffered
+        """
+        frame = bytes(self._buffer).strip()
+        self.clear()
+        if not frame:
+            return []
+        return [AMIMessage(frame, self.encoding)]
+
+    def clear(self) -> None:
+        """
+        Drops the buffered incomplete data, e.g. after the connection was lost.
+
+        :return: None
+        """
+        self._buffer.clear()
+        self._scan_from = 0
+
+    @staticmethod
+    def parse_frame(frame: str) -> dict:
+        """
+        Converts a decoded frame of "Key: Value" lines into a dictionary.
+        Lines without a key (e.g. the "Asterisk Call Manager" greeting) are skipped.
+
+        :param frame: The decoded frame without the terminating empty line
+        :return: The dictionary with the converted key-value pairs
+        """
+        result = {}
+        for line in frame.split('\r\n'):
+            key, sep, value = line.partition(':')
+            if sep:
+                result[key.strip()] = value.strip()
+        return result
+
+
+class MXMLParser:
+    """
+    Incremental parser of the /mxml endpoint responses.
+
+    Every <generic/> element of the XML document is a message, its attributes are the message keys
+    (Asterisk sends them in lower case).
+    """
+    __slots__ = ('_parser',)
+
+    def __init__(self):
+        self._parser = ElementTree.XMLPullParser(events=('end',))
+
+    def feed(self, data: bytes) -> List[AMIMessage]:
+        """
+        Adds a chunk of the document and returns all messages completed by it.
+
+        :param data: The chunk of data read from the response
+        :return: The list of parsed messages
+        """
+        self._parser.feed(data)
+        return self._read_messages()
+
+    def flush(self) -> List[dict]:
+        """
+        Finishes the document and returns the messages left in it.
+
+        :return: The list of parsed messages
+        """
+        try:
+            self._parser.close()
+        except ElementTree.ParseError:
+            pass
+        return self._read_messages()
+
+    def _read_messages(self) -> List[dict]:
+        messages = []
+        for _, element in self._parser.read_events():
+            if element.tag == 'generic':
+                messages.append(dict(element.attrib))
+                element.clear()
+            elif element.tag == 'response':
+                element.clear()
+        return messages
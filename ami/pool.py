@@ -0,0 +1,379 @@
+import asyncio
+import functools
+import logging
+import zlib
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Sequence, Tuple, Union
+
+from ami.base import AMIClientBase
+from ami.executors import ExecutorOption, is_async_callback
+from ami.routing import FilterValue, OrderKey
+
+
+def _call_tagged(callback: Callable, server: str, events: Any, *args) -> Any:
+    # Calls a plain callback with the Server header added to the event or to every event of a batch
+    if isinstance(events, list):
+        return callback([dict(event, Server=server) for event in events], *args)
+    return callback(dict(events, Server=server), *args)
+
+
+class PoolMember:
+    """ A connection of the pool with its routing state """
+    __slots__ = ('server', 'client', 'outstanding', 'healthy')
+
+    def __init__(self, server: str, client: AMIClientBase):
+        self.server = server
+        self.client = client
+        self.outstanding = 0
+        self.healthy = True
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.client.state == 'connected'
+
+    def __repr__(self) -> str:
+        return f"<PoolMember {self.server} {self.client.host}:{self.client.port} outstanding={self.outstanding}>"
+
+
+class _Subscription:
+    """ A callback of the pool registered on the event connection of a server """
+    __slots__ = ('server', 'client', 'tagged', 'options')
+
+    def __init__(self, server: str, client: AMIClientBase, tagged: Callable, options: tuple):
+        self.server = server
+        self.client = client
+        self.tagged = tagged
+        self.options = options
+
+
+class ClientPool:
+    """
+    Pool of connections to several servers.
+
+    Requests are routed to a server by a shard key (e.g. tenant or extension) or to the connection
+    with the least outstanding requests, broadcast requests are sent to every server concurrently
+    and events of all servers are passed to the callbacks tagged with the name of their server.
+    Connections that fail the periodic ping are taken out of routing until they answer again,
+    lost connections are connected again, and the callbacks move to another connection of the server
+    when the one receiving the events fails.
+    """
+
+    def __init__(self, servers: Dict[str, Union[AMIClientBase, Sequence[AMIClientBase]]],
+                 shard: Optional[Callable[[Any], str]] = None, health_interval: Optional[float] = 30,
+                 health_timeout: float = 5):
+        """
+        Initializes the pool
+
+        :param servers: The clients of every server by server name, one or several connections per server
+        :param shard: The function giving the server name for a shard key (a stable hash of the key by default)
+        :param health_interval: Seconds between health checks (None disables them)
+        :param health_timeout: Seconds to wait for the ping of a health check
+        :raises ValueError: If no clients are given
+        """
+        self.logger = logging.getLogger('AMI Pool')
+        self._members: List[PoolMember] = []
+        self._servers: Dict[str, List[PoolMember]] = {}
+        for server, clients in servers.items():
+            if isinstance(clients, AMIClientBase):
+                clients = [clients]
+            for client in clients:
+                member = PoolMember(server, client)
+                self._members.append(member)
+                self._servers.setdefault(server, []).append(member)
+        if not self._members:
+            raise ValueError('The pool requires at least one client')
+        self._server_names = sorted(self._servers)
+        self._shard = shard
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._health_task: Optional[asyncio.Task] = None
+        self._credentials: Optional[Tuple[str, str]] = None
+        # The connection receiving the events of every server
+        self._event_members: Dict[str, PoolMember] = {}
+        # (event name, callback) -> the wrappers registered on the event connection of every server
+        self._callbacks: Dict[Tuple[str, Callable], List[_Subscription]] = {}
+
+    @property
+    def servers(self) -> List[str]:
+        return list(self._server_names)
+
+    @property
+    def members(self) -> List[PoolMember]:
+        return list(self._members)
+
+    async def connect(self, username: str, password: str) -> Dict[str, Union[List[dict], BaseException]]:
+        """
+        Connects all clients and starts the health checks
+
+        :param username: The username to use for authentication
+        :param password: The password to use for authentication
+        :return: The login response or the error of every connection, by "server/index"
+        """
+        self._credentials = (username, password)
+        results = await asyncio.gather(*(member.client.connect(username, password) for member in self._members),
+                                       return_exceptions=True)
+        response = {}
+        for member, result in zip(self._members, results):
+            index = self._servers[member.server].index(member)
+            response[f"{member.server}/{index}"] = result
+            if isinstance(result, BaseException):
+                member.healthy = False
+                self.logger.warning(f"Connection to {member.server} failed: {result!r}")
+        if self.health_interval is not None and self._health_task is None:
+            self._health_task = asyncio.get_event_loop().create_task(self._health_loop())
+        return response
+
+    async def close(self) -> None:
+        """
+        Stops the health checks and closes all clients
+
+        :return: None
+        """
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        await asyncio.gather(*(member.client.close() for member in self._members), return_exceptions=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+    def server_for(self, shard_key: Any) -> str:
+        """
+        :param shard_key: The shard key, e.g. a tenant or an extension
+        :return: The name of the server the key is routed to
+        :raises ValueError: If the shard function returned an unknown server
+        """
+        if self._shard is not None:
+            server = self._shard(shard_key)
+            if server not in self._servers:
+                raise ValueError(f'Unknown server "{server}" for shard key {shard_key!r}')
+            return server
+        digest = zlib.crc32(str(shard_key).encode())
+        return self._server_names[digest % len(self._server_names)]
+
+    def pick(self, shard_key: Any = None, server: Optional[str] = None) -> PoolMember:
+        """
+        Chooses the connection for a request: the server is given by name or by the shard key,
+        otherwise any server, and within it the available connection with the least outstanding requests.
+
+        :param shard_key: The shard key of the request
+        :param server: The name of the server
+        :return: The connection
+        :raises ValueError: If the server is unknown
+        :raises ConnectionError: If no connection is available
+        """
+        if server is None and shard_key is not None:
+            server = self.server_for(shard_key)
+        if server is None:
+            members = self._members
+        elif server in self._servers:
+            members = self._servers[server]
+        else:
+            raise ValueError(f'Unknown server "{server}"')
+        best = None
+        for member in members:
+            if member.available and (best is None or member.outstanding < best.outstanding):
+                best = member
+        if best is None:
+            raise ConnectionError(f'No available connection to {server or "any server"}')
+        return best
+
+    async def _run(self, member: PoolMember, coroutine: Coroutine) -> Any:
+        member.outstanding += 1
+        try:
+            return await coroutine
+        finally:
+            member.outstanding -= 1
+
+    async def ami_request(self, query: dict, shard_key: Any = None, server: Optional[str] = None,
+                          request_timeout: Optional[float] = None) -> List[dict]:
+        """
+        Sends an AMI request to the connection chosen by pick
+
+        :param query: The data to be sent
+        :param shard_key: The shard key of the request
+        :param server: The name of the server
+        :param request_timeout: Seconds to wait for the response (the client default if None)
+        :return: The response from the server
+        """
+        member = self.pick(shard_key, server)
+        return await self._run(member, member.client.ami_request(query, request_timeout))
+
+    async def call(self, action: str, *args, shard_key: Any = None, server: Optional[str] = None, **kwargs) -> Any:
+        """
+        Calls a method of the client chosen by pick, e.g.
+        await pool.call('originate', 100, 89999999999, shard_key='tenant-1')
+
+        :param action: The name of the client method
+        :param shard_key: The shard key of the request
+        :param server: The name of the server
+        :return: The result of the method
+        """
+        member = self.pick(shard_key, server)
+        return await self._run(member, getattr(member.client, action)(*args, **kwargs))
+
+    async def broadcast(self, action: str, *args, **kwargs) -> Dict[str, Union[Any, BaseException]]:
+        """
+        Calls a method of the client on every server concurrently
+
+        :param action: The name of the client method
+        :return: The result or the error of every server by server name
+        """
+        targets = []
+        for server in self._server_names:
+            try:
+                targets.append((server, self.pick(server=server)))
+            except ConnectionError as e:
+                targets.append((server, e))
+        results = await asyncio.gather(
+            *(self._run(target, getattr(target.client, action)(*args, **kwargs))
+              for _, target in targets if isinstance(target, PoolMember)),
+            return_exceptions=True
+        )
+        results = iter(results)
+        return {server: next(results) if isinstance(target, PoolMember) else target for server, target in targets}
+
+    async def ping(self, request_timeout: Optional[float] = None) -> Dict[str, Union[List[dict], BaseException]]:
+        """
+        Pings every server
+
+        :param request_timeout: Seconds to wait for the response (the client default if None)
+        :return: The response or the error of every server by server name
+        """
+        return await self.broadcast('ping', request_timeout=request_timeout)
+
+    async def channels(self, refresh: bool = False, request_timeout: Optional[float] = None) -> List[dict]:
+        """
+        Lists the channels of all servers, every channel is tagged with the Server header.
+        Servers that failed to answer are left out and logged.
+
+        :param refresh: Request the servers even if the channels are tracked
+        :param request_timeout: Seconds to wait for the response (the client default if None)
+        :return: The list of dictionaries in the format of the CoreShowChannels response
+        """
+        results = await self.broadcast('channels', refresh=refresh, request_timeout=request_timeout)
+        channels = []
+        for server, response in results.items():
+            if isinstance(response, BaseException):
+                self.logger.warning(f"Channels of {server} failed: {response!r}")
+                continue
+            channels.extend(dict(event, Server=server) for event in response
+                            if event.get('Event') == 'CoreShowChannel')
+        response = [{"Response": "Success", "EventList": "start", "Message": "Channels will follow"}]
+        response.extend(channels)
+        response.append({"Event": "CoreShowChannelsComplete", "EventList": "Complete",
+                         "ListItems": str(len(channels))})
+        return response
+
+    def _event_member(self, server: str) -> PoolMember:
+        # One connection per server receives the events, so they are not delivered several times
+        member = self._event_members.get(server)
+        if member is None or not member.available:
+            members = self._servers[server]
+            member = next((candidate for candidate in members if candidate.available), member or members[0])
+            self._event_members[server] = member
+        return member
+
+    async def register_callback(self, event_name: str, callback: Callable[[dict, Any], Any],
+                                filters: Optional[Dict[str, FilterValue]] = None,
+                                max_concurrency: Optional[int] = None,
+                                ordered_by: Optional[OrderKey] = None, workers: int = 8,
+                                executor: Optional[ExecutorOption] = None, batch_size: int = 1,
+                                batch_wait: float = 0.05) -> None:
+        """
+        Registers a callback for the events of all servers. The callback gets a copy of the event
+        with the Server header set to the name of its server and the client that received it.
+
+        :param event_name: The name of the event
+        :param callback: The callback function, a coroutine function or a plain function run in an executor
+        :param filters: The header filters the event must match (see AMIClientBase.register_callback)
+        :param max_concurrency: The maximum number of simultaneous runs of the callback per server
+        :param ordered_by: The header name or function giving the key of ordered processing
+        :param workers: The number of workers of ordered processing per server
+        :param executor: Where a plain function runs (see AMIClientBase.register_callback)
+        :param batch_size: The maximum number of events per call of a plain function
+        :param batch_wait: Seconds to wait for a batch to fill after its first event
+        :return: None
+        """
+        options = (filters, max_concurrency, ordered_by, workers, executor, batch_size, batch_wait)
+        subscriptions = self._callbacks.setdefault((event_name, callback), [])
+        for server in self._server_names:
+            if is_async_callback(callback):
+                @functools.wraps(callback)
+                async def tagged(event: dict, client: Any, server: str = server) -> None:
+                    await callback(dict(event, Server=server), client)
+            else:
+                # A partial of a module-level function can be sent to a process pool
+                tagged = functools.partial(_call_tagged, callback, server)
+                # The metrics label the wrapper with the name of the callback
+                tagged.__wrapped__ = callback
+
+            client = self._event_member(server).client
+            await client.register_callback(event_name, tagged, *options)
+            subscriptions.append(_Subscription(server, client, tagged, options))
+
+    async def unregister_callback(self, event_name: str, callback: Callable[[dict, Any], Coroutine]) -> None:
+        """
+        Unregisters a callback registered with register_callback
+
+        :param event_name: The name of the event
+        :param callback: The callback function
+        :return: None
+        :raises ValueError: If the callback is not registered
+        """
+        subscriptions = self._callbacks.pop((event_name, callback), None)
+        if subscriptions is None:
+            raise ValueError(f'Callback {callback} is not registered for event "{event_name}"')
+        for subscription in subscriptions:
+            await subscription.client.unregister_callback(event_name, subscription.tagged)
+
+    async def check_health(self) -> None:
+        """
+        Pings every connection and takes the ones that did not answer out of routing, connects again
+        the lost connections and moves the callbacks of a server to an available connection
+        if the one receiving its events is not available
+
+        :return: None
+        """
+        async def check(member: PoolMember) -> None:
+            try:
+                if member.client.state == 'disconnected':
+                    response = await asyncio.wait_for(member.client.connect(*self._credentials), self.health_timeout)
+                else:
+                    response = await member.client.ping(request_timeout=self.health_timeout)
+                healthy = bool(response) and response[0].get('Response') == 'Success'
+            except Exception as e:
+                self.logger.debug("Health check of %s failed: %r", member.server, e)
+                healthy = False
+            if healthy != member.healthy:
+                self.logger.warning("Connection to %s is %s", member.server, 'healthy' if healthy else 'unhealthy')
+            member.healthy = healthy
+
+        # Reconnecting clients restore the connection themselves, closed ones are not used anymore
+        await asyncio.gather(*(check(member) for member in self._members if member.client.state == 'connected'
+                               or (member.client.state == 'disconnected' and self._credentials is not None)))
+        await self._move_callbacks()
+
+    async def _move_callbacks(self) -> None:
+        for server in self._server_names:
+            member = self._event_member(server)
+            moved = [(event_name, subscription) for (event_name, _), subscriptions in self._callbacks.items()
+                     for subscription in subscriptions
+                     if subscription.server == server and subscription.client is not member.client]
+            if moved:
+                self.logger.warning("Events of %s are received by %r now", server, member)
+            for event_name, subscription in moved:
+                try:
+                    await subscription.client.unregister_callback(event_name, subscription.tagged)
+                except ValueError:
+                    pass
+                await member.client.register_callback(event_name, subscription.tagged, *subscription.options)
+                subscription.client = member.client
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_health()
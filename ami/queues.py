@@ -0,0 +1,442 @@
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set
+
+
+def _interface(event: dict) -> str:
+    return event.get('Interface') or event.get('Location') or event.get('StateInterface', '')
+
+
+def _number(value: Any, default: float = 0) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class RollingWindow:
+    """
+    Counters over the last window seconds, kept in a fixed ring of time buckets.
+
+    Adding a value and reading the totals cost the same however many calls were counted:
+    the running totals are updated on add and the buckets that left the window are subtracted
+    as the time moves on.
+    """
+    __slots__ = ('width', '_buckets', '_totals', '_current')
+
+    ANSWERED = 0
+    ANSWERED_IN_SLA = 1
+    ABANDONED = 2
+    COMPLETED = 3
+    HOLD_TIME = 4
+    TALK_TIME = 5
+    FIELDS = 6
+
+    def __init__(self, window: float = 900, buckets: int = 60):
+        """
+        Initializes the window
+
+        :param window: The length of the window in seconds
+        :param buckets: The number of buckets, the window moves on by window / buckets seconds
+        """
+        self.width = window / buckets
+        self._buckets = [[0.0] * self.FIELDS for _ in range(buckets)]
+        self._totals = [0.0] * self.FIELDS
+        self._current = int(time.monotonic() // self.width)
+
+    def _advance(self, now: float) -> List[float]:
+        index = int(now // self.width)
+        if index > self._current:
+            size = len(self._buckets)
+            for position in range(self._current + 1, min(index, self._current + size) + 1):
+                bucket = self._buckets[position % size]
+                for field in range(self.FIELDS):
+                    self._totals[field] -= bucket[field]
+                    bucket[field] = 0.0
+            self._current = index
+        return self._buckets[index % len(self._buckets)]
+
+    def add(self, field: int, value: float = 1, now: Optional[float] = None) -> None:
+        bucket = self._advance(time.monotonic() if now is None else now)
+        bucket[field] += value
+        self._totals[field] += value
+
+    def totals(self, now: Optional[float] = None) -> List[float]:
+        """
+        :return: The totals of the fields over the window
+        """
+        self._advance(time.monotonic() if now is None else now)
+        return list(self._totals)
+
+    def to_dict(self, sla: Optional[float] = None) -> dict:
+        answered, in_sla, abandoned, completed, hold_time, talk_time = self.totals()
+        offered = answered + abandoned
+        return {
+            'answered': int(answered),
+            'abandoned': int(abandoned),
+            'completed': int(completed),
+            'sla': in_sla / offered * 100 if offered and sla is not None else None,
+            'avg_hold_time': hold_time / answered if answered else None,
+            'avg_talk_time': talk_time / completed if completed else None,
+        }
+
+
+class QueueMember:
+    """ The membership of an agent in a queue """
+    __slots__ = ('interface', 'name', 'status', 'paused', 'in_call', 'penalty', 'calls_taken', 'last_call')
+
+    def __init__(self, event: dict):
+        self.interface = _interface(event)
+        self.name = ''
+        self.status = self.paused = self.in_call = self.penalty = ''
+        self.calls_taken = 0
+        self.last_call = 0
+        self.update(event)
+
+    def update(self, event: dict) -> None:
+        self.name = event.get('MemberName', event.get('Name', self.name))
+        self.status = event.get('Status', self.status)
+        self.paused = event.get('Paused', self.paused)
+        self.in_call = event.get('InCall', self.in_call)
+        self.penalty = event.get('Penalty', self.penalty)
+        self.calls_taken = int(_number(event.get('CallsTaken'), self.calls_taken))
+        self.last_call = int(_number(event.get('LastCall'), self.last_call))
+
+    @property
+    def available(self) -> bool:
+        # AST_DEVICE_NOT_INUSE
+        return self.status == '1' and self.paused != '1'
+
+    def to_dict(self) -> dict:
+        return {'interface': self.interface, 'name': self.name, 'status': self.status, 'paused': self.paused == '1',
+                'in_call': self.in_call == '1', 'penalty': self.penalty, 'calls_taken': self.calls_taken,
+                'last_call': self.last_call}
+
+
+class Queue:
+    """ The state and statistics of a queue """
+    __slots__ = ('name', 'strategy', 'service_level', 'completed', 'abandoned', 'waiting', 'members',
+                 'available', 'paused', 'in_call', 'window')
+
+    def __init__(self, name: str, window: float, buckets: int):
+        self.name = name
+        self.strategy = ''
+        self.service_level: Optional[float] = None
+        self.completed = 0
+        self.abandoned = 0
+        # Uniqueid -> the monotonic time the caller joined, in the order of joining
+        self.waiting: Dict[str, float] = {}
+        self.members: Dict[str, QueueMember] = {}
+        self.available = self.paused = self.in_call = 0
+        self.window = RollingWindow(window, buckets)
+
+    def count_members(self) -> None:
+        members = self.members.values()
+        self.available = sum(1 for member in members if member.available)
+        self.paused = sum(1 for member in members if member.paused == '1')
+        self.in_call = sum(1 for member in members if member.in_call == '1')
+
+    def longest_wait(self) -> float:
+        if not self.waiting:
+            return 0
+        return time.monotonic() - next(iter(self.waiting.values()))
+
+    def to_dict(self) -> dict:
+        return {
+            'queue': self.name,
+            'strategy': self.strategy,
+            'calls_waiting': len(self.waiting),
+            'longest_wait': self.longest_wait(),
+            'completed': self.completed,
+            'abandoned': self.abandoned,
+            'members': len(self.members),
+            'available': self.available,
+            'paused': self.paused,
+            'in_call': self.in_call,
+            'window': self.window.to_dict(self.service_level),
+        }
+
+
+class Agent:
+    """ The statistics of an agent (queue member interface) over all its queues """
+    __slots__ = ('interface', 'name', 'status', 'queues', 'answered', 'completed', 'talk_time', 'window')
+
+    def __init__(self, interface: str, window: float, buckets: int):
+        self.interface = interface
+        self.name = ''
+        self.status = ''
+        self.queues: Set[str] = set()
+        self.answered = 0
+        self.completed = 0
+        self.talk_time = 0.0
+        self.window = RollingWindow(window, buckets)
+
+    def to_dict(self) -> dict:
+        return {
+            'interface': self.interface,
+            'name': self.name,
+            'status': self.status,
+            'queues': sorted(self.queues),
+            'answered': self.answered,
+            'completed': self.completed,
+            'avg_talk_time': self.talk_time / self.completed if self.completed else None,
+            'window': self.window.to_dict(),
+        }
+
+
+class QueueTracker:
+    """
+    In-memory statistics of the call queues and their agents.
+
+    The state is seeded from QueueStatus and then kept current from the queue and agent events.
+    The events sent while the client was disconnected are lost, so the state is seeded again
+    when the connection is restored. Besides the counters since seeding, every queue and agent has
+    rolling-window metrics (answered, abandoned, SLA %, average hold and talk time) kept in a fixed ring
+    of time buckets, so reading a queue never needs a request to the server and costs the same however
+    many calls it had.
+    """
+
+    EVENTS = ('QueueCallerJoin', 'QueueCallerLeave', 'QueueCallerAbandon', 'AgentConnect', 'AgentComplete',
+              'QueueMemberStatus', 'QueueMemberAdded', 'QueueMemberRemoved', 'QueueMemberPause')
+
+    def __init__(self, client: Any, window: float = 900, buckets: int = 60, sla: Optional[float] = None):
+        """
+        Initializes the tracker
+
+        :param client: The client to track the queues of
+        :param window: The length of the rolling window in seconds
+        :param buckets: The number of buckets of the rolling window
+        :param sla: The service level in seconds, a call answered within it counts as in SLA
+            (by default the ServiceLevel of every queue)
+        """
+        self._client = client
+        self.window = window
+        self.buckets = buckets
+        self.sla = sla
+        self._queues: Dict[str, Queue] = {}
+        self._agents: Dict[str, Agent] = {}
+        # The waiting callers (by Uniqueid) and the members (by queue and interface) that joined and left
+        # while the state is loaded from the server
+        self._joined: Optional[Set[Any]] = None
+        self._left: Optional[Set[Any]] = None
+        self._watching = False
+        self.logger = logging.getLogger('AMI Queues')
+        self.running = False
+        # False until the state is loaded and while the connection is lost
+        self.synced = False
+
+    def __len__(self) -> int:
+        return len(self._queues)
+
+    async def start(self) -> None:
+        """
+        Subscribes to the queue events and seeds the state from the server
+
+        :return: None
+        """
+        for event_name in self.EVENTS:
+            await self._client.register_callback(event_name, self._on_event)
+        if not self._watching:
+            await self._client.register_state_callback(self._on_state)
+            self._watching = True
+        self.running = True
+        await self.refresh()
+
+    async def stop(self) -> None:
+        """
+        Unsubscribes from the queue events and drops the state
+
+        :return: None
+        """
+        for event_name in self.EVENTS:
+            await self._client.unregister_callback(event_name, self._on_event)
+        self.running = False
+        self.synced = False
+        self.clear()
+
+    def clear(self) -> None:
+        self._queues.clear()
+        self._agents.clear()
+
+    async def refresh(self) -> None:
+        """
+        Loads the queues, members and waiting callers from the server: the ones already known keep their state,
+        the members and callers missing from the server are dropped
+
+        :return: None
+        """
+        # Events received while loading are newer than the snapshot: callers and members that joined meanwhile
+        # are kept, the ones that left meanwhile are not restored
+        self._joined, self._left = set(), set()
+        try:
+            response = await self._client.ami_request({"Action": "QueueStatus"})
+        finally:
+            joined, left = self._joined, self._left
+            self._joined = self._left = None
+
+        now = time.monotonic()
+        entries = []
+        listed = set()
+        for event in response:
+            name = event.get('Event')
+            if name == 'QueueParams':
+                queue = self._queue(event.get('Queue'))
+                queue.strategy = event.get('Strategy', queue.strategy)
+                queue.completed = int(_number(event.get('Completed'), queue.completed))
+                queue.abandoned = int(_number(event.get('Abandoned'), queue.abandoned))
+                if self.sla is None and event.get('ServiceLevel'):
+                    queue.service_level = _number(event.get('ServiceLevel'))
+            elif name == 'QueueMember':
+                key = (event.get('Queue'), _interface(event))
+                listed.add(key)
+                if key not in left:
+                    self._update_member(event)
+            elif name == 'QueueEntry':
+                listed.add(event.get('Uniqueid'))
+                entries.append(event)
+        for queue in list(self._queues.values()):
+            for interface in list(queue.members):
+                if (queue.name, interface) not in listed and (queue.name, interface) not in joined:
+                    self._remove_member(queue.name, interface)
+            for uniqueid in list(queue.waiting):
+                if uniqueid not in listed and uniqueid not in joined:
+                    del queue.waiting[uniqueid]
+        # The longest waiting callers first, the waiting callers are kept in the order of joining
+        for event in sorted(entries, key=lambda entry: -_number(entry.get('Wait'))):
+            uniqueid = event.get('Uniqueid')
+            queue = self._queue(event.get('Queue'))
+            if uniqueid in queue.waiting or uniqueid in left:
+                continue
+            queue.waiting[uniqueid] = now - _number(event.get('Wait'))
+        self.synced = True
+
+    def queue(self, name: str) -> Optional[dict]:
+        """
+        :param name: The name of the queue
+        :return: The snapshot of the queue or None
+        """
+        queue = self._queues.get(name)
+        return None if queue is None else queue.to_dict()
+
+    def queues(self) -> Dict[str, dict]:
+        """
+        :return: The snapshots of all queues by name
+        """
+        return {name: queue.to_dict() for name, queue in self._queues.items()}
+
+    def members(self, name: str) -> List[dict]:
+        """
+        :param name: The name of the queue
+        :return: The members of the queue
+        """
+        queue = self._queues.get(name)
+        return [] if queue is None else [member.to_dict() for member in queue.members.values()]
+
+    def agent(self, interface: str) -> Optional[dict]:
+        """
+        :param interface: The interface of the agent, e.g. PJSIP/100
+        :return: The snapshot of the agent or None
+        """
+        agent = self._agents.get(interface)
+        return None if agent is None else agent.to_dict()
+
+    def agents(self) -> Dict[str, dict]:
+        """
+        :return: The snapshots of all agents by interface
+        """
+        return {interface: agent.to_dict() for interface, agent in self._agents.items()}
+
+    def _queue(self, name: str) -> Queue:
+        queue = self._queues.get(name)
+        if queue is None:
+            queue = self._queues[name] = Queue(name, self.window, self.buckets)
+            queue.service_level = self.sla
+        return queue
+
+    def _agent(self, interface: str) -> Agent:
+        agent = self._agents.get(interface)
+        if agent is None:
+            agent = self._agents[interface] = Agent(interface, self.window, self.buckets)
+        return agent
+
+    def _update_member(self, event: dict) -> None:
+        queue = self._queue(event.get('Queue'))
+        interface = _interface(event)
+        member = queue.members.get(interface)
+        if member is None:
+            member = queue.members[interface] = QueueMember(event)
+        else:
+            member.update(event)
+        queue.count_members()
+        agent = self._agent(interface)
+        agent.name = member.name
+        agent.status = member.status
+        agent.queues.add(queue.name)
+
+    def _remove_member(self, name: str, interface: str) -> None:
+        queue = self._queue(name)
+        if queue.members.pop(interface, None) is not None:
+            queue.count_members()
+        agent = self._agents.get(interface)
+        if agent is not None:
+            agent.queues.discard(queue.name)
+            if not agent.queues:
+                del self._agents[interface]
+
+    async def _on_event(self, event: dict, _client: Any) -> None:
+        name = event.get('Event')
+        if name in ('QueueMemberStatus', 'QueueMemberAdded', 'QueueMemberPause'):
+            self._update_member(event)
+            if name == 'QueueMemberAdded' and self._joined is not None:
+                self._joined.add((event.get('Queue'), _interface(event)))
+            return
+        if name == 'QueueMemberRemoved':
+            self._remove_member(event.get('Queue'), _interface(event))
+            if self._left is not None:
+                self._left.add((event.get('Queue'), _interface(event)))
+            return
+
+        queue = self._queue(event.get('Queue'))
+        uniqueid = event.get('Uniqueid')
+        if name == 'QueueCallerJoin':
+            queue.waiting.setdefault(uniqueid, time.monotonic())
+            if self._joined is not None:
+                self._joined.add(uniqueid)
+        elif name == 'QueueCallerLeave':
+            queue.waiting.pop(uniqueid, None)
+            if self._left is not None:
+                self._left.add(uniqueid)
+        elif name == 'QueueCallerAbandon':
+            queue.abandoned += 1
+            queue.window.add(RollingWindow.ABANDONED)
+        elif name == 'AgentConnect':
+            hold_time = _number(event.get('HoldTime'))
+            queue.window.add(RollingWindow.ANSWERED)
+            queue.window.add(RollingWindow.HOLD_TIME, hold_time)
+            if queue.service_level is not None and hold_time <= queue.service_level:
+                queue.window.add(RollingWindow.ANSWERED_IN_SLA)
+            agent = self._agent(event.get('Interface') or event.get('MemberName', ''))
+            agent.answered += 1
+            agent.window.add(RollingWindow.ANSWERED)
+            agent.window.add(RollingWindow.HOLD_TIME, hold_time)
+        elif name == 'AgentComplete':
+            talk_time = _number(event.get('TalkTime'))
+            queue.completed += 1
+            queue.window.add(RollingWindow.COMPLETED)
+            queue.window.add(RollingWindow.TALK_TIME, talk_time)
+            agent = self._agent(event.get('Interface') or event.get('MemberName', ''))
+            agent.completed += 1
+            agent.talk_time += talk_time
+            agent.window.add(RollingWindow.COMPLETED)
+            agent.window.add(RollingWindow.TALK_TIME, talk_time)
+
+    async def _on_state(self, state: str, _client: Any) -> None:
+        if not self.running:
+            return
+        if state != 'connected':
+            self.synced = False
+        elif not self.synced:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.logger.warning('Failed to reload the queues after reconnecting: %r', e)
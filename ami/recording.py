@@ -0,0 +1,328 @@
+import asyncio
+import concurrent.futures
+import glob
+import gzip
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Any, BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+from ami.parser import FrameParser
+
+MAGIC = b'AMIREC\x00\x01'
+# Wall clock time of the chunk and its length, a record of zero length marks a lost connection
+_RECORD = struct.Struct('<dI')
+
+
+def recording_files(path: str) -> List[str]:
+    """
+    Finds the files of a recording: the file itself or, if the recording was rotated, its numbered parts
+
+    :param path: The path passed to the recorder
+    :return: The paths in recording order
+    """
+    if os.path.exists(path):
+        return [path]
+    root, ext = os.path.splitext(path)
+    return sorted(glob.glob(f'{glob.escape(root)}.[0-9][0-9][0-9][0-9][0-9]{ext}'))
+
+
+class EventRecorder:
+    """
+    Append-only recorder of the raw data received by TCPClient.
+
+    The data is recorded as it was read from the socket, in chunks with their wall clock time,
+    so recording costs one list append in the receiving loop. The chunks are written in batches
+    by a dedicated thread, if it falls behind by more than max_pending bytes new chunks are dropped
+    instead of slowing the client down.
+
+    A file is the magic bytes followed by records: a double timestamp, a 4-byte length and the data.
+    Recording to an existing file appends to it.
+    """
+
+    def __init__(self, path: str, compress: bool = False, max_bytes: Optional[int] = None,
+                 flush_interval: float = 0.5, max_pending: int = 64 * 1024 * 1024):
+        """
+        Initializes the recorder
+
+        :param path: The path of the file, rotated files are numbered: events.amirec -> events.00001.amirec
+        :param compress: Compress the files with gzip
+        :param max_bytes: Start a new file when the current one reaches this size (before compression)
+        :param flush_interval: Seconds between batched writes
+        :param max_pending: The maximum number of bytes waiting to be written
+        """
+        self.logger = logging.getLogger('AMI Recorder')
+        self.path = path
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.recorded = 0
+        self.dropped = 0
+        self._batch: List[Tuple[float, bytes]] = []
+        self._pending = 0
+        self._gap = False
+        self._file: Optional[BinaryIO] = None
+        self._file_size = 0
+        self._index = 0
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def record(self, data: bytes) -> None:
+        """
+        Queues a chunk of data for writing
+
+        :param data: The data read from the socket
+        :return: None
+        """
+        if self._pending > self.max_pending:
+            self.dropped += 1
+            self._gap = True
+            return
+        if self._gap:
+            # The replay must not join the frames around the dropped chunks
+            self._gap = False
+            self._batch.append((time.time(), b''))
+        self._batch.append((time.time(), data))
+        self._pending += len(data)
+
+    def reset(self) -> None:
+        """
+        Marks a lost connection, the replay drops the incomplete frame read before it
+
+        :return: None
+        """
+        self._batch.append((time.time(), b''))
+
+    def start(self, head: bytes = b'') -> None:
+        """
+        Starts writing in the background
+
+        :param head: The incomplete frame already received, so that the recording starts on a frame boundary
+        :return: None
+        """
+        if self._task is not None:
+            return
+        if head:
+            self.record(head)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ami-recorder')
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_event_loop().create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """
+        Writes the queued chunks and closes the file
+
+        :return: None
+        """
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        self._wakeup.set()
+        await task
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._close_file)
+        self._executor.shutdown()
+        self._executor = None
+
+    async def _flush_loop(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            batch, self._batch = self._batch, []
+            if batch:
+                try:
+                    await loop.run_in_executor(self._executor, self._write, batch)
+                except OSError as e:
+                    self.logger.error('Failed to write the recording: %r', e)
+                self._pending -= sum(len(data) for _, data in batch)
+                self.recorded += len(batch)
+            if self._task is None and not self._batch:
+                break
+
+    def _file_name(self) -> str:
+        if self.max_bytes is None:
+            return self.path
+        root, ext = os.path.splitext(self.path)
+        return f'{root}.{self._index:05d}{ext}'
+
+    def _open_file(self) -> BinaryIO:
+        if self._index == 0 and self.max_bytes is not None and not os.path.exists(self.path):
+            # Continue an existing rotated recording in its last part
+            self._index = max(len(recording_files(self.path)) - 1, 0)
+        self._index += 1
+        path = self._file_name()
+        # An existing recording is appended to, never truncated (a gzip file gets a new member)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        file = gzip.open(path, 'ab', compresslevel=6) if self.compress else open(path, 'ab')
+        if size == 0:
+            file.write(MAGIC)
+            size = len(MAGIC)
+        else:
+            # Like a lost connection: the replay drops the incomplete frame the previous recording ended with
+            file.write(_RECORD.pack(time.time(), 0))
+            size += _RECORD.size
+        self._file_size = size
+        return file
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, batch: Iterable[Tuple[float, bytes]]) -> None:
+        """ Runs in the writer thread """
+        pack = _RECORD.pack
+        parts = []
+        size = 0
+        for timestamp, data in batch:
+            if self._file is None:
+                self._file = self._open_file()
+            parts.append(pack(timestamp, len(data)))
+            parts.append(data)
+            size += _RECORD.size + len(data)
+            if self.max_bytes is not None and self._file_size + size >= self.max_bytes:
+                self._file.write(b''.join(parts))
+                self._close_file()
+                parts.clear()
+                size = 0
+        if parts:
+            self._file.write(b''.join(parts))
+            self._file_size += size
+            self._file.flush()
+
+
+class RecordingReader:
+    """
+    Reader of the records written by EventRecorder.
+
+    Uncompressed files are memory-mapped and compressed files are decompressed as a stream,
+    so a recording is never loaded into memory as a whole. A record cut off at the end of a file
+    (e.g. the client was killed while writing) ends the file.
+    """
+
+    def __init__(self, path: str):
+        """
+        Initializes the reader
+
+        :param path: The path passed to the recorder
+        :raises FileNotFoundError: If there are no files of the recording
+        """
+        self.files = recording_files(path)
+        if not self.files:
+            raise FileNotFoundError(f'Recording "{path}" not found')
+
+    def __iter__(self) -> Iterator[Tuple[float, bytes]]:
+        for path in self.files:
+            with open(path, 'rb') as file:
+                compressed = file.read(2) == b'\x1f\x8b'
+            if compressed:
+                yield from self._read_stream(path)
+            else:
+                yield from self._read_mapped(path)
+
+    @staticmethod
+    def _check_magic(magic: bytes, path: str) -> None:
+        if magic != MAGIC:
+            raise ValueError(f'"{path}" is not an AMI recording')
+
+    def _read_mapped(self, path: str) -> Iterator[Tuple[float, bytes]]:
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size < len(MAGIC):
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                self._check_magic(view[:len(MAGIC)], path)
+                unpack = _RECORD.unpack_from
+                offset = len(MAGIC)
+                while offset + _RECORD.size <= size:
+                    timestamp, length = unpack(view, offset)
+                    offset += _RECORD.size
+                    if offset + length > size:
+                        return
+                    yield timestamp, view[offset:offset + length]
+                    offset += length
+
+    def _read_stream(self, path: str) -> Iterator[Tuple[float, bytes]]:
+        with gzip.open(path, 'rb') as file:
+            self._check_magic(file.read(len(MAGIC)), path)
+            while True:
+                header = file.read(_RECORD.size)
+                if len(header) < _RECORD.size:
+                    return
+                timestamp, length = _RECORD.unpack(header)
+                data = file.read(length)
+                if len(data) < length:
+                    return
+                yield timestamp, data
+
+
+def replay_events(path: str, encoding: str = 'windows-1251') -> Iterator[Tuple[float, List[dict]]]:
+    """
+    Parses a recording into the events TCPClient would have dispatched: responses and the events
+    of their event lists are skipped
+
+    :param path: The path passed to the recorder
+    :param encoding: The encoding of the data
+    :return: The iterator over the time of each chunk and its events
+    """
+    parser = FrameParser(encoding)
+    event_lists = set()
+    for timestamp, data in RecordingReader(path):
+        if not data:
+            parser.clear()
+            event_lists.clear()
+            continue
+        events = []
+        for message in parser.feed(data):
+            action_id = message.get('ActionID')
+            # Events may carry a Response header too, e.g. OriginateResponse
+            if 'Event' in message:
+                if action_id is not None and action_id in event_lists:
+                    if message.get('EventList') == 'Complete':
+                        event_lists.discard(action_id)
+                    continue
+                events.append(message)
+            elif 'Response' in message:
+                if message.get('EventList') == 'start':
+                    event_lists.add(action_id)
+        yield timestamp, events
+
+
+async def replay(client: Any, path: str, speed: Optional[float] = 1.0) -> int:
+    """
+    Replays a recording into the dispatch pipeline of the client, the events go through
+    its buffer, overflow policy and callbacks like the events received from the server
+
+    :param client: The client
+    :param path: The path passed to the recorder
+    :param speed: The speed relative to the recorded time (2 is twice as fast), None replays as fast as possible
+    :return: The number of replayed events
+    """
+    loop = asyncio.get_event_loop()
+    dispatcher = client._dispatcher
+    count = 0
+    started = first = None
+    for timestamp, events in replay_events(path):
+        if speed:
+            if started is None:
+                started, first = loop.time(), timestamp
+            delay = started + (timestamp - first) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            # Let the callbacks run when the buffer never makes the replay wait
+            await asyncio.sleep(0)
+        for event in events:
+            await dispatcher.put(event)
+        count += len(events)
+    return count
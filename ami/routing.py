@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import re
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Pattern, Sequence, Tuple, Union
+
+FilterValue = Union[str, Pattern, Callable[[str], bool]]
+EventCallback = Callable[[dict, Any], Coroutine]
+OrderKey = Union[str, Callable[[dict], Any]]
+
+
+def prefix(value: str) -> Pattern:
+    """
+    Creates a filter value matching headers that start with the given prefix,
+    e.g. {"Channel": prefix("PJSIP/")}
+
+    :param value: The prefix
+    :return: The compiled pattern
+    """
+    return re.compile(re.escape(value))
+
+
+class Handler:
+    """
+    A registered callback with the header filters an event must match to be passed to it.
+
+    A filter value can be a string (exact match), a compiled regular expression
+    (matched from the beginning of the value) or a predicate taking the header value.
+    """
+    __slots__ = ('event_name', 'callback', 'filters', 'max_concurrency', 'ordered_by', 'workers', 'inline',
+                 'run', '_checks', '_semaphore')
+
+    def __init__(self, event_name: str, callback: EventCallback, filters: Optional[Dict[str, FilterValue]] = None,
+                 max_concurrency: Optional[int] = None, ordered_by: Optional[OrderKey] = None, workers: int = 8,
+                 inline: bool = False, run: Optional[EventCallback] = None):
+        if ordered_by is not None and workers < 1:
+            raise ValueError('Ordered callbacks require at least one worker')
+        self.event_name = event_name
+        self.callback = callback
+        self.filters = dict(filters or {})
+        self.max_concurrency = max_concurrency
+        self.ordered_by = ordered_by
+        self.workers = workers
+        # A plain function called by the dispatcher directly, without a task (e.g. putting into an event stream)
+        self.inline = inline
+        # The coroutine function awaited by the dispatcher, the callback itself or its runner (e.g. in an executor)
+        self.run = callback if run is None else run
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._checks: Tuple[Tuple[str, Callable[[str], Any]], ...] = tuple(
+            (header, self._compile(value)) for header, value in self.filters.items()
+        )
+
+    @staticmethod
+    def _compile(value: FilterValue) -> Callable[[str], Any]:
+        if isinstance(value, str):
+            return value.__eq__
+        if isinstance(value, re.Pattern):
+            return value.match
+        if callable(value):
+            return value
+        raise TypeError(f'Unsupported filter value {value!r}, use str, compiled pattern or callable')
+
+    @property
+    def semaphore(self) -> Optional[asyncio.Semaphore]:
+        """
+        The semaphore limiting the number of simultaneous runs of the callback,
+        created on first use so that it belongs to the running event loop
+
+        :return: The semaphore or None if the number of runs is not limited
+        """
+        if self._semaphore is None and self.max_concurrency:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def order_key(self, event: dict) -> Any:
+        """
+        The key of the event for ordered callbacks: events with the same key are processed one by one in order
+
+        :param event: The event
+        :return: The key
+        """
+        if callable(self.ordered_by):
+            return self.ordered_by(event)
+        return event.get(self.ordered_by)
+
+    @property
+    def index_key(self) -> Optional[Tuple[str, str]]:
+        """
+        The first exact-match filter, used to index the handler by header value
+
+        :return: The header name and value or None if the handler has no exact-match filters
+        """
+        for header, value in self.filters.items():
+            if isinstance(value, str):
+                return header, value
+        return None
+
+    def matches(self, event: dict, skip: Optional[str] = None) -> bool:
+        """
+        Checks whether the event matches all filters of the handler.
+
+        :param event: The event
+        :param skip: The header already checked by the index lookup
+        :return: True if the event matches
+        """
+        for header, check in self._checks:
+            if header == skip:
+                continue
+            value = event.get(header)
+            if value is None or not check(value):
+                return False
+        return True
+
+
+class _Route:
+    """ Precomputed handlers for one event name (including the '*' handlers) """
+    __slots__ = ('always', 'indexed', 'scanned')
+
+    def __init__(self, handlers: Sequence[Handler]):
+        always = []
+        indexed: Dict[str, Dict[str, List[Handler]]] = {}
+        scanned = []
+        for handler in handlers:
+            if not handler.filters:
+                always.append(handler)
+                continue
+            index_key = handler.index_key
+            if index_key is None:
+                scanned.append(handler)
+            else:
+                header, value = index_key
+                indexed.setdefault(header, {}).setdefault(value, []).append(handler)
+        self.always = tuple(always)
+        self.indexed = {header: {value: tuple(hs) for value, hs in by_value.items()}
+                        for header, by_value in indexed.items()}
+        self.scanned = tuple(scanned)
+
+    def match(self, event: dict, router: 'EventRouter') -> Sequence[Handler]:
+        if not self.indexed and not self.scanned:
+            return self.always
+        result = list(self.always)
+        for header, by_value in self.indexed.items():
+            handlers = by_value.get(event.get(header))
+            if handlers:
+                result.extend(handler for handler in handlers if router.check(handler, event, header))
+        result.extend(handler for handler in self.scanned if router.check(handler, event))
+        return result
+
+
+class EventRouter:
+    """
+    Routing table of event callbacks.
+
+    Handlers are indexed by event name and by the value of their first exact-match header filter.
+    The table is rebuilt on every registration, so looking up the handlers of an event costs
+    the same however many handlers are registered. A handler whose filter raises does not match
+    the event, the error is logged and counted in errors.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('AMI Router')
+        self.errors = 0
+        self._handlers: List[Handler] = []
+        self._routes: Dict[str, _Route] = {}
+        self._default = _Route(())
+
+    def __len__(self) -> int:
+        return len(self._handlers)
+
+    @property
+    def handlers(self) -> Tuple[Handler, ...]:
+        return tuple(self._handlers)
+
+    def add(self, handler: Handler) -> Handler:
+        """
+        Adds a handler to the routing table.
+
+        :param handler: The handler
+        :return: The handler
+        """
+        self._handlers.append(handler)
+        self._rebuild()
+        return handler
+
+    def remove(self, event_name: str, callback: EventCallback) -> int:
+        """
+        Removes all handlers of the callback registered for the event name.
+
+        :param event_name: The name of the event
+        :param callback: The callback function
+        :return: The number of removed handlers
+        """
+        handlers = [handler for handler in self._handlers
+                    if not (handler.event_name == event_name and handler.callback == callback)]
+        removed = len(self._handlers) - len(handlers)
+        if removed:
+            self._handlers = handlers
+            self._rebuild()
+        return removed
+
+    def event_names(self) -> List[str]:
+        """
+        :return: The names of the events that have handlers ('*' included)
+        """
+        return list(dict.fromkeys(handler.event_name for handler in self._handlers))
+
+    def match(self, event: dict) -> Sequence[Handler]:
+        """
+        Finds the handlers matching the event.
+
+        :param event: The event
+        :return: The matching handlers
+        """
+        return self._routes.get(event.get('Event'), self._default).match(event, self)
+
+    def check(self, handler: Handler, event: dict, skip: Optional[str] = None) -> bool:
+        """
+        Checks the filters of a handler, a filter that raises does not match
+
+        :param handler: The handler
+        :param event: The event
+        :param skip: The header already checked by the index lookup
+        :return: True if the event matches
+        """
+        try:
+            return handler.matches(event, skip)
+        except Exception:
+            self.errors += 1
+            self.logger.exception("Filters of callback %s failed on event '%s'", handler.callback, event.get('Event'))
+            return False
+
+    def _rebuild(self) -> None:
+        wildcard = [handler for handler in self._handlers if handler.event_name == '*']
+        names = {handler.event_name for handler in self._handlers if handler.event_name != '*'}
+        self._routes = {
+            name: _Route([handler for handler in self._handlers if handler.event_name == name] + wildcard)
+            for name in names
+        }
+        self._default = _Route(wildcard)
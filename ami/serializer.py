@@ -0,0 +1,59 @@
+import functools
+import re
+from typing import Any, List, Tuple
+
+_INDEX = re.compile(r"\[\d+]")
+
+
+@functools.lru_cache(maxsize=1024)
+def header_name(key: str) -> str:
+    """
+    Normalizes a key of an action: the "[n]" suffixes used to repeat a header in a dictionary
+    (e.g. "Variable[0]") are removed
+
+    :param key: The key of the action dictionary
+    :return: The header name
+    """
+    return _INDEX.sub('', str(key))
+
+
+@functools.lru_cache(maxsize=1024)
+def _header_prefix(key: str, encoding: str) -> bytes:
+    return f"{header_name(key)}: ".encode(encoding)
+
+
+def action_headers(query: dict) -> List[Tuple[str, Any]]:
+    """
+    Converts an action into the list of its headers, a list or tuple value is sent as a repeated header
+
+    :param query: The action, e.g. {"Action": "Originate", "Variable": ["A=1", "B=2"]}
+    :return: The list of header names and values
+    """
+    headers = []
+    for key, value in query.items():
+        name = header_name(key)
+        if isinstance(value, (list, tuple)):
+            headers.extend((name, item) for item in value)
+        else:
+            headers.append((name, value))
+    return headers
+
+
+def serialize_action(query: dict, encoding: str = 'utf8') -> bytes:
+    """
+    Converts an action into the AMI wire format, a list or tuple value is sent as a repeated header
+
+    :param query: The action, e.g. {"Action": "Originate", "Variable": ["A=1", "B=2"]}
+    :param encoding: The encoding of the values
+    :return: The message terminated by an empty line
+    """
+    parts = []
+    for key, value in query.items():
+        prefix = _header_prefix(key, encoding)
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                parts += (prefix, str(item).encode(encoding), b'\r\n')
+        else:
+            parts += (prefix, str(value).encode(encoding), b'\r\n')
+    parts.append(b'\r\n')
+    return b''.join(parts)
@@ -0,0 +1,397 @@
+import asyncio
+import logging
+import multiprocessing
+import struct
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Awaitable, Callable, Coroutine, Dict, List, Optional
+
+from ami.dispatch import EventDispatcher
+from ami.executors import ExecutorOption, ExecutorPools, callback_runner
+from ami.message import AMIMessage
+from ami.routing import EventRouter, FilterValue, Handler, OrderKey
+
+FANOUT_MODES = ('partition', 'broadcast')
+
+# Native format: positions are stored with a single aligned write, never seen half-updated by the other process
+_POSITION = struct.Struct('Q')
+_LENGTH = struct.Struct('<I')
+_WRAP = 0xFFFFFFFF
+
+
+def encode_event(event: dict) -> bytes:
+    """
+    Serializes an event in the AMI wire format without the blank line
+
+    :param event: The event, the repeated headers of an AMIMessage are kept
+    :return: The bytes of the event
+    """
+    headers = event.headers() if hasattr(event, 'headers') else event.items()
+    return ''.join(f"{key}: {value}\r\n" for key, value in headers).encode('utf-8')
+
+
+def decode_event(data: bytes) -> AMIMessage:
+    """
+    Parses an event serialized by encode_event
+
+    :param data: The bytes of the event
+    :return: The event
+    """
+    return AMIMessage(data, 'utf-8')
+
+
+class RingBuffer:
+    """
+    Single-producer single-consumer ring of byte records in shared memory.
+
+    The header holds the write position, the read position and the closed flag, each in its own
+    cache line. Positions only grow, the offset in the data area is the position modulo its size.
+    A record is a 4-byte length followed by the data, a record that does not fit before the end of
+    the data area is preceded by a wrap marker and written from the beginning.
+    """
+
+    _WRITE = 0
+    _READ = 64
+    _CLOSED = 128
+    HEADER = 192
+
+    def __init__(self, shm: SharedMemory, owner: bool):
+        self._shm = shm
+        self._owner = owner
+        self._buf = shm.buf
+        self.capacity = shm.size - self.HEADER
+
+    @classmethod
+    def create(cls, size: int) -> 'RingBuffer':
+        """
+        Creates a new ring
+
+        :param size: The size of the data area in bytes
+        :return: The ring owning the shared memory
+        """
+        shm = SharedMemory(create=True, size=size + cls.HEADER)
+        shm.buf[:cls.HEADER] = bytes(cls.HEADER)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> 'RingBuffer':
+        """
+        Attaches to a ring created by another process
+
+        :param name: The name of the shared memory
+        :return: The ring
+        """
+        return cls(SharedMemory(name=name), owner=False)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def _get(self, offset: int) -> int:
+        return _POSITION.unpack_from(self._buf, offset)[0]
+
+    def _set(self, offset: int, value: int) -> None:
+        _POSITION.pack_into(self._buf, offset, value)
+
+    def __len__(self) -> int:
+        return self._get(self._WRITE) - self._get(self._READ)
+
+    @property
+    def closed(self) -> bool:
+        return self._buf[self._CLOSED] != 0
+
+    def close(self) -> None:
+        """
+        Marks the ring closed, the consumer stops after reading the remaining records
+
+        :return: None
+        """
+        self._buf[self._CLOSED] = 1
+
+    def write(self, data: bytes) -> bool:
+        """
+        Appends a record
+
+        :param data: The data of the record
+        :return: False if there is not enough free space
+        :raises ValueError: If the record can never fit in the ring
+        """
+        size = _LENGTH.size + len(data)
+        if size > self.capacity - _LENGTH.size:
+            raise ValueError(f'The record of {len(data)} bytes does not fit in the ring of {self.capacity} bytes')
+        position = self._get(self._WRITE)
+        offset = position % self.capacity
+        padding = 0
+        if self.capacity - offset < size:
+            padding = self.capacity - offset
+        if position + padding + size - self._get(self._READ) > self.capacity:
+            return False
+        if padding:
+            if padding >= _LENGTH.size:
+                _LENGTH.pack_into(self._buf, self.HEADER + offset, _WRAP)
+            position += padding
+            offset = 0
+        start = self.HEADER + offset
+        _LENGTH.pack_into(self._buf, start, len(data))
+        self._buf[start + _LENGTH.size:start + size] = data
+        # The record is published by moving the write position after the data is in place
+        self._set(self._WRITE, position + size)
+        return True
+
+    def read(self) -> Optional[bytes]:
+        """
+        Takes the next record
+
+        :return: The data of the record or None if the ring is empty
+        """
+        position = self._get(self._READ)
+        if position == self._get(self._WRITE):
+            return None
+        offset = position % self.capacity
+        if self.capacity - offset < _LENGTH.size:
+            position += self.capacity - offset
+            offset = 0
+        length = _LENGTH.unpack_from(self._buf, self.HEADER + offset)[0]
+        if length == _WRAP:
+            position += self.capacity - offset
+            offset = 0
+            length = _LENGTH.unpack_from(self._buf, self.HEADER)[0]
+        start = self.HEADER + offset + _LENGTH.size
+        data = bytes(self._buf[start:start + length])
+        self._set(self._READ, position + _LENGTH.size + length)
+        return data
+
+    def release(self) -> None:
+        """
+        Detaches from the shared memory, the owner also destroys it
+
+        :return: None
+        """
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class EventWorker:
+    """
+    The consumer side of the fan-out, running in a worker process.
+    Callbacks are registered the same way as on the clients and get the events of the worker's ring,
+    the second argument of the callbacks is the worker (the AMI connection is owned by the main process).
+    """
+
+    def __init__(self, name: str, index: int = 0, poll_interval: float = 0.005):
+        """
+        Initializes the worker
+
+        :param name: The name of the shared memory of the ring
+        :param index: The number of the worker
+        :param poll_interval: The maximum number of seconds between checks of an empty ring
+        """
+        self.logger = logging.getLogger('AMI Worker')
+        self.index = index
+        self.poll_interval = poll_interval
+        self._ring = RingBuffer.attach(name)
+        self._router = EventRouter()
+        self._dispatcher = EventDispatcher(self, self._router)
+        self.executors = ExecutorPools()
+        self.received = 0
+
+    async def register_callback(self, event_name: str, callback: Callable[[dict, 'EventWorker'], Any],
+                                filters: Optional[Dict[str, FilterValue]] = None,
+                                max_concurrency: Optional[int] = None,
+                                ordered_by: Optional[OrderKey] = None, workers: int = 8,
+                                executor: Optional[ExecutorOption] = None, batch_size: int = 1,
+                                batch_wait: float = 0.05) -> None:
+        """
+        Registers a callback function for an event (see AMIClientBase.register_callback)
+
+        :param event_name: The name of the event ('*' for all events)
+        :param callback: The callback function, a coroutine function or a plain function run in an executor
+        :param filters: The header filters the event must match
+        :param max_concurrency: The maximum number of simultaneous runs of the callback
+        :param ordered_by: The header name or function giving the key of ordered processing
+        :param workers: The number of workers of ordered processing
+        :param executor: Where a plain function runs (see AMIClientBase.register_callback)
+        :param batch_size: The maximum number of events per call of a plain function
+        :param batch_wait: Seconds to wait for a batch to fill after its first event
+        :return: None
+        :raises ValueError: If the executor options do not fit the callback
+        """
+        run = callback_runner(callback, self.executors, executor, batch_size, batch_wait, max_concurrency, ordered_by)
+        self._router.add(Handler(event_name, callback, filters, max_concurrency, ordered_by, workers, run=run))
+
+    async def unregister_callback(self, event_name: str, callback: Callable[[dict, 'EventWorker'], Coroutine]) -> None:
+        """
+        Unregisters a callback function for an event
+
+        :param event_name: The name of the event
+        :param callback: The callback function
+        :return: None
+        :raises ValueError: If the callback is not registered
+        """
+        if not self._router.remove(event_name, callback):
+            raise ValueError(f'Callback {callback} is not registered for event "{event_name}"')
+        self._dispatcher.forget(event_name, callback)
+
+    async def run(self) -> None:
+        """
+        Reads the events of the ring and runs the callbacks until the ring is closed
+
+        :return: None
+        """
+        dispatch = asyncio.get_event_loop().create_task(self._dispatcher.run())
+        delay = 0
+        try:
+            while True:
+                data = self._ring.read()
+                if data is None:
+                    if self._ring.closed:
+                        break
+                    delay = min(delay * 2 or 0.0001, self.poll_interval)
+                    await asyncio.sleep(delay)
+                    continue
+                delay = 0
+                self.received += 1
+                await self._dispatcher.put(decode_event(data))
+        finally:
+            self._dispatcher.buffer.close()
+            await dispatch
+            while self._dispatcher.in_flight or self._dispatcher.stats()['queued']:
+                await asyncio.sleep(0.01)
+            self._dispatcher.stop()
+            await self.executors.shutdown()
+            self._ring.release()
+
+
+def _worker_main(name: str, index: int, setup: Callable[[EventWorker], Awaitable[None]]) -> None:
+    async def main() -> None:
+        worker = EventWorker(name, index)
+        await setup(worker)
+        await worker.run()
+
+    asyncio.run(main())
+
+
+class EventFanout:
+    """
+    Fan-out of the events of one client to worker processes through shared-memory rings,
+    so CPU-bound event handling scales across cores with a single AMI session.
+
+    In the 'partition' mode every event goes to one worker chosen by its key header (Uniqueid by default),
+    so all events of a channel are handled by the same worker in order. In the 'broadcast' mode every
+    worker gets every event. When a ring is full the fan-out waits for the worker, the events pile up
+    in the dispatch buffer of the client and its overflow policy applies (see configure_dispatch).
+    """
+
+    def __init__(self, client: Any, workers: int = 4, mode: str = 'partition', key: str = 'Uniqueid',
+                 ring_size: int = 4 * 1024 * 1024, event_name: str = '*',
+                 filters: Optional[Dict[str, FilterValue]] = None):
+        """
+        Initializes the fan-out
+
+        :param client: The client receiving the events
+        :param workers: The number of worker processes
+        :param mode: 'partition' or 'broadcast'
+        :param key: The header partitioning the events
+        :param ring_size: The size of the ring of every worker in bytes
+        :param event_name: The name of the events to pass to the workers ('*' for all events)
+        :param filters: The header filters of the events to pass to the workers
+        :raises ValueError: If the mode is unknown or there are no workers
+        """
+        if mode not in FANOUT_MODES:
+            raise ValueError(f'Unknown fan-out mode "{mode}", use one of {", ".join(FANOUT_MODES)}')
+        if workers < 1:
+            raise ValueError('The fan-out requires at least one worker')
+        self.logger = logging.getLogger('AMI Fanout')
+        self._client = client
+        self.workers = workers
+        self.mode = mode
+        self.key = key
+        self.ring_size = ring_size
+        self._event_name = event_name
+        self._filters = filters
+        self._rings: List[RingBuffer] = []
+        self.processes: List[multiprocessing.Process] = []
+        self.published = 0
+        self.dropped = 0
+
+    @property
+    def names(self) -> List[str]:
+        """
+        :return: The names of the shared memory of the rings, one per worker
+        """
+        return [ring.name for ring in self._rings]
+
+    async def start(self) -> None:
+        """
+        Creates the rings and subscribes to the events of the client
+
+        :return: None
+        """
+        self._rings = [RingBuffer.create(self.ring_size) for _ in range(self.workers)]
+        # One run at a time keeps the events in order and passes the backpressure of full rings to the client
+        await self._client.register_callback(self._event_name, self._publish, self._filters, max_concurrency=1)
+
+    def spawn(self, setup: Callable[[EventWorker], Awaitable[None]]) -> List[multiprocessing.Process]:
+        """
+        Starts a worker process per ring. In every process an EventWorker is created and passed
+        to setup, which registers the callbacks, then the worker runs until the fan-out is stopped.
+
+        :param setup: The async function registering the callbacks, it must be importable by the workers
+        :return: The processes
+        """
+        context = multiprocessing.get_context('spawn')
+        for index, name in enumerate(self.names):
+            process = context.Process(target=_worker_main, args=(name, index, setup), daemon=True,
+                                      name=f'ami-worker-{index}')
+            process.start()
+            self.processes.append(process)
+        return self.processes
+
+    async def stop(self, timeout: float = 10) -> None:
+        """
+        Unsubscribes from the events, lets the workers finish the remaining events and destroys the rings
+
+        :param timeout: Seconds to wait for every worker process
+        :return: None
+        """
+        await self._client.unregister_callback(self._event_name, self._publish)
+        for ring in self._rings:
+            ring.close()
+        loop = asyncio.get_event_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                self.logger.warning(f"Worker {process.name} did not stop in {timeout} seconds")
+                process.terminate()
+        self.processes.clear()
+        for ring in self._rings:
+            ring.release()
+        self._rings.clear()
+
+    async def _publish(self, event: dict, _client: Any) -> None:
+        data = encode_event(event)
+        if self.mode == 'broadcast':
+            rings = self._rings
+        else:
+            rings = (self._rings[hash(event.get(self.key)) % len(self._rings)],)
+        for ring in rings:
+            delay = 0
+            try:
+                while not ring.write(data):
+                    delay = min(delay * 2 or 0.0001, 0.01)
+                    await asyncio.sleep(delay)
+            except ValueError as e:
+                self.dropped += 1
+                self.logger.warning(f"Event '{event.get('Event')}' dropped: {e}")
+                return
+        self.published += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: The counters of the fan-out and the number of bytes queued in every ring
+        """
+        stats = {'published': self.published, 'dropped': self.dropped}
+        for index, ring in enumerate(self._rings):
+            stats[f'ring_{index}'] = len(ring)
+        return stats
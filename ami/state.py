@@ -0,0 +1,335 @@
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set
+
+
+def _parse_duration(duration: str) -> float:
+    try:
+        hours, minutes, seconds = (int(part) for part in duration.split(':'))
+    except ValueError:
+        return 0
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class Channel:
+    """ The state of a live channel """
+    __slots__ = ('uniqueid', 'linkedid', 'channel', 'state', 'state_desc', 'caller_id_num', 'caller_id_name',
+                 'connected_line_num', 'connected_line_name', 'language', 'account_code', 'context', 'exten',
+                 'priority', 'application', 'application_data', 'bridge_id', 'created')
+
+    # Event header -> attribute
+    HEADERS = {
+        'Uniqueid': 'uniqueid',
+        'Linkedid': 'linkedid',
+        'Channel': 'channel',
+        'ChannelState': 'state',
+        'ChannelStateDesc': 'state_desc',
+        'CallerIDNum': 'caller_id_num',
+        'CallerIDName': 'caller_id_name',
+        'ConnectedLineNum': 'connected_line_num',
+        'ConnectedLineName': 'connected_line_name',
+        'Language': 'language',
+        'AccountCode': 'account_code',
+        'Context': 'context',
+        'Exten': 'exten',
+        'Priority': 'priority',
+        'Application': 'application',
+        'ApplicationData': 'application_data',
+        'BridgeId': 'bridge_id',
+    }
+
+    def __init__(self, event: dict, created: Optional[float] = None):
+        for attribute in self.__slots__:
+            setattr(self, attribute, '')
+        self.created = time.time() if created is None else created
+        self.update(event)
+
+    def update(self, event: dict) -> None:
+        """
+        Updates the state from the headers of an event
+
+        :param event: The event
+        :return: None
+        """
+        for header, attribute in self.HEADERS.items():
+            value = event.get(header)
+            if value is not None:
+                setattr(self, attribute, value)
+
+    def to_dict(self) -> dict:
+        """
+        :return: The channel as a CoreShowChannel event
+        """
+        result = {'Event': 'CoreShowChannel'}
+        for header, attribute in self.HEADERS.items():
+            result[header] = getattr(self, attribute)
+        result['Duration'] = _format_duration(time.time() - self.created)
+        return result
+
+    def __repr__(self) -> str:
+        return f"<Channel {self.channel} {self.uniqueid} {self.state_desc}>"
+
+
+class Bridge:
+    """ The state of a live bridge """
+    __slots__ = ('bridge_id', 'bridge_type', 'technology', 'creator', 'name', 'channels')
+
+    def __init__(self, event: dict):
+        self.bridge_id = event.get('BridgeUniqueid', '')
+        self.bridge_type = event.get('BridgeType', '')
+        self.technology = event.get('BridgeTechnology', '')
+        self.creator = event.get('BridgeCreator', '')
+        self.name = event.get('BridgeName', '')
+        self.channels: Set[str] = set()
+
+    def __repr__(self) -> str:
+        return f"<Bridge {self.bridge_id} {len(self.channels)} channels>"
+
+
+class ChannelTracker:
+    """
+    In-memory state of the live channels and bridges of the server.
+
+    The state is seeded from CoreShowChannels and BridgeList and then kept current from
+    Newchannel, Newstate, Hangup, BridgeEnter, BridgeLeave and related events, so lookups and
+    channel lists do not need a request to the server. The events sent while the client was
+    disconnected are lost, so the state is seeded again when the connection is restored.
+    """
+
+    EVENTS = ('Newchannel', 'Newstate', 'NewCallerid', 'NewConnectedLine', 'NewAccountCode', 'Newexten',
+              'Rename', 'Hangup', 'BridgeCreate', 'BridgeDestroy', 'BridgeEnter', 'BridgeLeave')
+
+    def __init__(self, client: Any):
+        """
+        Initializes the tracker
+
+        :param client: The client to track the channels of
+        """
+        self._client = client
+        self._channels: Dict[str, Channel] = {}
+        self._by_name: Dict[str, Channel] = {}
+        self._by_linkedid: Dict[str, Dict[str, Channel]] = {}
+        self._bridges: Dict[str, Bridge] = {}
+        # The Uniqueids and BridgeUniqueids created and removed while the state is loaded from the server
+        self._created: Optional[Set[str]] = None
+        self._hung_up: Optional[Set[str]] = None
+        self._watching = False
+        self.logger = logging.getLogger('AMI Channels')
+        self.running = False
+        # False until the state is loaded and while the connection is lost
+        self.synced = False
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    async def start(self) -> None:
+        """
+        Subscribes to the channel events and seeds the state from the server
+
+        :return: None
+        """
+        for event_name in self.EVENTS:
+            await self._client.register_callback(event_name, self._on_event)
+        if not self._watching:
+            await self._client.register_state_callback(self._on_state)
+            self._watching = True
+        self.running = True
+        await self.refresh()
+
+    async def stop(self) -> None:
+        """
+        Unsubscribes from the channel events and drops the state
+
+        :return: None
+        """
+        for event_name in self.EVENTS:
+            await self._client.unregister_callback(event_name, self._on_event)
+        self.running = False
+        self.synced = False
+        self.clear()
+
+    def clear(self) -> None:
+        self._channels.clear()
+        self._by_name.clear()
+        self._by_linkedid.clear()
+        self._bridges.clear()
+
+    async def refresh(self) -> None:
+        """
+        Loads the channels and bridges from the server: the ones already known keep their state,
+        the ones missing from the server are dropped
+
+        :return: None
+        """
+        # Events received while loading are newer than the snapshot: channels and bridges created meanwhile
+        # are kept, the ones removed meanwhile are not restored
+        self._created, self._hung_up = set(), set()
+        try:
+            channels = await self._client.ami_request({"Action": "CoreShowChannels"})
+            bridges = await self._client.ami_request({"Action": "BridgeList"})
+        finally:
+            created, hung_up = self._created, self._hung_up
+            self._created = self._hung_up = None
+
+        listed = set()
+        for event in channels:
+            if event.get('Event') != 'CoreShowChannel':
+                continue
+            uniqueid = event.get('Uniqueid')
+            listed.add(uniqueid)
+            if uniqueid in self._channels or uniqueid in hung_up:
+                continue
+            created_at = time.time() - _parse_duration(event.get('Duration', ''))
+            self._add(Channel(event, created_at))
+        for uniqueid, channel in list(self._channels.items()):
+            if uniqueid not in listed and uniqueid not in created:
+                self._remove(channel)
+
+        listed = set()
+        for event in bridges:
+            if event.get('Event') != 'BridgeListItem':
+                continue
+            bridge_id = event.get('BridgeUniqueid')
+            listed.add(bridge_id)
+            if bridge_id not in self._bridges and bridge_id not in hung_up:
+                self._bridges[bridge_id] = Bridge(event)
+        for bridge_id in list(self._bridges):
+            if bridge_id not in listed and bridge_id not in created:
+                del self._bridges[bridge_id]
+        for channel in self._channels.values():
+            bridge = self._bridges.get(channel.bridge_id)
+            if bridge is not None:
+                bridge.channels.add(channel.uniqueid)
+        self.synced = True
+
+    def get(self, uniqueid: str) -> Optional[Channel]:
+        """
+        :param uniqueid: The Uniqueid of the channel
+        :return: The channel or None
+        """
+        return self._channels.get(uniqueid)
+
+    def by_name(self, channel: str) -> Optional[Channel]:
+        """
+        :param channel: The name of the channel, e.g. PJSIP/100-0000002a
+        :return: The channel or None
+        """
+        return self._by_name.get(channel)
+
+    def by_linkedid(self, linkedid: str) -> List[Channel]:
+        """
+        :param linkedid: The Linkedid of the call
+        :return: The channels of the call
+        """
+        return list(self._by_linkedid.get(linkedid, {}).values())
+
+    def bridge(self, bridge_id: str) -> Optional[Bridge]:
+        """
+        :param bridge_id: The BridgeUniqueid of the bridge
+        :return: The bridge or None
+        """
+        return self._bridges.get(bridge_id)
+
+    @property
+    def bridges(self) -> List[Bridge]:
+        return list(self._bridges.values())
+
+    def channels(self) -> List[dict]:
+        """
+        Builds the response of CoreShowChannels from the tracked state
+
+        :return: The list of dictionaries in the format of the server response
+        """
+        response = [{"Response": "Success", "EventList": "start", "Message": "Channels will follow"}]
+        response.extend(channel.to_dict() for channel in self._channels.values())
+        response.append({"Event": "CoreShowChannelsComplete", "EventList": "Complete",
+                         "ListItems": str(len(self._channels))})
+        return response
+
+    def _add(self, channel: Channel) -> None:
+        self._channels[channel.uniqueid] = channel
+        self._by_name[channel.channel] = channel
+        self._by_linkedid.setdefault(channel.linkedid, {})[channel.uniqueid] = channel
+
+    def _remove(self, channel: Channel) -> None:
+        self._channels.pop(channel.uniqueid, None)
+        if self._by_name.get(channel.channel) is channel:
+            del self._by_name[channel.channel]
+        linked = self._by_linkedid.get(channel.linkedid)
+        if linked is not None:
+            linked.pop(channel.uniqueid, None)
+            if not linked:
+                del self._by_linkedid[channel.linkedid]
+        bridge = self._bridges.get(channel.bridge_id)
+        if bridge is not None:
+            bridge.channels.discard(channel.uniqueid)
+
+    async def _on_event(self, event: dict, _client: Any) -> None:
+        name = event.get('Event')
+        if name.startswith('Bridge'):
+            self._on_bridge_event(name, event)
+            return
+
+        uniqueid = event.get('Uniqueid')
+        channel = self._channels.get(uniqueid)
+        if name == 'Newchannel':
+            if channel is None:
+                self._add(Channel(event))
+            if self._created is not None:
+                self._created.add(uniqueid)
+        elif name == 'Hangup':
+            if channel is not None:
+                self._remove(channel)
+            if self._hung_up is not None:
+                self._hung_up.add(uniqueid)
+        elif channel is not None:
+            if name == 'Rename':
+                if self._by_name.get(channel.channel) is channel:
+                    del self._by_name[channel.channel]
+                channel.channel = event.get('Newname', channel.channel)
+                self._by_name[channel.channel] = channel
+            else:
+                channel.update(event)
+
+    def _on_bridge_event(self, name: str, event: dict) -> None:
+        bridge_id = event.get('BridgeUniqueid')
+        bridge = self._bridges.get(bridge_id)
+        if name == 'BridgeCreate':
+            if bridge is None:
+                self._bridges[bridge_id] = Bridge(event)
+            if self._created is not None:
+                self._created.add(bridge_id)
+        elif name == 'BridgeDestroy':
+            self._bridges.pop(bridge_id, None)
+            if self._hung_up is not None:
+                self._hung_up.add(bridge_id)
+        else:
+            if bridge is None:
+                bridge = self._bridges[bridge_id] = Bridge(event)
+                if self._created is not None:
+                    self._created.add(bridge_id)
+            channel = self._channels.get(event.get('Uniqueid'))
+            if name == 'BridgeEnter':
+                bridge.channels.add(event.get('Uniqueid'))
+                if channel is not None:
+                    channel.bridge_id = bridge_id
+            else:
+                bridge.channels.discard(event.get('Uniqueid'))
+                if channel is not None and channel.bridge_id == bridge_id:
+                    channel.bridge_id = ''
+
+    async def _on_state(self, state: str, _client: Any) -> None:
+        if not self.running:
+            return
+        if state != 'connected':
+            self.synced = False
+        elif not self.synced:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.logger.warning('Failed to reload the channels after reconnecting: %r', e)
@@ -0,0 +1,107 @@
+import asyncio
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from ami.dispatch import CoalesceKey, EventBuffer
+from ami.routing import EventRouter, FilterValue, Handler
+
+
+class EventStream:
+    """
+    Async iterator over batches of events, for consumers that process events in bulk
+    (e.g. inserting them into a database).
+
+    The stream has its own bounded buffer filled by the dispatcher without starting tasks,
+    so a slow consumer only loses or coalesces its own events and does not delay the callbacks
+    and the other streams. With the 'block' policy the dispatcher waits for free space instead.
+    """
+
+    def __init__(self, router: EventRouter, names: Union[str, Iterable[str]] = '*', max_batch: int = 500,
+                 max_wait: float = 0.05, max_size: int = 10000, overflow: str = 'drop_oldest',
+                 coalesce_key: Optional[CoalesceKey] = None, filters: Optional[Dict[str, FilterValue]] = None):
+        """
+        Initializes the stream and subscribes it to the events
+
+        :param router: The routing table of the client
+        :param names: The name or names of the events ('*' for all events)
+        :param max_batch: The maximum number of events in a batch
+        :param max_wait: Seconds to wait for more events after the first event of a batch
+        :param max_size: The maximum number of buffered events
+        :param overflow: The overflow policy of the buffer (see EventBuffer)
+        :param coalesce_key: The header name or function giving the key of an event for the 'coalesce' policy
+        :param filters: The header filters the events must match
+        :raises ValueError: If max_batch is not positive or the policy is invalid
+        """
+        if max_batch < 1:
+            raise ValueError('max_batch must be positive')
+        self.buffer = EventBuffer(max_size, overflow, coalesce_key)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.names = [names] if isinstance(names, str) else list(names)
+        self._router = router
+        if overflow == 'block':
+            # One put at a time keeps the order while the dispatcher waits for free space
+            self._handlers = [Handler(name, self._put, filters, max_concurrency=1) for name in self.names]
+        else:
+            self._handlers = [Handler(name, self._put_nowait, filters, inline=True) for name in self.names]
+        for handler in self._handlers:
+            router.add(handler)
+
+    @property
+    def dropped(self) -> int:
+        return self.buffer.dropped
+
+    @property
+    def closed(self) -> bool:
+        return self._handlers is None
+
+    def _put_nowait(self, event: dict, _client: Any) -> None:
+        self.buffer.put_nowait(event)
+
+    async def _put(self, event: dict, _client: Any) -> None:
+        await self.buffer.put(event)
+
+    def close(self) -> None:
+        """
+        Unsubscribes the stream, the iteration ends after the buffered events are read
+
+        :return: None
+        """
+        if self._handlers is None:
+            return
+        for name in self.names:
+            self._router.remove(name, self._put if self.buffer.overflow == 'block' else self._put_nowait)
+        self._handlers = None
+        self.buffer.close()
+
+    def __aiter__(self) -> 'EventStream':
+        return self
+
+    async def __anext__(self) -> List[dict]:
+        event = await self.buffer.get()
+        if event is None:
+            raise StopAsyncIteration
+        batch = [event]
+        loop = asyncio.get_event_loop()
+        expires = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            event = self.buffer.get_nowait()
+            if event is not None:
+                batch.append(event)
+                continue
+            remaining = expires - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                event = await asyncio.wait_for(self.buffer.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if event is None:
+                break
+            batch.append(event)
+        return batch
+
+    async def __aenter__(self) -> 'EventStream':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
@@ -0,0 +1,48 @@
+import asyncio
+import contextlib
+import contextvars
+import math
+import time
+from typing import Iterator, Optional
+
+_deadline: contextvars.ContextVar = contextvars.ContextVar('ami_deadline', default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds: float) -> Iterator[None]:
+    """
+    Limits the total time of all requests made in the block, including the requests made by tasks
+    started in it. Nested deadlines can only make the limit shorter.
+
+    with deadline(2):
+        await client.ping()
+        await client.channels()
+
+    :param seconds: The time limit
+    """
+    expires = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(expires if current is None else min(current, expires))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def effective_timeout(timeout: Optional[float]) -> Optional[float]:
+    """
+    Combines the timeout of a request with the current deadline
+
+    :param timeout: The timeout of the request in seconds, None or math.inf for no limit
+    :return: The time left for the request or None if it is not limited
+    :raises asyncio.TimeoutError: If the deadline has already expired
+    """
+    if timeout is not None and math.isinf(timeout):
+        timeout = None
+    expires = _deadline.get()
+    if expires is not None:
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError('The deadline has expired')
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    return timeout
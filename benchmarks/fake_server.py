@@ -0,0 +1,292 @@
+"""
+Deterministic in-process fake of the Asterisk Manager Interface for benchmarks.
+
+Serves the TCP protocol (as on port 5038) and the HTTP /rawman endpoint from the same event loop:
+Login/Logoff, Ping, Events, Filter, Getvar, Originate (with the OriginateResponse event),
+CoreShowChannels and BridgeList as EventLists, WaitEvent for HTTP sessions and scripted event floods.
+Replies are sent immediately and the generated data depends only on the arguments, so runs
+are comparable with each other.
+
+Usage:
+    server = FakeAMIServer(channels=100)
+    await server.start()
+    client = TCPClient('127.0.0.1', server.tcp_port)
+    ...
+    await server.flood(100000)
+    await server.stop()
+
+Or standalone: PYTHONPATH=. python benchmarks/fake_server.py [tcp_port] [http_port]
+"""
+import asyncio
+import itertools
+import sys
+import uuid
+from typing import Callable, Dict, List, Optional, Set
+
+from aiohttp import web
+
+from ami.parser import FrameParser
+
+Action = Callable[[dict, 'Session'], List[dict]]
+
+
+def encode(messages: List[dict]) -> bytes:
+    # A list value is sent as a repeated header, like the Output lines of Command
+    return ''.join(
+        ''.join(f"{key}: {item}\r\n" for key, value in message.items()
+                for item in (value if isinstance(value, list) else (value,))) + '\r\n' for message in messages
+    ).encode('utf8')
+
+
+def newstate(n: int, channels: int) -> dict:
+    """ The n-th event of a flood, cycling over the channels """
+    channel = n % channels
+    return {
+        'Event': 'Newstate',
+        'Privilege': 'call,all',
+        'Channel': f'PJSIP/{100 + channel}-{channel:08x}',
+        'ChannelState': '6',
+        'ChannelStateDesc': 'Up',
+        'CallerIDNum': str(100 + channel),
+        'CallerIDName': f'Operator {channel}',
+        'ConnectedLineNum': '89999999999',
+        'ConnectedLineName': '<unknown>',
+        'Language': 'en',
+        'AccountCode': '',
+        'Context': 'from-internal',
+        'Exten': '89999999999',
+        'Priority': '1',
+        'Uniqueid': f'1694584278.{channel}',
+        'Linkedid': f'1694584278.{channel}',
+        'Seq': str(n),
+    }
+
+
+class Session:
+    """ A logged-in manager session, over TCP or HTTP """
+
+    def __init__(self, writer: Optional[asyncio.StreamWriter] = None):
+        self.writer = writer
+        self.authenticated = False
+        # HTTP sessions keep the events until WaitEvent
+        self.events: List[dict] = []
+        self.waiter: Optional[asyncio.Future] = None
+
+    def send(self, messages: List[dict]) -> None:
+        if self.writer is not None:
+            self.writer.write(encode(messages))
+            return
+        self.events.extend(messages)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+class FakeAMIServer:
+    def __init__(self, username: str = 'admin', secret: str = 'secret', channels: int = 100):
+        """
+        :param username: The accepted username
+        :param secret: The accepted secret
+        :param channels: The number of channels listed by CoreShowChannels and cycled by floods
+        """
+        self.username = username
+        self.secret = secret
+        self.channels = channels
+        self.tcp_port: Optional[int] = None
+        self.http_port: Optional[int] = None
+        self.sessions: Set[Session] = set()
+        self._http_sessions: Dict[str, Session] = {}
+        self._tcp_server: Optional[asyncio.AbstractServer] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._ids = itertools.count(1)
+        self.actions: Dict[str, Action] = {
+            'login': self._login,
+            'logoff': lambda query, session: [{'Response': 'Goodbye', 'Message': 'Thanks for all the fish.'}],
+            'ping': lambda query, session: [{'Response': 'Success', 'Ping': 'Pong', 'Timestamp': '1694584278.000000'}],
+            'events': lambda query, session: [{'Response': 'Success', 'Events': 'On'}],
+            'filter': lambda query, session: [{'Response': 'Success', 'Message': 'Filter Added Successfully'}],
+            'getvar': lambda query, session: [{'Response': 'Success', 'Variable': query.get('variable', ''),
+                                               'Value': f"value-{query.get('variable', '')}"}],
+            'originate': self._originate,
+            'coreshowchannels': self._core_show_channels,
+            'bridgelist': lambda query, session: [
+                {'Response': 'Success', 'EventList': 'start', 'Message': 'Bridge listing will follow'},
+                {'Event': 'BridgeListComplete', 'EventList': 'Complete', 'ListItems': '0'}],
+            'command': self._command,
+        }
+
+    async def start(self, host: str = '127.0.0.1', tcp_port: int = 0, http_port: int = 0) -> None:
+        """
+        Starts listening, port 0 takes a free port (see tcp_port and http_port)
+
+        :return: None
+        """
+        self._tcp_server = await asyncio.start_server(self._handle_tcp, host, tcp_port)
+        self.tcp_port = self._tcp_server.sockets[0].getsockname()[1]
+        app = web.Application()
+        app.router.add_get('/rawman', self._handle_rawman)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, http_port)
+        await site.start()
+        self.http_port = self._runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        for session in list(self.sessions):
+            if session.writer is not None:
+                session.writer.close()
+            elif session.waiter is not None and not session.waiter.done():
+                # Ends the WaitEvent long polls, the HTTP server waits for its handlers
+                session.waiter.set_result(None)
+        self._tcp_server.close()
+        await self._tcp_server.wait_closed()
+        await self._runner.cleanup()
+
+    def disconnect(self) -> None:
+        """
+        Drops the TCP connections, as a restart of Asterisk would
+
+        :return: None
+        """
+        for session in list(self.sessions):
+            if session.writer is not None:
+                session.writer.close()
+
+    def reply(self, query: dict, session: Session) -> List[dict]:
+        """
+        :param query: The action with the header names in lower case, like Asterisk looks them up
+        :param session: The session of the client
+        :return: The messages of the response
+        """
+        action = query.get('action', '').lower()
+        handler = self.actions.get(action)
+        if handler is None:
+            response = [{'Response': 'Error', 'Message': 'Invalid/unknown command'}]
+        elif not session.authenticated and action != 'login':
+            response = [{'Response': 'Error', 'Message': 'Permission denied'}]
+        else:
+            response = handler(query, session)
+        if 'actionid' in query:
+            for message in response:
+                message['ActionID'] = query['actionid']
+        return response
+
+    def _login(self, query: dict, session: Session) -> List[dict]:
+        # Asterisk matches the user name case-insensitively and the secret exactly
+        if query.get('username', '').lower() == self.username.lower() and query.get('secret') == self.secret:
+            session.authenticated = True
+            return [{'Response': 'Success', 'Message': 'Authentication accepted'}]
+        return [{'Response': 'Error', 'Message': 'Authentication failed'}]
+
+    def _originate(self, query: dict, session: Session) -> List[dict]:
+        event = {'Event': 'OriginateResponse', 'Response': 'Success', 'Channel': query.get('channel', ''),
+                 'Reason': '4', 'Uniqueid': f'1694584279.{next(self._ids)}'}
+        if 'actionid' in query:
+            event['ActionID'] = query['actionid']
+        asyncio.get_event_loop().call_soon(session.send, [event])
+        return [{'Response': 'Success', 'Message': 'Originate successfully queued'}]
+
+    def _core_show_channels(self, query: dict, session: Session) -> List[dict]:
+        response = [{'Response': 'Success', 'EventList': 'start', 'Message': 'Channels will follow'}]
+        for n in range(self.channels):
+            event = newstate(n, self.channels)
+            event['Event'] = 'CoreShowChannel'
+            response.append(event)
+        response.append({'Event': 'CoreShowChannelsComplete', 'EventList': 'Complete',
+                         'ListItems': str(self.channels)})
+        return response
+
+    def _command(self, query: dict, session: Session) -> List[dict]:
+        if ' '.join(query.get('command', '').lower().split()) != 'core show channels concise':
+            return [{'Response': 'Error', 'Message': 'Command output follows', 'Output': 'No such command'}]
+        output = []
+        for n in range(self.channels):
+            event = newstate(n, self.channels)
+            output.append(f"{event['Channel']}!{event['Context']}!{event['Exten']}!{event['Priority']}!"
+                          f"{event['ChannelStateDesc']}!!!{event['CallerIDNum']}!!!3!1!!{event['Uniqueid']}")
+        return [{'Response': 'Success', 'Message': 'Command output follows', 'Output': output}]
+
+    async def flood(self, count: int, chunk: int = 1000) -> None:
+        """
+        Sends Newstate events to every logged-in session
+
+        :param count: The number of events
+        :param chunk: The number of events written at once
+        :return: None
+        """
+        for start in range(0, count, chunk):
+            events = [newstate(n, self.channels) for n in range(start, min(start + chunk, count))]
+            for session in list(self.sessions):
+                if session.authenticated:
+                    session.send(events)
+                    if session.writer is not None:
+                        await session.writer.drain()
+            await asyncio.sleep(0)
+
+    async def _handle_tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = Session(writer)
+        self.sessions.add(session)
+        parser = FrameParser('utf8')
+        writer.write(b'Asterisk Call Manager/7.0.3\r\n')
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for message in parser.feed(data):
+                    query = {key.lower(): value for key, value in message.items()}
+                    session.send(self.reply(query, session))
+                    if query.get('action', '').lower() == 'logoff':
+                        await writer.drain()
+                        writer.close()
+                        return
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    async def _handle_rawman(self, request: web.Request) -> web.Response:
+        query = {key.lower(): value for key, value in request.query.items()}
+        session_id = request.cookies.get('mansession_id')
+        session = self._http_sessions.get(session_id)
+        if session is None:
+            session_id = uuid.uuid4().hex
+            session = self._http_sessions[session_id] = Session()
+            self.sessions.add(session)
+        if query.get('action', '').lower() == 'waitevent' and session.authenticated:
+            response = await self._wait_event(session, float(query.get('timeout', -1)))
+        else:
+            response = self.reply(query, session)
+        if query.get('action', '').lower() == 'logoff':
+            self.sessions.discard(session)
+            self._http_sessions.pop(session_id, None)
+        result = web.Response(body=encode(response), content_type='text/plain')
+        result.set_cookie('mansession_id', session_id)
+        return result
+
+    @staticmethod
+    async def _wait_event(session: Session, timeout: float) -> List[dict]:
+        if not session.events:
+            session.waiter = asyncio.get_event_loop().create_future()
+            try:
+                await asyncio.wait_for(session.waiter, None if timeout < 0 else timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                session.waiter = None
+        events, session.events = session.events, []
+        return [{'Response': 'Success', 'Message': 'Waiting for Event completed.'}] + events + \
+            [{'Event': 'WaitEventComplete'}]
+
+
+async def main() -> None:
+    server = FakeAMIServer()
+    await server.start(tcp_port=int(sys.argv[1]) if len(sys.argv) > 1 else 5038,
+                       http_port=int(sys.argv[2]) if len(sys.argv) > 2 else 8088)
+    print(f"Fake AMI on tcp {server.tcp_port} and http {server.http_port}, login {server.username}/{server.secret}")
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,119 @@
+"""
+Micro-benchmark of the TCP read path: the line-by-line reader used before FrameParser
+versus the chunked FrameParser. Both read the same event flood from a loopback TCP connection.
+
+Usage: PYTHONPATH=. python benchmarks/frame_parser.py [messages]
+"""
+import asyncio
+import sys
+import time
+from typing import Tuple
+
+from ami.parser import FrameParser
+
+EVENT = (
+    "Event: Newstate\r\n"
+    "Privilege: call,all\r\n"
+    "Channel: PJSIP/100-0000002a\r\n"
+    "ChannelState: 6\r\n"
+    "ChannelStateDesc: Up\r\n"
+    "CallerIDNum: 100\r\n"
+    "CallerIDName: Operator\r\n"
+    "ConnectedLineNum: 89999999999\r\n"
+    "ConnectedLineName: <unknown>\r\n"
+    "Language: ru\r\n"
+    "AccountCode: \r\n"
+    "Context: from-internal\r\n"
+    "Exten: 89999999999\r\n"
+    "Priority: 1\r\n"
+    "Uniqueid: 1694584278.23846\r\n"
+    "Linkedid: 1694584277.23843\r\n"
+    "\r\n"
+).encode('windows-1251')
+
+
+async def open_flood(data: bytes) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """ Starts a loopback server that writes the data and closes the connection """
+    async def flood(_, writer):
+        writer.write(data)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(flood, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    connection = await asyncio.open_connection('127.0.0.1', port)
+    server.close()
+    return connection
+
+
+async def legacy_path(data: bytes) -> int:
+    """ readline() with a timeout per line, a queue of line lists and a separate dict conversion """
+    reader, writer = await open_flood(data)
+    queue = asyncio.Queue()
+
+    async def receiving():
+        lines = []
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if not line:
+                await queue.put(None)
+                return
+            if not line.strip():
+                await queue.put(lines)
+                lines = []
+                continue
+            lines.append(line.decode('windows-1251', errors='replace').strip())
+
+    task = asyncio.ensure_future(receiving())
+    count = 0
+    while True:
+        lines = await queue.get()
+        if lines is None:
+            break
+        message = {}
+        for row in lines:
+            line = row.split(': ', 1)
+            if len(line) == 2:
+                message[line[0]] = line[1]
+        count += 1
+    await task
+    writer.close()
+    return count
+
+
+async def frame_parser_path(data: bytes) -> int:
+    """ read() of large chunks parsed by FrameParser """
+    reader, writer = await open_flood(data)
+    parser = FrameParser()
+    count = 0
+    while True:
+        chunk = await asyncio.wait_for(reader.read(65536), timeout=5)
+        if not chunk:
+            break
+        for message in parser.feed(chunk):
+            # Messages are split lazily, read the header the client routes by
+            message.get('ActionID')
+            count += 1
+    writer.close()
+    return count
+
+
+def run(name, path, data, expected):
+    started = time.perf_counter()
+    count = asyncio.run(path(data))
+    elapsed = time.perf_counter() - started
+    assert count == expected, (name, count)
+    print(f"{name:<14} {count / elapsed:>12,.0f} messages/sec ({elapsed:.3f}s)")
+    return count / elapsed
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    data = EVENT * messages
+    legacy = run('readline', legacy_path, data, messages)
+    chunked = run('FrameParser', frame_parser_path, data, messages)
+    print(f"speedup: x{chunked / legacy:.1f}")
+
+
+if __name__ == '__main__':
+    main()
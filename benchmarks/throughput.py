@@ -0,0 +1,98 @@
+"""
+Throughput benchmark of TCPClient and HTTPClient against the in-process FakeAMIServer:
+actions per second with p50/p99 latency, and events per second parsed and dispatched to a callback.
+
+Usage: PYTHONPATH=. python benchmarks/throughput.py [--requests N] [--concurrency N] [--events N]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_server import FakeAMIServer  # noqa: E402
+
+from ami.client import HTTPClient, TCPClient  # noqa: E402
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def report(name: str, count: int, elapsed: float, latencies: List[float] = ()) -> None:
+    line = f"{name:<14} {count / elapsed:>12,.0f} /sec ({count} in {elapsed:.3f}s)"
+    if latencies:
+        line += (f"  p50 {percentile(latencies, 0.5) * 1000:.2f}ms  p99 {percentile(latencies, 0.99) * 1000:.2f}ms"
+                 f"  mean {statistics.mean(latencies) * 1000:.2f}ms")
+    print(line)
+
+
+async def actions(client, name: str, requests: int, concurrency: int, action: str = 'ping') -> None:
+    latencies = []
+    call = getattr(client, action)
+
+    async def worker(count: int) -> None:
+        for _ in range(count):
+            started = time.perf_counter()
+            response = await call()
+            latencies.append(time.perf_counter() - started)
+            assert response[0].get('Response') == 'Success', response
+
+    per_worker, extra = divmod(requests, concurrency)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(per_worker + (n < extra)) for n in range(concurrency)))
+    report(name, requests, time.perf_counter() - started, latencies)
+
+
+async def events(client, server: FakeAMIServer, name: str, count: int) -> None:
+    done = asyncio.get_event_loop().create_future()
+    received = 0
+
+    async def on_event(_event: dict, _client) -> None:
+        nonlocal received
+        received += 1
+        if received == count and not done.done():
+            done.set_result(None)
+
+    await client.register_callback('Newstate', on_event)
+    started = time.perf_counter()
+    await server.flood(count)
+    await asyncio.wait_for(done, timeout=max(60, count / 1000))
+    report(name, count, time.perf_counter() - started)
+    await client.unregister_callback('Newstate', on_event)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--events', type=int, default=100000)
+    args = parser.parse_args()
+
+    server = FakeAMIServer()
+    await server.start()
+    try:
+        tcp = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await tcp.connect(server.username, server.secret)
+        await actions(tcp, 'TCP actions', args.requests, args.concurrency)
+        # CoreShowChannels of server.channels channels, an EventList collected by ActionID
+        await actions(tcp, 'TCP EventList', args.requests // 20, args.concurrency, 'channels')
+        await events(tcp, server, 'TCP events', args.events)
+        await tcp.close()
+
+        http = HTTPClient('127.0.0.1', server.http_port)
+        await http.connect(server.username, server.secret)
+        await actions(http, 'HTTP actions', args.requests // 10, args.concurrency)
+        await events(http, server, 'HTTP events', args.events)
+        await http.close()
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
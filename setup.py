@@ -6,7 +6,6 @@ with open("README.pypi.md", "r", encoding='UTF-8') as f:
 
 classifiers = [
     "Programming Language :: Python :: 3",
-    "Programming Language :: Python :: 3.7",
     "Programming Language :: Python :: 3.8",
     "Programming Language :: Python :: 3.9",
     "Programming Language :: Python :: 3.10",
@@ -35,5 +34,5 @@ setup(
     classifiers=classifiers,
     keywords=' '.join(keywords),
     install_requires=['aiohttp'],
-    python_requires='>=3.7'
+    python_requires='>=3.8'
 )
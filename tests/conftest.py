@@ -0,0 +1,29 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from fake_server import FakeAMIServer  # noqa: E402
+
+
+@pytest.fixture
+def run():
+    """
+    Runs a scenario against a started FakeAMIServer: run(scenario, **server_options),
+    where scenario is an async function taking the server
+    """
+    def run(scenario, timeout: float = 10, **options):
+        async def main():
+            server = FakeAMIServer(**options)
+            await server.start()
+            try:
+                return await asyncio.wait_for(scenario(server), timeout)
+            finally:
+                await server.stop()
+        return asyncio.run(main())
+    return run
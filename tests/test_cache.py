@@ -0,0 +1,78 @@
+import asyncio
+import gc
+
+from ami.client import TCPClient
+
+
+def delayed_getvar(delay: float):
+    def getvar(query, session):
+        response = {'Response': 'Success', 'Variable': query.get('variable'), 'Value': 'late',
+                    'ActionID': query.get('actionid')}
+        asyncio.get_event_loop().call_later(delay, session.send, [response])
+        return []
+    return getvar
+
+
+async def connected(server) -> TCPClient:
+    client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+    await client.connect('admin', 'secret')
+    client.enable_cache()
+    return client
+
+
+def test_hits_and_coalescing(run):
+    async def scenario(server):
+        client = await connected(server)
+        query = {'Action': 'Getvar', 'Variable': 'A'}
+        try:
+            first, second = await asyncio.gather(client.ami_request(query), client.ami_request(query))
+            third = await client.ami_request(query)
+            await client.ami_request({'Action': 'Setvar', 'Variable': 'A', 'Value': '1'})
+            await client.ami_request(query)
+        finally:
+            await client.close()
+        assert first == second == third
+        assert client.cache.stats() == {'entries': 1, 'hits': 1, 'misses': 2, 'coalesced': 1}
+
+    run(scenario)
+
+
+def test_invalidation_during_fill(run):
+    async def scenario(server):
+        server.actions['getvar'] = delayed_getvar(0.05)
+        client = await connected(server)
+        query = {'Action': 'Getvar', 'Variable': 'A'}
+        try:
+            request = asyncio.get_event_loop().create_task(client.ami_request(query))
+            await asyncio.sleep(0.01)
+            client.cache.invalidate('Getvar')
+            response = await request
+        finally:
+            await client.close()
+        assert response[0]['Value'] == 'late'
+        # The response requested before the invalidation is not stored
+        assert len(client.cache) == 0
+
+    run(scenario)
+
+
+def test_fill_error_without_waiters_is_consumed(run):
+    errors = []
+
+    async def scenario(server):
+        asyncio.get_event_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        server.actions['getvar'] = delayed_getvar(1)
+        client = await connected(server)
+        try:
+            try:
+                await asyncio.wait_for(client.ami_request({'Action': 'Getvar', 'Variable': 'A'}, 0.05), 0.01)
+            except asyncio.TimeoutError:
+                pass
+            # The fill fails with nobody waiting for it
+            await asyncio.sleep(0.1)
+        finally:
+            await client.close()
+        gc.collect()
+
+    run(scenario)
+    assert errors == []
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from ami import cli
+from ami.client import TCPClient
+
+
+async def lines(*values):
+    for value in values:
+        yield value
+
+
+async def collect(rows):
+    return [row async for row in rows]
+
+
+def test_command(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await client.connect('admin', 'secret')
+        try:
+            output = await collect(client.command('core show channels concise'))
+            rows = await collect(client.command('core  show channels concise', parse=True))
+            with pytest.raises(ValueError):
+                client.command('core show uptime', parse=True)
+        finally:
+            await client.close()
+        return output, rows
+
+    output, rows = run(scenario, channels=3)
+    assert len(output) == 3
+    assert output[0].startswith('PJSIP/100-00000000!from-internal!')
+    assert [row['channel'] for row in rows] == ['PJSIP/100-00000000', 'PJSIP/101-00000001', 'PJSIP/102-00000002']
+    assert rows[1]['state'] == 'Up'
+    assert rows[1]['uniqueid'] == '1694584278.1'
+
+
+def test_parser_for():
+    assert cli.parser_for('Core Show Channels') is cli.fixed_width
+    assert cli.parser_for('core show channels concise') is cli.PARSERS['core show channels concise']
+    assert cli.parser_for('pjsip show endpoints 100') is cli.PARSERS['pjsip show endpoints']
+    assert cli.parser_for('core show channelsx') is None
+
+
+def test_fixed_width():
+    output = lines('Channel              Location             State   Application(Data)',
+                   'PJSIP/100-00000001   s@from-internal:1    Up      Dial(PJSIP/101)',
+                   'PJSIP/101-00000002   (None)               Ring    AppDial((Outgoing Line))',
+                   '2 active channels',
+                   '1 active call')
+    rows = asyncio.run(collect(cli.fixed_width(output)))
+    assert rows == [
+        {'Channel': 'PJSIP/100-00000001', 'Location': 's@from-internal:1', 'State': 'Up',
+         'Application(Data)': 'Dial(PJSIP/101)'},
+        {'Channel': 'PJSIP/101-00000002', 'Location': '(None)', 'State': 'Ring',
+         'Application(Data)': 'AppDial((Outgoing Line))'},
+    ]
+
+
+def test_pjsip_objects():
+    output = lines(' Contact:  <Aor/ContactUri..............................> <Hash....> <Status> <RTT(ms)..>',
+                   '==========================================================================================',
+                   '  Contact:  100/sip:100@10.0.0.2:5060                    4a1e35c5d1 Avail        12.345',
+                   '',
+                   'Objects found: 1')
+    rows = asyncio.run(collect(cli.PARSERS['pjsip show contacts'](output)))
+    assert rows == [{'contact': '100/sip:100@10.0.0.2:5060', 'hash': '4a1e35c5d1', 'status': 'Avail',
+                     'rtt': '12.345'}]
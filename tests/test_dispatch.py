@@ -0,0 +1,268 @@
+import asyncio
+from typing import Tuple
+
+import pytest
+
+from ami.client import TCPClient
+from ami.dispatch import EventBuffer, EventDispatcher
+from ami.routing import EventRouter, Handler
+
+
+def test_inline_handler_exception_is_counted():
+    async def main():
+        router = EventRouter()
+        dispatcher = EventDispatcher(None, router)
+        received = []
+
+        def broken(event, _client):
+            raise RuntimeError('broken')
+
+        router.add(Handler('Newstate', broken, inline=True))
+        router.add(Handler('Newstate', lambda event, _client: received.append(event['Seq']), inline=True))
+        runner = asyncio.get_event_loop().create_task(dispatcher.run())
+        for n in range(3):
+            await dispatcher.put({'Event': 'Newstate', 'Seq': str(n)})
+        await asyncio.sleep(0.01)
+        dispatcher.stop()
+        await runner
+        return dispatcher.stats(), received
+
+    stats, received = asyncio.run(main())
+    assert received == ['0', '1', '2']
+    assert stats['errors'] == 3
+    assert stats['dispatched'] == 3
+
+
+def test_overflow_drop_newest():
+    async def main():
+        dispatcher = EventDispatcher(None, EventRouter(), maxsize=2, overflow='drop_newest')
+        for n in range(5):
+            await dispatcher.put({'Event': 'Newstate', 'Seq': str(n)})
+        return dispatcher.stats()
+
+    stats = asyncio.run(main())
+    assert stats['queued'] == 2
+    assert stats['dropped'] == 3
+
+
+def test_unregister_stops_ordered_workers(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await client.connect('admin', 'secret')
+        received = []
+
+        async def on_newstate(event, _client):
+            received.append(event['Seq'])
+
+        try:
+            await client.register_callback('Newstate', on_newstate, ordered_by='Uniqueid', workers=2)
+            await server.flood(10)
+            while len(received) < 10:
+                await asyncio.sleep(0.01)
+            assert len(client._dispatcher._ordered) == 1
+            workers = next(iter(client._dispatcher._ordered.values()))
+            await client.unregister_callback('Newstate', on_newstate)
+            await asyncio.sleep(0)
+            assert client._dispatcher._ordered == {}
+            assert all(task.done() for task in workers._tasks)
+        finally:
+            await client.close()
+        # Events of the same channel keep their order
+        assert [seq for seq in received if int(seq) % 5 == 0] == ['0', '5']
+
+    run(scenario, channels=5)
+
+
+def test_buffer_drop_oldest():
+    async def main():
+        buffer = EventBuffer(2, 'drop_oldest')
+        for n in range(5):
+            assert await buffer.put({'Event': 'Newstate', 'Seq': str(n)})
+        return buffer, [buffer.get_nowait()['Seq'] for _ in range(buffer.qsize())]
+
+    buffer, kept = asyncio.run(main())
+    assert kept == ['3', '4']
+    assert buffer.dropped == 3
+
+
+def test_buffer_coalesce():
+    async def main():
+        buffer = EventBuffer(2, 'coalesce', coalesce_key='Channel')
+        for n in range(6):
+            await buffer.put({'Event': 'Newstate', 'Channel': f'PJSIP/{n % 2}', 'Seq': str(n)})
+        # A new key in a full buffer drops the oldest event
+        await buffer.put({'Event': 'Newstate', 'Channel': 'PJSIP/2', 'Seq': '6'})
+        return buffer, [buffer.get_nowait()['Seq'] for _ in range(buffer.qsize())]
+
+    buffer, kept = asyncio.run(main())
+    # The replaced events keep the place of the first event of their key
+    assert kept == ['5', '6']
+    assert buffer.coalesced == 4
+    assert buffer.dropped == 1
+
+
+def test_buffer_block():
+    async def main():
+        buffer = EventBuffer(1, 'block')
+        await buffer.put({'Seq': '0'})
+        writer = asyncio.get_event_loop().create_task(buffer.put({'Seq': '1'}))
+        await asyncio.sleep(0.01)
+        assert not writer.done()
+        assert (await buffer.get())['Seq'] == '0'
+        assert await writer
+        buffer.close()
+        assert (await buffer.get())['Seq'] == '1'
+        return await buffer.get(), buffer.dropped
+
+    assert asyncio.run(main()) == (None, 0)
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        EventBuffer(10, 'drop_all')
+    with pytest.raises(ValueError):
+        EventBuffer(10, 'coalesce')
+
+
+async def gated_client(server, received, **dispatch) -> Tuple[TCPClient, asyncio.Event]:
+    """ A client whose only callback runs one event at a time and waits for the gate """
+    client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+    client.configure_dispatch(**dispatch)
+    await client.connect('admin', 'secret')
+    gate = asyncio.Event()
+
+    async def on_newstate(event, _client):
+        await gate.wait()
+        received.append(event['Seq'])
+
+    await client.register_callback('Newstate', on_newstate, max_concurrency=1)
+    return client, gate
+
+
+def test_block_policy_stops_reading(run):
+    async def scenario(server):
+        received = []
+        client, gate = await gated_client(server, received, max_queue_size=10, overflow='block')
+        try:
+            await server.flood(100)
+            await asyncio.sleep(0.1)
+            stats = client.dispatch_stats()
+            assert stats['queued'] == 10
+            gate.set()
+            while len(received) < 100:
+                await asyncio.sleep(0.01)
+            stats = client.dispatch_stats()
+        finally:
+            await client.close()
+        assert received == [str(n) for n in range(100)]
+        assert stats['dropped'] == 0
+
+    run(scenario)
+
+
+def test_coalesce_policy_keeps_the_latest_state(run):
+    async def scenario(server):
+        received = []
+        client, gate = await gated_client(server, received, max_queue_size=10, overflow='coalesce',
+                                          coalesce_key='Channel')
+        try:
+            await server.flood(100)
+            await asyncio.sleep(0.1)
+            queued = client.dispatch_stats()['queued']
+            gate.set()
+            while '99' not in received:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+            stats = client.dispatch_stats()
+        finally:
+            await client.close()
+        # The queue keeps one event per channel, the latest one
+        assert queued <= 5
+        assert {'95', '96', '97', '98', '99'} <= set(received)
+        assert len(received) + stats['coalesced'] == 100
+        assert stats['dropped'] == 0
+
+    run(scenario, channels=5)
+
+
+def test_ordered_callback_keeps_the_order_per_key(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await client.connect('admin', 'secret')
+        received = {}
+        running = set()
+        overlapped = []
+
+        async def on_newstate(event, _client):
+            running.add(event['Uniqueid'])
+            overlapped.append(len(running))
+            # Later events of a channel finish sooner, the order must still hold
+            await asyncio.sleep(0.01 * (3 - int(event['Seq']) // 5 % 3))
+            running.discard(event['Uniqueid'])
+            received.setdefault(event['Uniqueid'], []).append(int(event['Seq']))
+
+        try:
+            await client.register_callback('Newstate', on_newstate, ordered_by='Uniqueid', workers=5)
+            await server.flood(30)
+            while sum(len(seqs) for seqs in received.values()) < 30:
+                await asyncio.sleep(0.01)
+        finally:
+            await client.close()
+        assert all(seqs == sorted(seqs) for seqs in received.values())
+        assert len(received) == 5
+        # Different channels were processed in parallel
+        assert max(overlapped) > 1
+
+    run(scenario, channels=5)
+
+
+def test_failing_filter_does_not_stop_dispatching():
+    async def main():
+        router = EventRouter()
+        dispatcher = EventDispatcher(None, router)
+        received = []
+
+        async def on_event(event, _client):
+            received.append(event['Seq'])
+
+        router.add(Handler('Newstate', on_event, {'Foo': lambda value: int(value) > 1}))
+        router.add(Handler('*', on_event))
+        runner = asyncio.get_event_loop().create_task(dispatcher.run())
+        await dispatcher.put({'Event': 'Newstate', 'Foo': 'abc', 'Seq': '0'})
+        await dispatcher.put({'Event': 'Hangup', 'Seq': '1'})
+        await asyncio.sleep(0.01)
+        dispatcher.stop()
+        await runner
+        return dispatcher.stats(), received
+
+    stats, received = asyncio.run(main())
+    assert received == ['0', '1']
+    assert stats['errors'] == 1
+
+
+def test_failing_order_key_does_not_stop_dispatching():
+    async def main():
+        router = EventRouter()
+        dispatcher = EventDispatcher(None, router)
+        ordered, received = [], []
+
+        async def on_ordered(event, _client):
+            ordered.append(event['Seq'])
+
+        async def on_event(event, _client):
+            received.append(event['Seq'])
+
+        router.add(Handler('Newstate', on_ordered, ordered_by=lambda event: int(event['Foo'])))
+        router.add(Handler('*', on_event))
+        runner = asyncio.get_event_loop().create_task(dispatcher.run())
+        await dispatcher.put({'Event': 'Newstate', 'Foo': 'abc', 'Seq': '0'})
+        await dispatcher.put({'Event': 'Newstate', 'Foo': '1', 'Seq': '1'})
+        await asyncio.sleep(0.01)
+        dispatcher.stop()
+        await runner
+        return dispatcher.stats(), ordered, received
+
+    stats, ordered, received = asyncio.run(main())
+    assert ordered == ['1']
+    assert received == ['0', '1']
+    assert stats['errors'] == 1
@@ -0,0 +1,96 @@
+import asyncio
+import functools
+import threading
+
+from ami.client import TCPClient
+from ami.executors import is_async_callback
+
+
+async def on_event(event, client, received):
+    received.append(event['Seq'])
+
+
+def test_is_async_callback():
+    assert is_async_callback(on_event)
+    assert is_async_callback(functools.partial(on_event, received=[]))
+    assert not is_async_callback(lambda event, client: None)
+    assert not is_async_callback(print)
+
+
+def flooded(run, register, count=10):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await client.connect('admin', 'secret')
+        received = []
+        try:
+            await register(client, received)
+            await server.flood(count)
+            while len(received) < count:
+                await asyncio.sleep(0.01)
+        finally:
+            await client.close()
+        return received
+
+    return run(scenario)
+
+
+def test_plain_function_runs_in_thread(run):
+    threads = set()
+
+    def on_newstate(event, client, received):
+        threads.add(threading.current_thread().name)
+        received.append(event['Seq'])
+
+    async def register(client, received):
+        await client.register_callback('Newstate', functools.partial(on_newstate, received=received))
+
+    assert sorted(flooded(run, register), key=int) == [str(n) for n in range(10)]
+    assert all(name.startswith('ami-callback') for name in threads)
+
+
+def test_partial_of_coroutine_function(run):
+    async def register(client, received):
+        await client.register_callback('Newstate', functools.partial(on_event, received=received))
+
+    assert flooded(run, register) == [str(n) for n in range(10)]
+
+
+def test_lambda_returning_coroutine(run):
+    async def register(client, received):
+        await client.register_callback('Newstate', lambda event, client: on_event(event, client, received))
+
+    assert sorted(flooded(run, register), key=int) == [str(n) for n in range(10)]
+
+
+def test_batches(run):
+    batches = []
+
+    def save(events, client, received):
+        batches.append(len(events))
+        received.extend(event['Seq'] for event in events)
+
+    async def register(client, received):
+        await client.register_callback('Newstate', functools.partial(save, received=received),
+                                       batch_size=4, batch_wait=0.01)
+
+    assert sorted(flooded(run, register), key=int) == [str(n) for n in range(10)]
+    assert max(batches) <= 4
+
+
+def test_plain_function_runs_after_reconnect(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        received = []
+        await client.register_callback('Newstate', lambda event, _client: received.append(event['Seq']))
+        for _ in range(2):
+            await client.connect('admin', 'secret')
+            try:
+                await server.flood(5)
+                while len(received) < 5:
+                    await asyncio.sleep(0.01)
+            finally:
+                await client.close()
+            received.clear()
+        return client.dispatch_stats()
+
+    assert run(scenario)['errors'] == 0
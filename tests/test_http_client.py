@@ -0,0 +1,154 @@
+import asyncio
+
+from ami.client import HTTPClient
+
+
+async def connected(server, **options) -> HTTPClient:
+    client = HTTPClient('127.0.0.1', server.http_port, **options)
+    await client.connect('admin', 'secret')
+    return client
+
+
+def test_values_keep_their_case(run):
+    async def scenario(server):
+        client = await connected(server)
+        try:
+            response = await client.ami_request({'Action': 'Getvar', 'Variable': 'CALLERID(Name)'})
+        finally:
+            await client.close()
+        assert response[0]['Response'] == 'Success'
+        assert response[0]['Value'] == 'value-CALLERID(Name)'
+
+    run(scenario)
+
+
+def test_event_list(run):
+    async def scenario(server):
+        client = await connected(server)
+        try:
+            response = await client.ami_request({'Action': 'CoreShowChannels'})
+        finally:
+            await client.close()
+        assert [message.get('Event') for message in response[1:]] == ['CoreShowChannel'] * 3 + \
+            ['CoreShowChannelsComplete']
+
+    run(scenario, channels=3)
+
+
+def test_request_stream(run):
+    async def scenario(server):
+        client = await connected(server)
+        try:
+            messages = [message async for message in client.ami_request_stream({'Action': 'CoreShowChannels'})]
+            try:
+                async for _ in client.ami_request_stream({'Action': 'Ping'}, endpoint='arawman'):
+                    pass
+            except ValueError:
+                unsupported = True
+            else:
+                unsupported = False
+        finally:
+            await client.close()
+        assert len(messages) == 4
+        assert unsupported
+
+    run(scenario, channels=2)
+
+
+def test_request_metrics(run):
+    async def scenario(server):
+        client = await connected(server)
+        metrics = client.enable_metrics()
+        try:
+            await client.ping()
+        finally:
+            await client.close()
+        assert metrics.requests['ping'].count == 1
+        assert metrics.requests['ping'].errors == 0
+
+    run(scenario)
+
+
+def test_events_are_polled(run):
+    async def scenario(server):
+        client = await connected(server)
+        received = []
+
+        async def on_newstate(event, _client):
+            received.append(event['Seq'])
+
+        try:
+            await client.register_callback('Newstate', on_newstate)
+            await server.flood(50)
+            while len(received) < 50:
+                await asyncio.sleep(0.01)
+        finally:
+            await client.close()
+        assert received == [str(n) for n in range(50)]
+
+    run(scenario)
+
+
+def test_concurrent_requests_share_the_session(run):
+    async def scenario(server):
+        async with HTTPClient('127.0.0.1', server.http_port, pool_size=4) as client:
+            await client.connect('admin', 'secret')
+            session = client._session
+            responses = await asyncio.gather(*(client.ami_request({'Action': 'Getvar', 'Variable': str(n)})
+                                               for n in range(20)))
+            assert client._session is session
+            # One manager session: every request carried the cookie of the login
+            assert len(server._http_sessions) == 1
+        assert session.closed
+        return responses
+
+    responses = run(scenario)
+    assert [response[0]['Value'] for response in responses] == [f'value-{n}' for n in range(20)]
+
+
+def counted_logins(server):
+    logins = []
+    login = server.actions['login']
+
+    def counted(query, session):
+        logins.append(query.get('secret'))
+        return login(query, session)
+
+    server.actions['login'] = counted
+    return logins
+
+
+def test_rejected_login_stops_the_client(run):
+    async def scenario(server):
+        logins = counted_logins(server)
+        client = HTTPClient('127.0.0.1', server.http_port, retry_delay=0.01)
+        try:
+            response = await client.connect('admin', 'wrong')
+            await asyncio.sleep(0.2)
+        finally:
+            await client.close()
+        assert response[0]['Response'] == 'Error'
+        assert not client.running
+        assert logins == ['wrong']
+
+    run(scenario)
+
+
+def test_failed_relogin_backs_off(run):
+    async def scenario(server):
+        client = await connected(server, retry_delay=0.05)
+        logins = counted_logins(server)
+        try:
+            # The manager session expires and the secret is changed
+            server.secret = 'changed'
+            for session in list(server.sessions):
+                session.authenticated = False
+                if session.waiter is not None and not session.waiter.done():
+                    session.waiter.set_result(None)
+            await asyncio.sleep(0.5)
+        finally:
+            await client.close()
+        # 0.05 + 0.1 + 0.2 seconds between the attempts, a fixed delay would make about 10 of them
+        assert 3 <= len(logins) <= 5
+
+    run(scenario)
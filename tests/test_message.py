@@ -0,0 +1,32 @@
+import pytest
+
+from ami.message import AMIMessage
+
+FRAME = b'Event: VarSet\r\nChannel: PJSIP/100-00000001\r\nVariable: A\r\nVariable: B\r\nValue: 1'
+
+
+def test_mapping():
+    message = AMIMessage(FRAME, 'utf8')
+    assert message['Event'] == 'VarSet'
+    assert message.get('Missing') is None
+    assert 'Channel' in message
+    assert len(message) == 4
+    assert list(message) == ['Event', 'Channel', 'Variable', 'Value']
+    assert message == {'Event': 'VarSet', 'Channel': 'PJSIP/100-00000001', 'Variable': 'B', 'Value': '1'}
+
+
+def test_repeated_headers():
+    message = AMIMessage(FRAME, 'utf8')
+    assert message['Variable'] == 'B'
+    assert message.getall('Variable') == ['A', 'B']
+    assert [name for name, _ in message.headers()] == ['Event', 'Channel', 'Variable', 'Variable', 'Value']
+
+
+def test_immutable_with_mutable_copy():
+    message = AMIMessage(FRAME, 'utf8')
+    with pytest.raises(TypeError):
+        message['Event'] = 'Hangup'
+    copy = message.to_dict()
+    copy['Event'] = 'Hangup'
+    assert message['Event'] == 'VarSet'
+    assert dict(message, Server='pbx1')['Server'] == 'pbx1'
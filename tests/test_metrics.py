@@ -0,0 +1,52 @@
+import asyncio
+import functools
+
+from ami.client import TCPClient
+from ami.metrics import callback_name
+
+
+class Calls:
+    def __init__(self):
+        self.received = 0
+
+    async def on_newstate(self, event, client):
+        self.received += 1
+
+
+def test_callback_name():
+    assert callback_name(Calls().on_newstate) == f'{__name__}.Calls.on_newstate'
+    assert callback_name(functools.partial(Calls.on_newstate, Calls())) == f'{__name__}.Calls.on_newstate'
+    assert callback_name(print) == 'builtins.print'
+
+
+def test_callback_series(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await client.connect('admin', 'secret')
+        metrics = client.enable_metrics()
+        first, second = Calls(), Calls()
+        try:
+            await client.register_callback('Newstate', first.on_newstate)
+            await client.register_callback('Newstate', second.on_newstate)
+            await server.flood(5)
+            while first.received < 5 or second.received < 5:
+                await asyncio.sleep(0.01)
+            await client.ping()
+            snapshot = metrics.snapshot()
+            await client.unregister_callback('Newstate', first.on_newstate)
+            kept = dict(metrics.callbacks)
+            await client.unregister_callback('Newstate', second.on_newstate)
+            text = metrics.prometheus()
+        finally:
+            await client.close()
+        key = f'Newstate:{__name__}.Calls.on_newstate'
+        # The two instances share one series
+        assert list(snapshot['callbacks']) == [key]
+        assert snapshot['callbacks'][key]['count'] == 10
+        assert snapshot['requests']['ping']['count'] == 1
+        assert snapshot['events']['Newstate'] == 5
+        assert len(kept) == 1
+        assert metrics.callbacks == {}
+        assert 'ami_callback_duration_seconds' in text and 'Calls.on_newstate' not in text
+
+    run(scenario)
@@ -0,0 +1,30 @@
+from ami.client import TCPClient
+
+
+def test_originate_many(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await client.connect('admin', 'secret')
+        specs = [{'originator': 100 + n, 'extension': 89999999999} for n in range(5)]
+        try:
+            results = [result async for result in client.originate_many(specs, rate=1000, max_concurrent=2)]
+        finally:
+            await client.close()
+        assert len(results) == 5
+        assert all(result.success and result.reason == '4' for result in results)
+        assert sorted(result.spec['originator'] for result in results) == [100, 101, 102, 103, 104]
+
+    run(scenario)
+
+
+def test_originate_many_without_calls(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await client.connect('admin', 'secret')
+        try:
+            results = [result async for result in client.originate_many([])]
+        finally:
+            await client.close()
+        assert results == []
+
+    run(scenario, timeout=2)
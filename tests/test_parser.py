@@ -0,0 +1,36 @@
+from ami.parser import FrameParser
+
+DATA = (b'Response: Success\r\nActionID: 1\r\nPing: Pong\r\n\r\n'
+        b'Event: Newstate\r\nChannel: PJSIP/100-00000001\r\nChannelStateDesc: Up\r\n\r\n'
+        b'Event: Hangup\r\nChannel: PJSIP/100-00000001\r\n\r\n')
+
+
+def test_complete_frames():
+    messages = FrameParser('utf8').feed(DATA)
+    assert [message.get('Event') for message in messages] == [None, 'Newstate', 'Hangup']
+    assert messages[0]['Ping'] == 'Pong'
+
+
+def test_frames_split_at_every_byte():
+    parser = FrameParser('utf8')
+    messages = []
+    for index in range(len(DATA)):
+        messages += parser.feed(DATA[index:index + 1])
+    assert [message.to_dict() for message in messages] == [message.to_dict() for message in FrameParser().feed(DATA)]
+    assert len(parser) == 0
+
+
+def test_incomplete_frame_is_kept():
+    parser = FrameParser('utf8')
+    assert parser.feed(b'Event: Newstate\r\nChannel: PJSIP/1') == []
+    assert parser.pending() == b'Event: Newstate\r\nChannel: PJSIP/1'
+    messages = parser.feed(b'00\r\n\r\n')
+    assert messages[0]['Channel'] == 'PJSIP/100'
+    parser.feed(b'Event: Hangup\r\n')
+    parser.clear()
+    assert parser.pending() == b''
+
+
+def test_encoding():
+    messages = FrameParser().feed('Event: Newstate\r\nCallerIDName: Оператор\r\n\r\n'.encode('windows-1251'))
+    assert messages[0]['CallerIDName'] == 'Оператор'
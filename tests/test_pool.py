@@ -0,0 +1,80 @@
+import asyncio
+
+from ami.client import TCPClient
+from ami.pool import ClientPool
+
+
+def clients(server, count=2):
+    return [TCPClient('127.0.0.1', server.tcp_port, reconnect=False) for _ in range(count)]
+
+
+def test_requests_and_events(run):
+    async def scenario(server):
+        pool = ClientPool({'a': clients(server), 'b': clients(server)}, health_interval=None)
+        await pool.connect('admin', 'secret')
+        received = []
+
+        async def on_newstate(event, _client):
+            received.append(event['Server'])
+
+        try:
+            pings = await pool.ping()
+            await pool.register_callback('Newstate', on_newstate)
+            await server.flood(3)
+            while len(received) < 6:
+                await asyncio.sleep(0.01)
+        finally:
+            await pool.close()
+        assert all(response[0]['Response'] == 'Success' for response in pings.values())
+        # Only one connection of every server delivers the events
+        assert sorted(received) == ['a', 'a', 'a', 'b', 'b', 'b']
+
+    run(scenario)
+
+
+def test_lost_connections_are_connected_again(run):
+    async def scenario(server):
+        pool = ClientPool({'a': clients(server)}, health_interval=None)
+        await pool.connect('admin', 'secret')
+        try:
+            server.disconnect()
+            while any(member.client.state == 'connected' for member in pool.members):
+                await asyncio.sleep(0.01)
+            await pool.check_health()
+            states = [(member.client.state, member.healthy) for member in pool.members]
+            response = await pool.ami_request({'Action': 'Ping'})
+        finally:
+            await pool.close()
+        assert states == [('connected', True), ('connected', True)]
+        assert response[0]['Response'] == 'Success'
+
+    run(scenario)
+
+
+def test_callbacks_move_to_a_live_connection(run):
+    async def scenario(server):
+        first, second = clients(server)
+        pool = ClientPool({'a': [first, second]}, health_interval=None, health_timeout=0.2)
+        await pool.connect('admin', 'secret')
+        received = []
+
+        async def on_newstate(event, client):
+            received.append(client)
+
+        try:
+            await pool.register_callback('Newstate', on_newstate)
+            # The first connection stops answering
+            ping = server.actions['ping']
+            server.actions['ping'] = lambda query, session: \
+                [] if query['actionid'].startswith(first._action_prefix) else ping(query, session)
+            await pool.check_health()
+            await server.flood(3)
+            while len(received) < 3:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+        finally:
+            await pool.close()
+        assert [member.healthy for member in pool.members] == [False, True]
+        assert received == [second] * 3
+
+    run(scenario)
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from ami.client import TCPClient
+
+
+def queue_status(query, session, members=True, entries=True):
+    response = [
+        {'Response': 'Success', 'EventList': 'start', 'Message': 'Queue status will follow'},
+        {'Event': 'QueueParams', 'Queue': 'support', 'Strategy': 'ringall', 'ServiceLevel': '60',
+         'Completed': '10', 'Abandoned': '2'},
+    ]
+    if members:
+        response.append({'Event': 'QueueMember', 'Queue': 'support', 'Name': 'Operator 100', 'Location': 'PJSIP/100',
+                         'Status': '1', 'Paused': '0', 'InCall': '0', 'CallsTaken': '3'})
+    if entries:
+        response.append({'Event': 'QueueEntry', 'Queue': 'support', 'Uniqueid': '1694584278.1', 'Wait': '12'})
+    response.append({'Event': 'QueueStatusComplete', 'EventList': 'Complete', 'ListItems': str(len(response) - 1)})
+    return response
+
+
+def tracked(run, sla=None):
+    async def scenario(server):
+        server.actions['queuestatus'] = queue_status
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await client.connect('admin', 'secret')
+        try:
+            tracker = await client.track_queues(sla=sla)
+            return tracker.queue('support'), tracker._queues['support'].service_level
+        finally:
+            await client.close()
+
+    return run(scenario)
+
+
+def test_seeded_from_queue_status(run):
+    queue, service_level = tracked(run)
+    assert queue['strategy'] == 'ringall'
+    assert queue['completed'] == 10
+    assert queue['members'] == 1
+    assert queue['calls_waiting'] == 1
+    assert service_level == 60
+
+
+def test_sla_overrides_service_level(run):
+    _, service_level = tracked(run, sla=20)
+    assert service_level == 20
+
+
+def send(server, events):
+    for session in list(server.sessions):
+        if session.authenticated:
+            session.send(events)
+
+
+def test_window_statistics(run):
+    async def scenario(server):
+        server.actions['queuestatus'] = queue_status
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await client.connect('admin', 'secret')
+        try:
+            tracker = await client.track_queues()
+            send(server, [
+                {'Event': 'QueueCallerJoin', 'Queue': 'support', 'Uniqueid': '1694584278.2'},
+                {'Event': 'QueueCallerLeave', 'Queue': 'support', 'Uniqueid': '1694584278.1'},
+                {'Event': 'AgentConnect', 'Queue': 'support', 'Interface': 'PJSIP/100', 'HoldTime': '10'},
+                {'Event': 'AgentConnect', 'Queue': 'support', 'Interface': 'PJSIP/100', 'HoldTime': '90'},
+                {'Event': 'QueueCallerAbandon', 'Queue': 'support', 'Uniqueid': '1694584278.3'},
+                {'Event': 'AgentComplete', 'Queue': 'support', 'Interface': 'PJSIP/100', 'TalkTime': '100'},
+                {'Event': 'AgentComplete', 'Queue': 'support', 'Interface': 'PJSIP/100', 'TalkTime': '200'},
+            ])
+            while tracker.queue('support')['window']['completed'] < 2:
+                await asyncio.sleep(0.01)
+            return tracker.queue('support'), tracker.agent('PJSIP/100')
+        finally:
+            await client.close()
+
+    queue, agent = run(scenario)
+    assert queue['calls_waiting'] == 1
+    assert queue['completed'] == 12
+    assert queue['abandoned'] == 3
+    # 1 of 2 answered calls within the 60 seconds of the queue, 1 abandoned call
+    window = queue['window']
+    assert window['sla'] == pytest.approx(100 / 3)
+    assert (window['answered'], window['abandoned'], window['completed']) == (2, 1, 2)
+    assert (window['avg_hold_time'], window['avg_talk_time']) == (50, 150)
+    assert agent['answered'] == 2
+    assert agent['avg_talk_time'] == 150
+    assert agent['queues'] == ['support']
+
+
+def test_reloaded_after_reconnect(run):
+    async def scenario(server):
+        server.actions['queuestatus'] = queue_status
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect_delay=0.01)
+        await client.connect('admin', 'secret')
+        reconnected = asyncio.Event()
+
+        async def on_state(state, _client):
+            if state == 'connected':
+                reconnected.set()
+
+        try:
+            tracker = await client.track_queues()
+            await client.register_state_callback(on_state)
+            assert tracker.queue('support')['calls_waiting'] == 1
+            # The caller left and the member was removed while the client was disconnected
+            server.actions['queuestatus'] = lambda query, session: queue_status(query, session, False, False)
+            server.disconnect()
+            await reconnected.wait()
+            while not tracker.synced:
+                await asyncio.sleep(0.01)
+            return tracker.queue('support'), tracker.agents()
+        finally:
+            await client.close()
+
+    queue, agents = run(scenario)
+    assert queue['calls_waiting'] == 0
+    assert queue['longest_wait'] == 0
+    assert queue['members'] == 0
+    assert agents == {}
@@ -0,0 +1,54 @@
+import asyncio
+import gzip
+
+import pytest
+
+from ami.client import TCPClient
+from ami.recording import MAGIC, replay_events
+
+
+async def record(server, path: str, count: int, compress: bool = False, max_bytes=None) -> None:
+    client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+    await client.connect('admin', 'secret')
+    try:
+        client.start_recording(path, compress=compress, max_bytes=max_bytes, flush_interval=0.01)
+        response = await client.ami_request({'Action': 'Originate', 'Channel': 'PJSIP/100', 'Async': 'true'})
+        assert response[0]['Response'] == 'Success'
+        await server.flood(count)
+        await asyncio.sleep(0.1)
+    finally:
+        await client.stop_recording()
+        await client.close()
+
+
+def events(path: str):
+    return [event.get('Event') for _, chunk in replay_events(path) for event in chunk]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_recordings_are_appended(run, tmp_path, compress):
+    path = str(tmp_path / 'events.amirec')
+
+    async def scenario(server):
+        await record(server, path, 3, compress)
+        await record(server, path, 2, compress)
+
+    run(scenario)
+    opener = gzip.open if compress else open
+    with opener(path, 'rb') as file:
+        assert file.read(len(MAGIC)) == MAGIC
+    # The OriginateResponse events are replayed, the responses are not
+    assert events(path) == ['OriginateResponse'] + ['Newstate'] * 3 + ['OriginateResponse'] + ['Newstate'] * 2
+
+
+def test_rotated_recordings_continue_in_the_last_part(run, tmp_path):
+    path = str(tmp_path / 'events.amirec')
+
+    async def scenario(server):
+        await record(server, path, 20, max_bytes=4096)
+        await record(server, path, 20, max_bytes=4096)
+
+    run(scenario)
+    assert not (tmp_path / 'events.amirec').exists()
+    assert len(list(tmp_path.iterdir())) >= 2
+    assert events(path) == (['OriginateResponse'] + ['Newstate'] * 20) * 2
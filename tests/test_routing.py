@@ -0,0 +1,58 @@
+import re
+
+import pytest
+
+from ami.routing import EventRouter, Handler, prefix
+
+
+async def callback(event, client):
+    pass
+
+
+async def other(event, client):
+    pass
+
+
+def test_match_by_name_and_filters():
+    router = EventRouter()
+    exact = router.add(Handler('Newstate', callback, {'Channel': 'PJSIP/100-00000001'}))
+    by_prefix = router.add(Handler('Newstate', callback, {'Channel': prefix('PJSIP/')}))
+    by_predicate = router.add(Handler('Newstate', other, {'ChannelState': lambda value: int(value) > 4}))
+    wildcard = router.add(Handler('*', other))
+    event = {'Event': 'Newstate', 'Channel': 'PJSIP/100-00000001', 'ChannelState': '6'}
+    assert set(router.match(event)) == {exact, by_prefix, by_predicate, wildcard}
+    event = {'Event': 'Newstate', 'Channel': 'SIP/100-00000001', 'ChannelState': '4'}
+    assert set(router.match(event)) == {wildcard}
+    assert set(router.match({'Event': 'Hangup'})) == {wildcard}
+
+
+def test_regular_expression_filter():
+    router = EventRouter()
+    handler = router.add(Handler('Hangup', callback, {'Cause': re.compile(r'1[67]$')}))
+    assert router.match({'Event': 'Hangup', 'Cause': '16'}) == [handler]
+    assert not router.match({'Event': 'Hangup', 'Cause': '21'})
+
+
+def test_remove():
+    router = EventRouter()
+    router.add(Handler('Newstate', callback))
+    router.add(Handler('Newstate', callback, {'Channel': 'PJSIP/100'}))
+    kept = router.add(Handler('Newstate', other))
+    assert router.remove('Newstate', callback) == 2
+    assert router.remove('Newstate', callback) == 0
+    assert list(router.match({'Event': 'Newstate', 'Channel': 'PJSIP/100'})) == [kept]
+    assert router.event_names() == ['Newstate']
+
+
+def test_ordered_handler_requires_workers():
+    with pytest.raises(ValueError):
+        Handler('Newstate', callback, ordered_by='Uniqueid', workers=0)
+
+
+def test_failing_filter_does_not_match():
+    router = EventRouter()
+    router.add(Handler('Newstate', callback, {'Foo': lambda value: int(value) > 1}))
+    wildcard = router.add(Handler('*', other))
+    assert router.match({'Event': 'Newstate', 'Foo': 'abc'}) == [wildcard]
+    assert router.errors == 1
+    assert len(router.match({'Event': 'Newstate', 'Foo': '2'})) == 2
@@ -0,0 +1,18 @@
+from ami.serializer import action_headers, header_name, serialize_action
+
+
+def test_serialize_action():
+    data = serialize_action({'Action': 'Originate', 'Channel': 'PJSIP/100', 'Variable': ['A=1', 'B=2'], 'Timeout': 15})
+    assert data == (b'Action: Originate\r\nChannel: PJSIP/100\r\nVariable: A=1\r\nVariable: B=2\r\n'
+                    b'Timeout: 15\r\n\r\n')
+
+
+def test_indexed_keys_are_repeated_headers():
+    assert header_name('Variable[0]') == 'Variable'
+    assert action_headers({'Action': 'Setvar', 'Variable[0]': 'A=1', 'Variable[1]': 'B=2'}) == [
+        ('Action', 'Setvar'), ('Variable', 'A=1'), ('Variable', 'B=2')]
+
+
+def test_encoding():
+    assert serialize_action({'Action': 'Setvar', 'Value': 'Оператор'}, 'windows-1251') == \
+        'Action: Setvar\r\nValue: Оператор\r\n\r\n'.encode('windows-1251')
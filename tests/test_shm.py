@@ -0,0 +1,39 @@
+import asyncio
+
+from ami.shm import EventWorker, RingBuffer, decode_event, encode_event
+
+
+def test_encode_event_round_trip():
+    event = decode_event(encode_event({'Event': 'Newstate', 'Channel': 'PJSIP/100-00000001'}))
+    assert event['Event'] == 'Newstate'
+    assert event['Channel'] == 'PJSIP/100-00000001'
+
+
+def test_worker_runs_plain_and_async_callbacks():
+    async def main():
+        ring = RingBuffer.create(64 * 1024)
+        try:
+            for n in range(5):
+                assert ring.write(encode_event({'Event': 'Newstate', 'Seq': str(n)}))
+            ring.close()
+            worker = EventWorker(ring.name, poll_interval=0.001)
+            plain, coroutine = [], []
+
+            async def on_async(event, _worker):
+                coroutine.append(event['Seq'])
+
+            await worker.register_callback('Newstate', lambda event, _worker: plain.append(event['Seq']))
+            await worker.register_callback('Newstate', on_async)
+            await asyncio.wait_for(worker.run(), 5)
+        finally:
+            ring.release()
+        return plain, coroutine
+
+    plain, coroutine = asyncio.run(main())
+    assert sorted(plain) == ['0', '1', '2', '3', '4']
+    assert coroutine == ['0', '1', '2', '3', '4']
+
+
+def test_encode_event_keeps_repeated_headers():
+    message = decode_event(b'Event: VarSet\r\nVariable: A\r\nVariable: B\r\n')
+    assert decode_event(encode_event(message)).getall('Variable') == ['A', 'B']
@@ -0,0 +1,79 @@
+import asyncio
+
+from ami.client import TCPClient
+
+
+def test_refresh_drops_missing_channels(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await client.connect('admin', 'secret')
+        try:
+            tracker = await client.track_channels()
+            assert len(tracker) == 3
+            assert tracker.by_name('PJSIP/101-00000001').uniqueid == '1694584278.1'
+            server.channels = 1
+            await tracker.refresh()
+            assert [channel.uniqueid for channel in tracker._channels.values()] == ['1694584278.0']
+            assert tracker.by_name('PJSIP/101-00000001') is None
+        finally:
+            await client.close()
+
+    run(scenario, channels=3)
+
+
+def test_reloaded_after_reconnect(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect_delay=0.01)
+        await client.connect('admin', 'secret')
+        reconnected = asyncio.Event()
+
+        async def on_state(state, _client):
+            if state == 'connected':
+                reconnected.set()
+
+        try:
+            tracker = await client.track_channels()
+            await client.register_state_callback(on_state)
+            assert len(await client.channels()) == 5
+            server.channels = 2
+            server.disconnect()
+            await reconnected.wait()
+            while not tracker.synced:
+                await asyncio.sleep(0.01)
+            response = await client.channels()
+        finally:
+            await client.close()
+        assert len(tracker) == 2
+        assert response[-1]['ListItems'] == '2'
+
+    run(scenario, channels=3)
+
+
+def test_hangup_while_loading_is_not_restored(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        await client.connect('admin', 'secret')
+        bridge_list = server.actions['bridgelist']
+        try:
+            tracker = await client.track_channels()
+            assert tracker.get('1694584278.1') is not None
+
+            def hangup_then_list(query, session):
+                # The channel hangs up after CoreShowChannels listed it and before BridgeList is answered
+                session.send([{'Event': 'Hangup', 'Channel': 'PJSIP/101-00000001', 'Uniqueid': '1694584278.1',
+                               'Cause': '16'}])
+                response = bridge_list(query, session)
+                for message in response:
+                    message['ActionID'] = query['actionid']
+                asyncio.get_event_loop().call_later(0.05, session.send, response)
+                return []
+
+            server.actions['bridgelist'] = hangup_then_list
+            await tracker.refresh()
+        finally:
+            await client.close()
+        assert tracker.get('1694584278.1') is None
+        assert tracker.by_name('PJSIP/101-00000001') is None
+        assert len(tracker) == 2
+
+    run(scenario, channels=3)
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from ami.client import TCPClient
+
+
+async def connected(server) -> TCPClient:
+    client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+    await client.connect('admin', 'secret')
+    return client
+
+
+def test_batches(run):
+    async def scenario(server):
+        client = await connected(server)
+        batches = []
+        try:
+            async with client.event_stream('Newstate', max_batch=100, max_wait=0.05) as stream:
+                await server.flood(1000)
+                async for batch in stream:
+                    batches.append(batch)
+                    if sum(len(batch) for batch in batches) == 1000:
+                        break
+            assert stream.closed
+            assert not client._router.match({'Event': 'Newstate'})
+        finally:
+            await client.close()
+        assert all(len(batch) <= 100 for batch in batches)
+        assert len(batches) >= 10
+        assert [event['Seq'] for batch in batches for event in batch] == [str(n) for n in range(1000)]
+
+    run(scenario)
+
+
+def test_batch_is_returned_after_max_wait(run):
+    async def scenario(server):
+        client = await connected(server)
+        loop = asyncio.get_event_loop()
+        try:
+            stream = client.event_stream(['Newstate'], max_batch=500, max_wait=0.1)
+            await server.flood(3)
+            started = loop.time()
+            batch = await stream.__anext__()
+            elapsed = loop.time() - started
+        finally:
+            await client.close()
+        assert [event['Seq'] for event in batch] == ['0', '1', '2']
+        assert elapsed < 0.5
+        # Closing the client ends the streams
+        assert stream.closed
+
+    run(scenario)
+
+
+def test_filters_and_overflow(run):
+    async def scenario(server):
+        client = await connected(server)
+        try:
+            stream = client.event_stream('Newstate', max_size=10, filters={'Channel': 'PJSIP/100-00000000'})
+            await server.flood(200)
+            await client.ping()
+            while client.dispatch_stats()['queued']:
+                await asyncio.sleep(0.01)
+            stream.close()
+            events = [event async for batch in stream for event in batch]
+        finally:
+            await client.close()
+        # 20 events of the channel, the oldest 10 were dropped
+        assert [event['Seq'] for event in events] == [str(n) for n in range(100, 200, 10)]
+        assert stream.dropped == 10
+
+    run(scenario, channels=10)
+
+
+def test_invalid_batch():
+    with pytest.raises(ValueError):
+        TCPClient('127.0.0.1').event_stream('Newstate', max_batch=0)
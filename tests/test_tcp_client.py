@@ -0,0 +1,331 @@
+import asyncio
+
+import pytest
+
+from ami.client import TCPClient
+
+
+async def connected(server, **options) -> TCPClient:
+    client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False, **options)
+    await client.connect('admin', 'secret')
+    return client
+
+
+async def reconnected(server, client: TCPClient) -> None:
+    """ Drops the connection and waits until the client has restored its session """
+    done = asyncio.Event()
+
+    async def on_state(state, _client):
+        if state == 'connected':
+            done.set()
+
+    await client.register_state_callback(on_state)
+    server.disconnect()
+    await done.wait()
+    client._state_callbacks.remove(on_state)
+
+
+def test_ping(run):
+    async def scenario(server):
+        client = await connected(server)
+        try:
+            response = await client.ping()
+        finally:
+            await client.close()
+        assert response[0]['Response'] == 'Success'
+        assert response[0]['Ping'] == 'Pong'
+
+    run(scenario)
+
+
+def test_event_list(run):
+    async def scenario(server):
+        client = await connected(server)
+        try:
+            response = await client.ami_request({'Action': 'CoreShowChannels'})
+        finally:
+            await client.close()
+        assert response[0]['EventList'] == 'start'
+        assert [message['Event'] for message in response[1:-1]] == ['CoreShowChannel'] * 5
+        assert response[-1]['Event'] == 'CoreShowChannelsComplete'
+
+    run(scenario, channels=5)
+
+
+def test_originate_response_is_dispatched(run):
+    # OriginateResponse has a Response header and the ActionID of the Originate, it is still an event
+    async def scenario(server):
+        client = await connected(server)
+        received = asyncio.get_event_loop().create_future()
+
+        async def on_response(event, _client):
+            if not received.done():
+                received.set_result(event)
+
+        await client.register_callback('OriginateResponse', on_response)
+        try:
+            response = await client.ami_request({'Action': 'Originate', 'Channel': 'PJSIP/100', 'Async': 'true'})
+            event = await asyncio.wait_for(received, 5)
+        finally:
+            await client.close()
+        assert response[0]['Response'] == 'Success'
+        assert event['Response'] == 'Success'
+        assert event['ActionID'] == response[0]['ActionID']
+
+    run(scenario)
+
+
+def test_logoff(run):
+    async def scenario(server):
+        client = await connected(server)
+        response = await client.logoff(request_timeout=5)
+        assert response[0]['Response'] == 'Goodbye'
+        assert client.state == 'closed'
+
+    run(scenario)
+
+
+def test_login_secret_is_case_sensitive(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        try:
+            response = await client.connect('ADMIN', 'Secret')
+        finally:
+            await client.close()
+        assert response[0]['Response'] == 'Error'
+
+    run(scenario)
+
+
+def test_reconnect_replays_read_only_requests(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect_delay=0.01)
+        await client.connect('admin', 'secret')
+        answer = server.actions['getvar']
+        server.actions['getvar'] = lambda query, session: []
+        try:
+            request = asyncio.get_event_loop().create_task(client.ami_request({'Action': 'Getvar', 'Variable': 'A'}))
+            await asyncio.sleep(0.05)
+            server.actions['getvar'] = answer
+            server.disconnect()
+            response = await request
+            for _ in range(2):
+                await reconnected(server, client)
+                await client.ping()
+        finally:
+            await client.close()
+        assert response[0]['Value'] == 'value-A'
+        assert client.reconnects == 3
+        # Finished resume tasks are not kept
+        assert len(client._loop_tasks) <= 3
+
+    run(scenario)
+
+
+def test_cached_request_keeps_replay(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect_delay=0.01)
+        await client.connect('admin', 'secret')
+        client.enable_cache()
+        server.actions['getvar'] = lambda query, session: []
+        try:
+            request = asyncio.get_event_loop().create_task(
+                client.ami_request({'Action': 'Getvar', 'Variable': 'A'}, replay=False))
+            await asyncio.sleep(0.05)
+            server.disconnect()
+            try:
+                await request
+            except ConnectionError:
+                return True
+            return False
+        finally:
+            await client.close()
+
+    assert run(scenario)
+
+
+def test_requests_continue_when_restoring_the_session_fails(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect_delay=0.01, event_filters=['Event: Newstate'],
+                           request_timeout=0.2)
+        await client.connect('admin', 'secret')
+        # The filter is not answered after the reconnect, so the session is restored only partially
+        server.actions['filter'] = lambda query, session: []
+        try:
+            await reconnected(server, client)
+            response = await client.ami_request({'Action': 'Ping'}, request_timeout=5)
+        finally:
+            await client.close()
+        assert response[0]['Response'] == 'Success'
+        assert client.state == 'closed'
+
+    run(scenario)
+
+
+def delayed_getvar(delay: float):
+    """ A Getvar action answered after the delay """
+    def getvar(query, session):
+        response = {'Response': 'Success', 'Variable': query.get('variable', ''),
+                    'Value': f"value-{query.get('variable', '')}", 'ActionID': query.get('actionid')}
+        asyncio.get_event_loop().call_later(delay, session.send, [response])
+        return []
+    return getvar
+
+
+def test_concurrent_requests_are_multiplexed(run):
+    async def scenario(server):
+        client = await connected(server)
+        server.actions['getvar'] = delayed_getvar(0.2)
+        loop = asyncio.get_event_loop()
+        try:
+            started = loop.time()
+            responses = await asyncio.gather(*(client.ami_request({'Action': 'Getvar', 'Variable': str(n)})
+                                               for n in range(50)))
+            elapsed = loop.time() - started
+        finally:
+            await client.close()
+        assert [response[0]['Value'] for response in responses] == [f'value-{n}' for n in range(50)]
+        # The requests waited for their responses at the same time, not one after another
+        assert elapsed < 2
+
+    run(scenario)
+
+
+def test_duplicate_action_id(run):
+    async def scenario(server):
+        client = await connected(server)
+        server.actions['getvar'] = delayed_getvar(0.1)
+        try:
+            first = asyncio.get_event_loop().create_task(
+                client.ami_request({'Action': 'Getvar', 'Variable': 'A', 'ActionID': 'same'}))
+            await asyncio.sleep(0.01)
+            with pytest.raises(ValueError):
+                await client.ami_request({'Action': 'Getvar', 'Variable': 'B', 'ActionID': 'same'})
+            response = await first
+        finally:
+            await client.close()
+        assert response[0]['Value'] == 'value-A'
+
+    run(scenario)
+
+
+def test_late_response_is_discarded(run):
+    async def scenario(server):
+        client = await connected(server)
+        events = []
+
+        async def on_event(event, _client):
+            events.append(event)
+
+        await client.register_callback('*', on_event)
+        server.actions['getvar'] = delayed_getvar(0.1)
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await client.ami_request({'Action': 'Getvar', 'Variable': 'A'}, request_timeout=0.01)
+            await asyncio.sleep(0.2)
+            response = await client.ping()
+        finally:
+            await client.close()
+        assert response[0]['Ping'] == 'Pong'
+        assert client._expired == {}
+        assert events == []
+
+    run(scenario)
+
+
+def test_filters_and_event_mask_are_applied_on_every_login(run):
+    async def scenario(server):
+        applied = []
+        filter_answer, events_answer = server.actions['filter'], server.actions['events']
+
+        def on_filter(query, session):
+            applied.append(('filter', query.get('operation'), query.get('filter')))
+            return filter_answer(query, session)
+
+        def on_events(query, session):
+            applied.append(('events', query.get('eventmask')))
+            return events_answer(query, session)
+
+        server.actions['filter'], server.actions['events'] = on_filter, on_events
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect_delay=0.01,
+                           event_filters=['Event: Newstate'], event_mask=['call', 'agent'])
+        await client.connect('admin', 'secret')
+        try:
+            response = await client.add_filter('!Channel: Local/')
+            assert response[0]['Response'] == 'Success'
+            before = list(applied)
+            applied.clear()
+            await reconnected(server, client)
+        finally:
+            await client.close()
+        assert before == [('events', 'call,agent'), ('filter', 'Add', 'Event: Newstate'),
+                          ('filter', 'Add', '!Channel: Local/')]
+        assert applied == [('events', 'call,agent'), ('filter', 'Add', 'Event: Newstate'),
+                           ('filter', 'Add', '!Channel: Local/')]
+
+    run(scenario)
+
+
+def test_filter_by_callbacks(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+
+        async def on_event(event, _client):
+            pass
+
+        await client.register_callback('Newstate', on_event)
+        await client.register_callback('Hangup', on_event)
+        try:
+            # Before the login the filter is only kept
+            assert await client.filter_by_callbacks() == []
+            await client.connect('admin', 'secret')
+            await client.register_callback('*', on_event)
+            assert client.callbacks_filter() is None
+        finally:
+            await client.close()
+        return client._event_filters
+
+    assert run(scenario) == ['^Event: (Hangup|Newstate)[[:space:]]']
+
+
+def test_command_is_not_replayed(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect_delay=0.01)
+        await client.connect('admin', 'secret')
+        server.actions['command'] = lambda query, session: []
+        try:
+            request = asyncio.get_event_loop().create_task(
+                client.ami_request({'Action': 'Command', 'Command': 'channel request hangup all'}))
+            await asyncio.sleep(0.05)
+            server.disconnect()
+            with pytest.raises(ConnectionError):
+                await request
+        finally:
+            await client.close()
+
+    run(scenario)
+
+
+def test_state_callback_tasks_are_kept_until_done(run):
+    async def scenario(server):
+        client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False)
+        release = asyncio.Event()
+        states = []
+
+        async def on_state(state, _client):
+            await release.wait()
+            states.append(state)
+
+        await client.register_state_callback(on_state)
+        await client.connect('admin', 'secret')
+        try:
+            assert len(client._state_tasks) == 1
+            release.set()
+            await asyncio.sleep(0.01)
+            assert not client._state_tasks
+        finally:
+            await client.close()
+            await asyncio.sleep(0.01)
+        assert states == ['connected', 'closed']
+
+    run(scenario)
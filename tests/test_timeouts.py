@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from ami.client import TCPClient
+from ami.timeouts import deadline, effective_timeout
+
+
+def silent(query, session):
+    """ An action the server never answers """
+    return []
+
+
+async def connected(server, **options) -> TCPClient:
+    client = TCPClient('127.0.0.1', server.tcp_port, reconnect=False, **options)
+    await client.connect('admin', 'secret')
+    server.actions['getvar'] = silent
+    return client
+
+
+def test_effective_timeout():
+    assert effective_timeout(None) is None
+    assert effective_timeout(float('inf')) is None
+    with deadline(10):
+        assert 9 < effective_timeout(None) <= 10
+        assert effective_timeout(1) == 1
+        with deadline(0.5):
+            assert effective_timeout(1) <= 0.5
+        # A nested deadline can not extend the outer one
+        with deadline(100):
+            assert effective_timeout(None) <= 10
+    with deadline(0):
+        with pytest.raises(asyncio.TimeoutError):
+            effective_timeout(1)
+
+
+def test_request_timeout(run):
+    async def scenario(server):
+        client = await connected(server, request_timeout=0.05)
+        loop = asyncio.get_event_loop()
+        try:
+            started = loop.time()
+            with pytest.raises(asyncio.TimeoutError):
+                await client.ami_request({'Action': 'Getvar', 'Variable': 'A'})
+            default = loop.time() - started
+            started = loop.time()
+            with pytest.raises(asyncio.TimeoutError):
+                await client.ami_request({'Action': 'Getvar', 'Variable': 'A'}, request_timeout=0.3)
+            explicit = loop.time() - started
+            # The connection stays usable after the timeouts
+            response = await client.ping()
+        finally:
+            await client.close()
+        assert default < 0.25
+        assert explicit >= 0.3
+        assert response[0]['Ping'] == 'Pong'
+
+    run(scenario)
+
+
+def test_deadline_limits_all_requests_of_the_block(run):
+    async def scenario(server):
+        client = await connected(server)
+        loop = asyncio.get_event_loop()
+        try:
+            started = loop.time()
+            with deadline(0.2):
+                await client.ping()
+                # Tasks started in the block share its deadline
+                task = loop.create_task(client.ami_request({'Action': 'Getvar', 'Variable': 'A'}, request_timeout=5))
+                with pytest.raises(asyncio.TimeoutError):
+                    await task
+                with pytest.raises(asyncio.TimeoutError):
+                    await client.ping()
+            elapsed = loop.time() - started
+            response = await client.ping()
+        finally:
+            await client.close()
+        assert elapsed < 1
+        assert response[0]['Response'] == 'Success'
+
+    run(scenario)